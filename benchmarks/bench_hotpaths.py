@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks for scrapy-prerender hot paths: middleware request and
+response processing, request fingerprints, argument hashing, cookie
+conversion and PrerenderJsonResponse construction. Synthetic requests
+and canned Prerender responses are used, so no Prerender server is needed.
+
+Install scrapy-prerender (e.g. ``pip install -e .``) and run::
+
+    python benchmarks/bench_hotpaths.py
+
+Save results as a baseline, then compare a later run against it;
+the script exits with status 1 if any benchmark is slower than
+the baseline by more than ``--tolerance``::
+
+    python benchmarks/bench_hotpaths.py --save baseline.json
+    python benchmarks/bench_hotpaths.py --compare baseline.json
+
+Baselines depend on the machine and Python version, so compare only
+results obtained in the same environment. ``benchmarks/baseline.json``
+has reference results (single core Xeon VM, Python 3.11, Scrapy 2.5);
+regenerate it with ``--save`` when a change makes hot paths faster.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import base64
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+from six.moves.http_cookiejar import CookieJar
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+
+from scrapy_prerender import (
+    PrerenderMiddleware,
+    PrerenderRequest,
+    PrerenderJsonResponse,
+)
+from scrapy_prerender.cookies import jar_to_har, har_to_jar
+from scrapy_prerender.dupefilter import (
+    invalidate_prerender_fingerprint,
+    prerender_request_fingerprint,
+)
+from scrapy_prerender.utils import (
+    dict_hash,
+    json_based_hash,
+    streaming_dict_hash,
+)
+
+# the script can be run from any directory, or with python -m
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_serializers import make_args  # noqa: E402
+
+
+def make_har_cookies(n=50):
+    return [
+        {'name': 'cookie%d' % i, 'value': 'v' * 40, 'path': '/',
+         'domain': '.example.com', 'secure': False, 'httpOnly': True,
+         'expires': '2055-07-24T19:20:30Z'}
+        for i in range(n)
+    ]
+
+
+def make_html(size):
+    row = u'<div class="item"><a href="/item/%d">Item %d</a></div>\n'
+    parts = []
+    i = 0
+    while sum(len(p) for p in parts) < size:
+        parts.append(row % (i, i))
+        i += 1
+    return u'<html><body>\n%s</body></html>' % u''.join(parts)
+
+
+def make_har(entries):
+    return {'log': {'version': '1.2', 'entries': [
+        {
+            'startedDateTime': '2017-01-01T00:00:00Z',
+            'time': 12.5,
+            'request': {
+                'method': 'GET',
+                'url': 'http://example.com/static/%d.js' % i,
+                'headers': [{'name': 'Accept', 'value': '*/*'}] * 5,
+            },
+            'response': {
+                'status': 200,
+                'headers': [{'name': 'Content-Type',
+                             'value': 'application/javascript'}] * 5,
+                'content': {'size': 1024, 'mimeType': 'text/javascript'},
+            },
+        } for i in range(entries)
+    ]}}
+
+
+# canned bodies of 'execute' / 'render.json' responses
+MAGIC_RESPONSES = {
+    'small_html': {
+        'url': 'http://example.com/page',
+        'http_status': 200,
+        'headers': [{'name': 'Content-Type', 'value': 'text/html'}],
+        'html': make_html(5 * 1024),
+    },
+    'big_har': {
+        'url': 'http://example.com/page',
+        'http_status': 200,
+        'html': make_html(50 * 1024),
+        'har': make_har(500),
+    },
+    'base64_png': {
+        'url': 'http://example.com/page',
+        'html': make_html(20 * 1024),
+        'png': base64.b64encode(b'\x89PNG\r\n\x1a\n' + b'\x00' * 300 * 1024
+                                ).decode('ascii'),
+    },
+}
+
+
+def _get_middleware():
+    crawler = get_crawler(settings_dict={'PRERENDER_LATENCY_STATS': True})
+    crawler.stats.open_spider(None)
+    return PrerenderMiddleware.from_crawler(crawler)
+
+
+def _make_request(args=None):
+    args = dict(args or make_args())
+    return PrerenderRequest(args.pop('url'), endpoint='execute', args=args)
+
+
+def _json_response(request, data):
+    return Response(request.url, request=request,
+                    headers={'Content-Type': 'application/json'},
+                    body=json.dumps(data).encode('utf8'))
+
+
+def bench_request():
+    args = make_args()
+    return lambda: _make_request(args)
+
+
+def bench_process_request():
+    # PrerenderMiddleware changes request.meta, so a new request is
+    # needed for each call; compare with 'PrerenderRequest' benchmark
+    # to get the cost of middleware alone.
+    mw = _get_middleware()
+    args = make_args()
+
+    def run():
+        new_request = mw.process_request(_make_request(args), None)
+        mw.process_request(new_request, None)
+        mw.process_response(new_request, Response(new_request.url), None)
+    return run
+
+
+def bench_process_response():
+    mw = _get_middleware()
+    request = mw.process_request(_make_request(), None)
+    body = MAGIC_RESPONSES['small_html']
+
+    def run():
+        mw.process_request(request, None)
+        mw.process_response(request, _json_response(request, body), None)
+    return run
+
+
+def _bench_fingerprint(version, processed=False):
+    # fingerprints are cached per request, so the cache is dropped
+    # before each call; copying the request would be measured too
+    def setup():
+        request = _make_request()
+        if processed:
+            request = _get_middleware().process_request(request, None)
+
+        def run():
+            invalidate_prerender_fingerprint(request)
+            return prerender_request_fingerprint(request, version=version)
+        return run
+    return setup
+
+
+def bench_dict_hash():
+    args = make_args()
+    return lambda: dict_hash(args)
+
+
+def bench_streaming_dict_hash():
+    args = make_args()
+    return lambda: streaming_dict_hash(args)
+
+
+def bench_json_based_hash():
+    lua_source = make_args()['lua_source']
+    return lambda: json_based_hash(lua_source)
+
+
+def bench_jar_to_har():
+    jar = CookieJar()
+    har_to_jar(jar, make_har_cookies())
+    return lambda: jar_to_har(jar)
+
+
+def bench_har_to_jar():
+    cookies = make_har_cookies()
+    return lambda: har_to_jar(CookieJar(), cookies, cookies)
+
+
+def _bench_json_response(name):
+    def setup():
+        request = _make_request()
+        body = json.dumps(MAGIC_RESPONSES[name]).encode('utf8')
+
+        def run():
+            PrerenderJsonResponse(request.url, request=request, body=body)
+        return run
+    return setup
+
+
+BENCHMARKS = [
+    ('PrerenderRequest', bench_request),
+    ('middleware.process_request', bench_process_request),
+    ('middleware.process_response', bench_process_response),
+    ('prerender_request_fingerprint.v1', _bench_fingerprint(1)),
+    ('prerender_request_fingerprint.v1.processed', _bench_fingerprint(1, True)),
+    ('prerender_request_fingerprint.v2', _bench_fingerprint(2)),
+    ('prerender_request_fingerprint.v2.processed', _bench_fingerprint(2, True)),
+    ('dict_hash', bench_dict_hash),
+    ('streaming_dict_hash', bench_streaming_dict_hash),
+    ('json_based_hash', bench_json_based_hash),
+    ('jar_to_har', bench_jar_to_har),
+    ('har_to_jar', bench_har_to_jar),
+] + [
+    ('PrerenderJsonResponse.%s' % name, _bench_json_response(name))
+    for name in sorted(MAGIC_RESPONSES)
+]
+
+
+def measure(func, min_time=0.2, repeat=5):
+    """ Return the best time of a single call, in microseconds """
+    number = 1
+    while True:
+        start = time.time()
+        for _ in range(number):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= 0.01:
+            break
+        number *= 10
+    number = max(1, int(number * min_time / elapsed))
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return best / number * 1e6
+
+
+def run(names_filter=None, min_time=0.2):
+    results = {}
+    for name, setup in BENCHMARKS:
+        if names_filter and names_filter not in name:
+            continue
+        results[name] = measure(setup(), min_time=min_time)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Print a comparison table; return names of regressed benchmarks """
+    regressions = []
+    print("%-42s %12s %12s %8s" % ('name', 'baseline us', 'us', 'change'))
+    for name in sorted(results):
+        usec = results[name]
+        if name not in baseline:
+            print("%-42s %12s %12.1f %8s" % (name, '-', usec, 'new'))
+            continue
+        change = (usec - baseline[name]) / baseline[name]
+        mark = ''
+        if change > tolerance:
+            regressions.append(name)
+            mark = ' !'
+        print("%-42s %12.1f %12.1f %+7.1f%%%s" % (
+            name, baseline[name], usec, change * 100, mark))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--filter', help="run benchmarks with this "
+                                         "substring in their names")
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help="approximate time of each measurement, s")
+    parser.add_argument('--save', metavar='FILE',
+                        help="save results to a baseline file")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare results with a baseline file")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed slowdown relative to the baseline "
+                             "(default: 0.25, i.e. 25%%)")
+    opts = parser.parse_args(argv)
+
+    results = run(opts.filter, opts.min_time)
+    if opts.save:
+        with open(opts.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if not opts.compare:
+        for name in sorted(results):
+            print("%-42s %12.1f us" % (name, results[name]))
+        return 0
+
+    with open(opts.compare) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(results, baseline, opts.tolerance)
+    if regressions:
+        print("\nSlower than baseline: %s" % ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare Prerender request body serializers: body size and CPU time
+per request. Install scrapy-prerender (e.g. ``pip install -e .``)
+and run::
+
+    python benchmarks/bench_serializers.py
+"""
+from __future__ import absolute_import, print_function
+import timeit
+
+from scrapy_prerender.serializers import JSON_SERIALIZERS, orjson
+
+
+def make_args():
+    """ Arguments of a typical 'execute' request with a session """
+    return {
+        'url': 'http://example.com/catalog/page?id=42&sort=price',
+        'wait': 0.5,
+        'timeout': 60,
+        'http_method': 'POST',
+        'body': 'q=' + 'x' * 4000,
+        'lua_source': 'function main(prerender)\n' + '  -- comment\n' * 200 + 'end',
+        'headers': {
+            'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) Scrapy',
+            'Accept': 'text/html,application/xhtml+xml;q=0.9,*/*;q=0.8',
+            'Accept-Language': 'en',
+            'Referer': 'http://example.com/catalog/',
+        },
+        'cookies': [
+            {'name': 'cookie%d' % i, 'value': 'v' * 40, 'path': '/',
+             'domain': '.example.com', 'secure': False, 'httpOnly': True,
+             'expires': '2055-07-24T19:20:30Z'}
+            for i in range(50)
+        ],
+    }
+
+
+def main(number=2000):
+    args = make_args()
+    names = ['pretty', 'json']
+    if orjson is not None:
+        names.append('orjson')
+
+    results = {}
+    for name in names:
+        serializer = JSON_SERIALIZERS[name]
+        body = serializer(args)
+        if not isinstance(body, bytes):
+            body = body.encode('utf8')
+        seconds = min(timeit.repeat(lambda: serializer(args),
+                                    number=number, repeat=3))
+        results[name] = len(body), seconds / number * 1e6
+
+    base_size, base_time = results['pretty']
+    print("%-8s %10s %10s %12s %10s" % (
+        'name', 'bytes', 'saved', 'us/request', 'speedup'))
+    for name in names:
+        size, usec = results[name]
+        print("%-8s %10d %9.1f%% %12.1f %9.1fx" % (
+            name, size, 100.0 * (base_size - size) / base_size,
+            usec, base_time / usec))
+
+
+if __name__ == '__main__':
+    main()
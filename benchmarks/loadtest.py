@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load test of the full scrapy-prerender middleware stack against a local
+mock Prerender server (tests/mockprerender.py). No browser is used,
+so the results show the client-side cost: pages per second, CPU time
+and peak memory of the crawling process.
+
+Run it from the repository root with scrapy-prerender installed::
+
+    python benchmarks/loadtest.py --pages 5000 --concurrency 64 \\
+        --latency 0.05 --latency-distribution lognormal --forget-rate 0.01
+
+The mock server runs in a separate process, so its CPU usage is not
+counted.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import scrapy
+from scrapy import signals
+from scrapy.crawler import CrawlerProcess
+
+from scrapy_prerender import PrerenderRequest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LUA_SOURCE = """
+function main(prerender)
+  prerender:init_cookies(prerender.args.cookies)
+  assert(prerender:go(prerender.args.url))
+  return {
+    url = prerender:url(),
+    html = prerender:html(),
+    cookies = prerender:get_cookies(),
+  }
+end
+"""
+
+
+class LoadTestSpider(scrapy.Spider):
+    name = 'loadtest'
+
+    def __init__(self, pages, endpoint, domains, *args, **kwargs):
+        super(LoadTestSpider, self).__init__(*args, **kwargs)
+        self.pages = pages
+        self.endpoint = endpoint
+        self.domains = domains
+
+    def start_requests(self):
+        for i in range(self.pages):
+            url = 'http://site%d.example.com/page/%d' % (i % self.domains, i)
+            if self.endpoint == 'execute':
+                yield PrerenderRequest(url, endpoint='execute',
+                                       args={'lua_source': LUA_SOURCE},
+                                       cache_args=['lua_source'])
+            else:
+                yield PrerenderRequest(url, endpoint=self.endpoint)
+
+    def parse(self, response):
+        yield {'url': response.url, 'size': len(response.body)}
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_mock_server(opts):
+    port = _free_port()
+    proc = subprocess.Popen([
+        sys.executable, '-u', '-m', 'tests.mockprerender',
+        '--port', str(port),
+        '--latency', str(opts.latency),
+        '--latency-distribution', opts.latency_distribution,
+        '--error-rate', str(opts.error_rate),
+        '--forget-rate', str(opts.forget_rate),
+        '--payload-size', str(opts.payload_size),
+        '--seed', '0',
+    ], cwd=ROOT, stdout=subprocess.PIPE)
+    proc.stdout.readline()
+    return proc, 'http://127.0.0.1:%d' % port
+
+
+def _peak_rss_mb():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if sys.platform == 'darwin':
+        maxrss /= 1024.0
+    return maxrss / 1024.0
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(opts, prerender_url):
+    settings = {
+        'PRERENDER_URL': prerender_url,
+        'DOWNLOADER_MIDDLEWARES': {
+            'scrapy_prerender.PrerenderCookiesMiddleware': 723,
+            'scrapy_prerender.PrerenderMiddleware': 725,
+            'scrapy.downloadermiddlewares.httpcompression.HttpCompressionMiddleware': 810,
+        },
+        'SPIDER_MIDDLEWARES': {
+            'scrapy_prerender.PrerenderDeduplicateArgsMiddleware': 100,
+        },
+        'DUPEFILTER_CLASS': 'scrapy_prerender.PrerenderAwareDupeFilter',
+        'CONCURRENT_REQUESTS': opts.concurrency,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': opts.concurrency,
+        'RETRY_TIMES': 5,
+        'LOG_LEVEL': opts.log_level,
+        'TELNETCONSOLE_ENABLED': False,
+    }
+    for item in opts.set:
+        name, value = item.split('=', 1)
+        settings[name] = value
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(LoadTestSpider)
+    items = []
+
+    def item_scraped(item):
+        items.append(1)
+    # signal handlers are weak references; keep the function alive
+    crawler.signals.connect(item_scraped, signal=signals.item_scraped)
+
+    cpu_start = _cpu_time()
+    start = time.time()
+    process.crawl(crawler, pages=opts.pages, endpoint=opts.endpoint,
+                  domains=opts.domains)
+    process.start()
+    elapsed = time.time() - start
+    cpu = _cpu_time() - cpu_start
+
+    stats = crawler.stats.get_stats()
+    return {
+        'pages': len(items),
+        'seconds': round(elapsed, 3),
+        'pages_per_sec': round(len(items) / elapsed, 1),
+        'cpu_seconds': round(cpu, 3),
+        'cpu_ms_per_page': round(1000 * cpu / max(len(items), 1), 3),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        'prerender_requests': stats.get('prerender/%s/request_count' % opts.endpoint, 0),
+        'retries_498': stats.get('prerender/498_retry_count', 0),
+        'request_bytes': stats.get('prerender/request_bytes', 0),
+        'response_bytes': stats.get('prerender/response_bytes', 0),
+        'latency_total_p50': stats.get('prerender/latency/total/p50'),
+        'latency_total_p95': stats.get('prerender/latency/total/p95'),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument('--domains', type=int, default=10,
+                        help="number of target website domains")
+    parser.add_argument('--endpoint', default='execute',
+                        choices=['execute', 'render.json', 'render.html'])
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help="mean render latency of the mock server, s")
+    parser.add_argument('--latency-distribution', default='exponential')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--forget-rate', type=float, default=0.0)
+    parser.add_argument('--payload-size', type=int, default=50 * 1024)
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help="set a Scrapy setting, e.g. "
+                             "--set PRERENDER_JSON_SERIALIZER=orjson")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--json', action='store_true',
+                        help="print results as JSON")
+    opts = parser.parse_args(argv)
+
+    proc, prerender_url = start_mock_server(opts)
+    try:
+        results = run(opts, prerender_url)
+    finally:
+        proc.kill()
+        proc.wait()
+
+    if opts.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for name in sorted(results):
+            print("%-20s %s" % (name, results[name]))
+
+
+if __name__ == '__main__':
+    main()
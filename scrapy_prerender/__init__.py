@@ -5,9 +5,23 @@ from .middleware import (
     PrerenderMiddleware,
     PrerenderCookiesMiddleware,
     PrerenderDeduplicateArgsMiddleware,
+    PrerenderPrefilterMiddleware,
+    PrerenderCachePrefetchMiddleware,
     SlotPolicy,
 )
-from .dupefilter import PrerenderAwareDupeFilter, prerender_request_fingerprint
-from .cache import PrerenderAwareFSCacheStorage
+from .backends import BalancePolicy, BackendPool
+from .extensions import PrerenderStatsExtension
+from .dupefilter import (
+    PrerenderAwareDupeFilter,
+    prerender_request_fingerprint,
+    prerender_request_fingerprints,
+    invalidate_prerender_fingerprint,
+)
+from .fingerprints import FingerprintPolicy
+from .cache import (
+    PrerenderAwareFSCacheStorage,
+    PrerenderAwareThreadedFSCacheStorage,
+    PrerenderAwareSqliteCacheStorage,
+)
 from .response import PrerenderResponse, PrerenderTextResponse, PrerenderJsonResponse
 from .request import PrerenderRequest, PrerenderFormRequest
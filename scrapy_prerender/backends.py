@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Distribution of requests between several Prerender servers.
+"""
+from __future__ import absolute_import
+import bisect
+import hashlib
+import itertools
+
+import six
+from scrapy.utils.misc import load_object
+
+from scrapy_prerender.utils import to_bytes
+
+
+class BalancePolicy(object):
+    ROUND_ROBIN = 'round_robin'
+    LEAST_OUTSTANDING = 'least_outstanding'
+    WEIGHTED = 'weighted'
+    CONSISTENT_HASH = 'consistent_hash'
+
+    _known = {ROUND_ROBIN, LEAST_OUTSTANDING, WEIGHTED, CONSISTENT_HASH}
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker of a single Prerender server.
+
+    It opens after ``failure_threshold`` consecutive failures; an open
+    server doesn't receive requests. After ``reset_timeout`` seconds the
+    breaker becomes half-open: a probe request is sent to the server,
+    and the breaker closes if the probe succeeds or opens again
+    if it fails.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def allows_requests(self):
+        return self.state == self.CLOSED
+
+    def should_probe(self, now):
+        return (self.state == self.OPEN and
+                now - self.opened_at >= self.reset_timeout)
+
+    def half_open(self):
+        self.state = self.HALF_OPEN
+
+    def record_success(self, probe=False):
+        """
+        Return True if the breaker is closed by this call.
+        Only a probe result can close an open or half-open breaker:
+        other requests could be sent before the breaker opened.
+        """
+        if self.state == self.CLOSED:
+            self.failures = 0
+            return False
+        if not probe:
+            return False
+        self.failures = 0
+        self.state = self.CLOSED
+        self.opened_at = None
+        return True
+
+    def record_failure(self, now):
+        """ Return True if the breaker is opened by this call """
+        self.failures += 1
+        if self.state == self.OPEN:
+            return False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = now
+            return True
+        return False
+
+
+class Backend(object):
+    """ A single Prerender server """
+    def __init__(self, url, weight=1, breaker=None):
+        self.url = url
+        self.weight = weight
+        self.breaker = breaker
+        self.outstanding = 0  # requests sent to the server, without responses
+
+    @property
+    def available(self):
+        return self.breaker is None or self.breaker.allows_requests
+
+    def __repr__(self):
+        return "<Backend %s weight=%s outstanding=%s>" % (
+            self.url, self.weight, self.outstanding)
+
+
+class RoundRobinBalancer(object):
+    """ Send requests to backends in turn """
+    def __init__(self, backends):
+        self._counter = itertools.count()
+
+    def choose(self, backends, key):
+        return backends[next(self._counter) % len(backends)]
+
+
+class LeastOutstandingBalancer(object):
+    """
+    Send requests to a backend with the least number of requests
+    in progress, relative to backend weight.
+    """
+    def __init__(self, backends):
+        self._counter = itertools.count()
+
+    def choose(self, backends, key):
+        # start from a different backend each time to break ties evenly
+        offset = next(self._counter) % len(backends)
+        candidates = backends[offset:] + backends[:offset]
+        return min(candidates, key=lambda b: float(b.outstanding) / b.weight)
+
+
+class WeightedBalancer(object):
+    """
+    Smooth weighted round-robin: each backend gets a share of requests
+    proportional to its weight, and requests to the same backend
+    are interleaved with requests to other backends.
+    """
+    def __init__(self, backends):
+        self._current = {b.url: 0 for b in backends}
+
+    def choose(self, backends, key):
+        total = 0
+        best = None
+        for backend in backends:
+            self._current[backend.url] += backend.weight
+            total += backend.weight
+            if best is None or self._current[backend.url] > self._current[best.url]:
+                best = backend
+        self._current[best.url] -= total
+        return best
+
+
+class ConsistentHashBalancer(object):
+    """
+    Send all requests for the same key (target domain) to the same backend,
+    so that browser caches of Prerender servers are reused. When a backend
+    is unavailable its keys are spread over other backends; keys of other
+    backends are not moved.
+    """
+    replicas = 100
+
+    def __init__(self, backends):
+        self._ring = []
+        for backend in backends:
+            for i in range(self.replicas * backend.weight):
+                point = self._hash('%s#%d' % (backend.url, i))
+                self._ring.append((point, backend.url))
+        self._ring.sort()
+        self._points = [point for point, url in self._ring]
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(to_bytes(value)).hexdigest()[:16], 16)
+
+    def choose(self, backends, key):
+        urls = {b.url: b for b in backends}
+        start = bisect.bisect(self._points, self._hash(key or ''))
+        for i in range(len(self._ring)):
+            point, url = self._ring[(start + i) % len(self._ring)]
+            if url in urls:
+                return urls[url]
+        return backends[0]
+
+
+BALANCERS = {
+    BalancePolicy.ROUND_ROBIN: RoundRobinBalancer,
+    BalancePolicy.LEAST_OUTSTANDING: LeastOutstandingBalancer,
+    BalancePolicy.WEIGHTED: WeightedBalancer,
+    BalancePolicy.CONSISTENT_HASH: ConsistentHashBalancer,
+}
+
+
+class BackendPool(object):
+    """
+    A set of Prerender servers. ``policy`` is a BalancePolicy value
+    or an import path of a balancer class.
+    """
+    def __init__(self, backends, policy=BalancePolicy.ROUND_ROBIN):
+        if not backends:
+            raise ValueError("At least one Prerender backend is required")
+        self.backends = backends
+        self._by_url = {b.url: b for b in backends}
+        balancer_cls = BALANCERS.get(policy) or load_object(policy)
+        self.balancer = balancer_cls(backends)
+
+    @classmethod
+    def from_urls(cls, urls, policy=BalancePolicy.ROUND_ROBIN):
+        """
+        Create a pool from a list of URLs, a comma-separated string of URLs
+        or a {url: weight} dict. The order of URLs is kept: the first URL
+        is used in request fingerprints.
+
+        >>> pool = BackendPool.from_urls({'http://b:8050': 2, 'http://a:8050': 1})
+        >>> [(b.url, b.weight) for b in pool.backends]
+        [('http://b:8050', 2), ('http://a:8050', 1)]
+        >>> pool = BackendPool.from_urls('http://a:8050, http://b:8050')
+        >>> [b.url for b in pool.backends]
+        ['http://a:8050', 'http://b:8050']
+        """
+        if isinstance(urls, six.string_types):
+            urls = urls.split(',')
+        if isinstance(urls, dict):
+            backends = [Backend(url.strip(), int(weight))
+                        for url, weight in urls.items()]
+        else:
+            backends = [Backend(url.strip()) for url in urls if url.strip()]
+        return cls(backends, policy)
+
+    def get(self, url):
+        return self._by_url.get(url)
+
+    def enable_circuit_breakers(self, failure_threshold, reset_timeout):
+        for backend in self.backends:
+            backend.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+    def choose(self, key=None):
+        """
+        Return a Backend for a request; ``key`` is its target domain.
+        Backends with open circuit breakers are skipped unless all
+        backends are unavailable.
+        """
+        if len(self.backends) == 1:
+            return self.backends[0]
+        backends = [b for b in self.backends if b.available] or self.backends
+        return self.balancer.choose(backends, key)
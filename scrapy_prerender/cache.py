@@ -6,7 +6,20 @@ Scrapy needs a custom caching backed.
 See https://github.com/scrapy/scrapy/issues/900 for more info.
 """
 from __future__ import absolute_import
+import base64
+import binascii
+import errno
+import hashlib
+import json
+import logging
 import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import zlib
+from collections import OrderedDict, deque
+from time import time
 
 try:
     from scrapy.extensions.httpcache import FilesystemCacheStorage
@@ -14,10 +27,1053 @@ except ImportError:
     # scrapy < 1.0
     from scrapy.contrib.httpcache import FilesystemCacheStorage
 
-from .dupefilter import prerender_request_fingerprint
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.log import failure_to_exc_info
+from scrapy.utils.project import data_path
+import six
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import failure, threadable
+from twisted.python.threadpool import ThreadPool
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .dupefilter import prerender_request_fingerprint, get_fingerprint_version
+from .fingerprints import FingerprintPolicy
+from .response import encode_prerender_payload
+from .seen import DigestTable
+from .stats import LatencyStats
+from .utils import compress_body, replace_file
+
+
+logger = logging.getLogger(__name__)
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# base64-encoded keys of Prerender JSON results (screenshots) which are
+# stored decoded, in separate files, by PRERENDER_HTTPCACHE_DECODED layout
+DECODED_BINARY_KEYS = ('png', 'jpeg')
+
+# cache entry files stored as content-addressed blobs
+# by PRERENDER_HTTPCACHE_DEDUPLICATE option
+BLOB_FILES = frozenset(['response_body', 'prerender_body'] + [
+    'prerender_' + name for name in DECODED_BINARY_KEYS])
+
+
+def _zstd_compress(data, level):
+    if zstandard is None:
+        raise ValueError("zstd compression requires zstandard package")
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+# name => (compress(data, level) function, default level)
+CACHE_COMPRESSORS = {
+    'gzip': (lambda data, level: compress_body(data, 'gzip', level), 6),
+    'zstd': (_zstd_compress, 3),
+}
+
+
+def decompress_cached(data, compression):
+    """
+    Decompress data compressed with ``compression`` method
+    ('gzip', 'zstd' or None for uncompressed data).
+
+    >>> decompress_cached(compress_body(b'foo', 'gzip'), 'gzip')
+    b'foo'
+    >>> decompress_cached(b'\\x1f\\x8b', None)
+    b'\\x1f\\x8b'
+    """
+    if compression is None:
+        return data
+    if compression == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd-compressed cache entry requires "
+                             "zstandard package")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    raise ValueError("Unknown cache entry compression: %r" % compression)
+
+
+def get_cache_compressor(settings, default=None):
+    """
+    Return (name, compress(data) function) for
+    PRERENDER_HTTPCACHE_COMPRESSION setting; (None, None) if compression
+    is disabled.
+    """
+    name = settings.get('PRERENDER_HTTPCACHE_COMPRESSION') or default
+    if name is None:
+        return None, None
+    if name not in CACHE_COMPRESSORS:
+        raise ValueError("Unknown PRERENDER_HTTPCACHE_COMPRESSION: %r" % name)
+    if name == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression requires zstandard package")
+    compress, level = CACHE_COMPRESSORS[name]
+    level = settings.getint('PRERENDER_HTTPCACHE_COMPRESSION_LEVEL', level)
+    return name, lambda data: compress(data, level)
+
+
+class CacheAccessIndex(object):
+    """
+    Sizes of cache entries, in least recently used first order, kept in
+    a SQLite database at ``path`` (in memory by default). Changes are
+    written incrementally and saved by ``commit``.
+
+    >>> index = CacheAccessIndex()
+    >>> index.add('a', 10); index.add('b', 20); index.touch('a')
+    >>> index.pop_lru(), index.total
+    (('b', 20), 10)
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            size INTEGER,
+            atime INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+    """
+
+    def __init__(self, path=':memory:'):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.schema)
+        self.total, self._clock, self._len = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0), COALESCE(MAX(atime), 0), '
+            'COUNT(*) FROM entries').fetchone()
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, key):
+        return self._size(key) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [key for key, in self.db.execute(
+            'SELECT key FROM entries ORDER BY atime')]
+
+    def items(self):
+        return self.db.execute(
+            'SELECT key, size FROM entries ORDER BY atime').fetchall()
+
+    def _size(self, key):
+        row = self.db.execute('SELECT size FROM entries WHERE key = ?',
+                              (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def add(self, key, size):
+        """ Add or update an entry; it becomes the most recently used """
+        self.remove(key)
+        self.db.execute('INSERT INTO entries VALUES (?, ?, ?)',
+                        (key, size, self._tick()))
+        self.total += size
+        self._len += 1
+
+    def touch(self, key):
+        """ Mark an entry as the most recently used """
+        self.db.execute('UPDATE entries SET atime = ? WHERE key = ?',
+                        (self._tick(), key))
+
+    def remove(self, key):
+        size = self._size(key)
+        if size is not None:
+            self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self.total -= size
+            self._len -= 1
+        return size
+
+    def pop_lru(self):
+        """ Remove the least recently used entry; return (key, size) """
+        row = self.db.execute('SELECT key, size FROM entries '
+                              'ORDER BY atime LIMIT 1').fetchone()
+        if row is None:
+            raise KeyError('index is empty')
+        self.db.execute('DELETE FROM entries WHERE key = ?', (row[0],))
+        self.total -= row[1]
+        self._len -= 1
+        return tuple(row)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class _PrerenderCacheStorageMixin(object):
+    """ Fingerprints and stats shared by Prerender-aware cache storages """
+    def _init_fingerprints(self, settings):
+        self.fingerprint_version = get_fingerprint_version(settings)
+        self.fingerprint_policy = FingerprintPolicy.from_settings(settings)
+        self.stats = None
+
+    def _open_stats(self, spider):
+        crawler = getattr(spider, 'crawler', None)
+        self.stats = getattr(crawler, 'stats', None)
+
+    def _count_lookup(self, spider, request, response):
+        if self.stats is not None and 'prerender' in request.meta:
+            self.stats.inc_value('prerender/httpcache/%s' % (
+                'miss' if response is None else 'hit'), spider=spider)
+
+    def _fingerprint(self, request):
+        return prerender_request_fingerprint(
+            request,
+            version=self.fingerprint_version,
+            policy=self.fingerprint_policy,
+        )
+
+
+def _processed_by_json_response(request):
+    """
+    Return True if a response to the request is converted to
+    PrerenderJsonResponse with response magic enabled.
+    """
+    options = request.meta.get('prerender')
+    return bool(options) and (
+        not options.get('dont_process_response', False) and
+        options.get('magic_response', True)
+    )
+
+
+def decode_prerender_payload(request, response):
+    """
+    Split a raw Prerender JSON response into (body key, body, binary values,
+    other data) parts: body is a base64-decoded 'body' value or
+    an UTF-8 encoded 'html' value, binary values are decoded screenshots.
+    None is returned if the response is not a JSON response with 'html'
+    or 'body' key which would be processed by PrerenderJsonResponse.
+    """
+    if not _processed_by_json_response(request):
+        return None
+    content_type = response.headers.get(b'Content-Type') or b''
+    if not content_type.startswith((b'application/json',
+                                    b'application/x-json')):
+        return None
+    try:
+        data = json.loads(response.body.decode('utf8'))
+        if not isinstance(data, dict):
+            return None
+        if isinstance(data.get('body'), six.string_types):
+            key, body = 'body', base64.b64decode(data.pop('body'))
+        elif isinstance(data.get('html'), six.string_types):
+            key, body = 'html', data.pop('html').encode('utf8')
+        else:
+            return None
+        binary = {
+            name: base64.b64decode(data.pop(name))
+            for name in DECODED_BINARY_KEYS
+            if isinstance(data.get(name), six.string_types)
+        }
+    except ValueError:
+        return None
+    return key, body, binary, data
+
+
+class PrerenderAwareFSCacheStorage(_PrerenderCacheStorageMixin,
+                                   FilesystemCacheStorage):
+    """
+    Filesystem HTTP cache storage keyed by ``prerender_request_fingerprint``.
+
+    With ``PRERENDER_HTTPCACHE_DECODED`` option Prerender JSON responses
+    are stored already parsed: 'html' or base64-decoded 'body' value,
+    decoded screenshots and the rest of JSON data are stored in separate
+    files, so PrerenderMiddleware creates PrerenderJsonResponse from cache
+    without parsing the whole JSON response and decoding base64 data again.
+
+    With ``PRERENDER_HTTPCACHE_DEDUPLICATE`` option response bodies are
+    stored once per content in ``<HTTPCACHE_DIR>/.blobs`` directory, keyed
+    by SHA1 hash of the body; body files of cache entries are hard links
+    to these blobs, so the number of links is a reference count.
+    Blobs which are no longer used are removed by ``collect_garbage``,
+    and blobs of entries evicted by compaction are removed with them.
+
+    With ``PRERENDER_HTTPCACHE_MAX_BYTES`` option the cache size is limited:
+    sizes of entries are tracked in LRU order (``CacheAccessIndex``, stored
+    in the spider cache directory and reconciled with cache entries on
+    disk when the spider is opened), and least recently used entries are
+    removed in small batches, periodically and outside of
+    ``store_response``, until the cache is below ``compaction_target``
+    fraction of the limit.
+
+    With ``PRERENDER_HTTPCACHE_KEY_INDEX`` option fingerprints of cached
+    entries are kept in memory (``DigestTable``), so lookups of responses
+    which are not cached don't access the filesystem.
+    """
+    blobs_dirname = '.blobs'
+    index_filename = '.access_index.sqlite'
+    compaction_target = 0.9
+
+    def __init__(self, settings):
+        super(PrerenderAwareFSCacheStorage, self).__init__(settings)
+        self._init_fingerprints(settings)
+        self.compression, self._compress = get_cache_compressor(
+            settings, 'gzip' if self.use_gzip else None)
+        self.decoded = settings.getbool('PRERENDER_HTTPCACHE_DECODED')
+        self.deduplicate = settings.getbool('PRERENDER_HTTPCACHE_DEDUPLICATE')
+        self.collect_garbage_on_close = settings.getbool(
+            'PRERENDER_HTTPCACHE_DEDUPLICATE_GC', True)
+        self.blobs_dir = os.path.join(self.cachedir, self.blobs_dirname)
+        self.max_bytes = settings.getint('PRERENDER_HTTPCACHE_MAX_BYTES', 0)
+        self.compaction_interval = settings.getfloat(
+            'PRERENDER_HTTPCACHE_COMPACTION_INTERVAL', 10.0)
+        self.compaction_batch_size = settings.getint(
+            'PRERENDER_HTTPCACHE_COMPACTION_BATCH_SIZE', 100)
+        self.use_key_index = settings.getbool('PRERENDER_HTTPCACHE_KEY_INDEX')
+        self.keys = None
+        self.index = None
+        self.blob_bytes = 0
+        self._compaction_loop = None
+        self._compaction_call = None
+
+    def open_spider(self, spider):
+        super(PrerenderAwareFSCacheStorage, self).open_spider(spider)
+        self._open_stats(spider)
+        keys = None
+        if self.max_bytes > 0 or self.use_key_index:
+            # indexes are built from cache directory listings, so they have
+            # all entries even if the access index is stale
+            keys = [key for key, _ in self._entry_dirs(spider)]
+        if self.max_bytes > 0:
+            self._open_index(spider, keys)
+            self._compaction_loop = task.LoopingCall(self._compaction_tick,
+                                                     spider)
+            self._compaction_loop.start(self.compaction_interval, now=True)
+        if self.use_key_index:
+            self._open_key_index(spider, keys)
+
+    def close_spider(self, spider):
+        super(PrerenderAwareFSCacheStorage, self).close_spider(spider)
+        if self._compaction_loop is not None:
+            if self._compaction_loop.running:
+                self._compaction_loop.stop()
+            self._compaction_loop = None
+            if self._compaction_call is not None and \
+                    self._compaction_call.active():
+                self._compaction_call.cancel()
+            self._compaction_call = None
+            self.index.close()
+        if self.deduplicate and self.collect_garbage_on_close:
+            count, size = self.collect_garbage()
+            if self.stats is not None:
+                self.stats.inc_value('prerender/httpcache/blobs/collected',
+                                     count, spider=spider)
+                self.stats.inc_value('prerender/httpcache/blobs/collected_bytes',
+                                     size, spider=spider)
+
+    def retrieve_response(self, spider, request):
+        if self.keys is not None and not self._key_indexed(request):
+            self._count_lookup(spider, request, None)
+            if self.stats is not None:
+                self.stats.inc_value('prerender/httpcache/key_index/skipped',
+                                     spider=spider)
+            return None
+        response = self._load_entry(spider, request)
+        self._entry_retrieved(spider, request, response)
+        return response
+
+    def _load_entry(self, spider, request):
+        """ Read a cached response from disk; None is returned on misses """
+        metadata = self._read_meta(spider, request)
+        if metadata is None:
+            return None
+        return self._read_response(self._get_request_path(spider, request),
+                                   request, metadata)
+
+    def _entry_retrieved(self, spider, request, response):
+        if response is not None and self.index is not None:
+            self.index.touch(self._fingerprint(request))
+        self._count_lookup(spider, request, response)
+
+    def _read_meta(self, spider, request):
+        rpath = self._get_request_path(spider, request)
+        metapath = os.path.join(rpath, 'pickled_meta')
+        if not os.path.exists(metapath):
+            return  # not found
+        mtime = os.stat(metapath).st_mtime
+        if 0 < self.expiration_secs < time() - mtime:
+            return  # expired
+        return self._load_metadata(metapath)
+
+    def _load_metadata(self, metapath):
+        with open(metapath, 'rb') as f:
+            data = f.read()
+        # pickled_meta is always written uncompressed, with the compression
+        # of other files; entries written by FilesystemCacheStorage have
+        # all files gzip-compressed if HTTPCACHE_GZIP is enabled.
+        compression = None
+        if data.startswith(GZIP_MAGIC):
+            data = decompress_cached(data, 'gzip')
+            compression = 'gzip'
+        metadata = pickle.loads(data)
+        metadata.setdefault('prerender_compression', compression)
+        return metadata
+
+    def _read(self, rpath, name, metadata):
+        with open(os.path.join(rpath, name), 'rb') as f:
+            return decompress_cached(f.read(),
+                                     metadata['prerender_compression'])
+
+    def _read_response(self, rpath, request, metadata):
+        url = metadata.get('response_url')
+        status = metadata['status']
+        headers = Headers(headers_raw_to_dict(
+            self._read(rpath, 'response_headers', metadata)))
+        if metadata.get('prerender_layout') != 'decoded':
+            body = self._read(rpath, 'response_body', metadata)
+            respcls = responsetypes.from_args(headers=headers, url=url)
+            return respcls(url=url, headers=headers, status=status, body=body)
+
+        payload = (
+            metadata['prerender_body_key'],
+            self._read(rpath, 'prerender_body', metadata),
+            {name: self._read(rpath, 'prerender_' + name, metadata)
+             for name in metadata.get('prerender_binary_keys', ())},
+            json.loads(self._read(rpath, 'prerender_data', metadata
+                                  ).decode('utf8')),
+        )
+
+        respcls = responsetypes.from_args(headers=headers, url=url)
+        if _processed_by_json_response(request):
+            # Other downloader middlewares see the raw Prerender response
+            # (without a body); PrerenderMiddleware creates
+            # PrerenderJsonResponse from the decoded parts, and
+            # base64 values of response.data are encoded only if it is used.
+            request.meta['_prerender_cached_data'] = payload
+            return respcls(url=url, headers=headers, status=status, body=b'')
+        # e.g. dont_process_response is enabled now
+        return respcls(url=url, headers=headers, status=status,
+                       body=json.dumps(encode_prerender_payload(*payload)
+                                       ).encode('utf8'))
+
+    def store_response(self, spider, request, response):
+        blob_bytes = self._store_entry(spider, request, response)
+        self._entry_stored(spider, request, blob_bytes)
+
+    def _entry_stored(self, spider, request, blob_bytes=0):
+        """
+        Update indexes after a cache entry is written; ``blob_bytes`` is
+        the size of blobs created for the entry.
+        """
+        if self.keys is not None:
+            self.keys.add(self._key_digest(self._fingerprint(request)))
+        if self.index is not None:
+            rpath = self._get_request_path(spider, request)
+            self.index.add(self._fingerprint(request), self._entry_size(rpath))
+            self.blob_bytes += blob_bytes
+            if self._cache_size() > self.max_bytes:
+                self._schedule_compaction(spider)
+
+    def _store_entry(self, spider, request, response):
+        """
+        Write a cache entry; return the size of blobs created for it.
+        """
+        rpath = self._get_request_path(spider, request)
+        if not os.path.exists(rpath):
+            os.makedirs(rpath)
+        metadata = {
+            'url': request.url,
+            'method': request.method,
+            'status': response.status,
+            'response_url': response.url,
+            'timestamp': time(),
+            'prerender_compression': self.compression,
+        }
+        parts = None
+        if self.decoded:
+            parts = decode_prerender_payload(request, response)
+        if parts is None:
+            files = [('response_body', response.body)]
+        else:
+            key, body, binary, data = parts
+            metadata.update({
+                'prerender_layout': 'decoded',
+                'prerender_body_key': key,
+                'prerender_binary_keys': sorted(binary),
+            })
+            files = [('prerender_data', json.dumps(data).encode('utf8')),
+                     ('prerender_body', body)]
+            files.extend(('prerender_' + name, value)
+                         for name, value in binary.items())
+        files.extend([
+            ('response_headers', headers_dict_to_raw(response.headers)),
+            ('request_headers', headers_dict_to_raw(request.headers)),
+            ('request_body', request.body),
+        ])
+        blobs = []
+        blob_bytes = 0
+        for name, value in files:
+            path = os.path.join(rpath, name)
+            if self.deduplicate and name in BLOB_FILES:
+                blob, size = self._write_blob(path, value)
+                if blob is not None:
+                    blobs.append(os.path.relpath(blob, self.blobs_dir))
+                blob_bytes += size
+            else:
+                with open(path, 'wb') as f:
+                    f.write(self._compressed(value))
+        if blobs:
+            # blobs are released when the entry is evicted
+            metadata['prerender_blobs'] = blobs
+        # metadata is small and is never compressed:
+        # it tells how the other files are compressed
+        with open(os.path.join(rpath, 'meta'), 'wb') as f:
+            f.write(repr(metadata).encode('utf8'))
+        with open(os.path.join(rpath, 'pickled_meta'), 'wb') as f:
+            pickle.dump(metadata, f, protocol=2)
+        return blob_bytes
+
+    def _key_digest(self, key):
+        return binascii.unhexlify(key)
+
+    def _key_indexed(self, request):
+        return self._key_digest(self._fingerprint(request)) in self.keys
+
+    def _open_key_index(self, spider, keys):
+        self.keys = DigestTable(capacity=len(keys) or 1024)
+        for key in keys:
+            try:
+                self.keys.add(self._key_digest(key))
+            except (TypeError, ValueError):
+                continue  # not a cache entry
+        if self.stats is not None:
+            self.stats.set_value('prerender/httpcache/key_index/size',
+                                 len(self.keys), spider=spider)
+            self.stats.set_value('prerender/httpcache/key_index/memory_bytes',
+                                 self.keys.memory_usage(), spider=spider)
+
+    def _entry_dirs(self, spider):
+        """ Return (key, path) pairs for cache entry directories """
+        spider_dir = os.path.join(self.cachedir, spider.name)
+        if not os.path.isdir(spider_dir):
+            return
+        for prefix in os.listdir(spider_dir):
+            prefix_dir = os.path.join(spider_dir, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                yield key, os.path.join(prefix_dir, key)
+
+    def _entry_size(self, rpath):
+        """
+        Size of entry files; links to blobs are not counted, blobs are
+        accounted in ``blob_bytes`` once.
+        """
+        size = 0
+        for name in os.listdir(rpath):
+            stat = os.stat(os.path.join(rpath, name))
+            if name not in BLOB_FILES or stat.st_nlink <= 1:
+                size += stat.st_size
+        return size
+
+    def _cache_size(self):
+        return self.index.total + self.blob_bytes
+
+    def _index_path(self, spider):
+        return os.path.join(self.cachedir, spider.name, self.index_filename)
+
+    def _open_index(self, spider, keys):
+        path = self._index_path(spider)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.index = CacheAccessIndex(path)
+        self._reconcile_index(spider, keys)
+        self.blob_bytes = sum(os.path.getsize(path)
+                              for path in self._blob_paths())
+        self._set_size_stats(spider)
+
+    def _reconcile_index(self, spider, keys):
+        """
+        Make the access index match cache entry directories (``keys``)
+        of a spider: the index misses entries stored after the last commit
+        before a crash, or stored without PRERENDER_HTTPCACHE_MAX_BYTES
+        option. Such entries are added as the most recently used ones,
+        in the order they were stored; entries removed from disk are
+        removed from the index.
+        """
+        indexed = set(self.index)
+        spider_dir = os.path.join(self.cachedir, spider.name)
+        entries = []
+        for key in keys:
+            if key in indexed:
+                indexed.discard(key)
+                continue
+            rpath = os.path.join(spider_dir, key[0:2], key)
+            try:
+                mtime = os.path.getmtime(os.path.join(rpath, 'pickled_meta'))
+                entries.append((mtime, key, self._entry_size(rpath)))
+            except OSError:
+                continue  # not a cache entry
+        for key in indexed:
+            self.index.remove(key)
+        for _, key, size in sorted(entries):
+            self.index.add(key, size)
+        self.index.commit()
+
+    def _set_size_stats(self, spider):
+        if self.stats is not None:
+            self.stats.set_value('prerender/httpcache/bytes',
+                                 self._cache_size(), spider=spider)
+
+    def _compaction_tick(self, spider):
+        if self._cache_size() > self.max_bytes:
+            self._schedule_compaction(spider)
+        # so that a crash loses only the recent changes
+        self.index.commit()
+
+    def _schedule_compaction(self, spider):
+        if self._compaction_call is None:
+            self._compaction_call = reactor.callLater(0, self.compact, spider)
+
+    def compact(self, spider):
+        """
+        Remove a batch of least recently used cache entries if the cache
+        is larger than the limit; another batch is scheduled if needed.
+        """
+        self._compaction_call = None
+        target = self.max_bytes * self.compaction_target
+        spider_dir = os.path.join(self.cachedir, spider.name)
+        count = size = 0
+        while count < self.compaction_batch_size and self.index and \
+                self._cache_size() > target:
+            key, entry_size = self.index.pop_lru()
+            if self._writing(key):
+                # it is stored again; the new entry is added to the index
+                # when it is written
+                continue
+            rpath = os.path.join(spider_dir, key[0:2], key)
+            blobs = self._entry_blobs(rpath)
+            shutil.rmtree(rpath, ignore_errors=True)
+            count += 1
+            size += entry_size + self._release_blobs(spider, blobs)
+        if count:
+            logger.debug("Evicted %(count)d entries (%(size)d bytes) "
+                         "from HTTP cache",
+                         {'count': count, 'size': size},
+                         extra={'spider': spider})
+            if self.stats is not None:
+                self.stats.inc_value('prerender/httpcache/evicted', count,
+                                     spider=spider)
+                self.stats.inc_value('prerender/httpcache/evicted_bytes', size,
+                                     spider=spider)
+        self._set_size_stats(spider)
+        if self._cache_size() > target:
+            self._schedule_compaction(spider)
+
+    def _entry_blobs(self, rpath):
+        """ Return names of blobs linked by a cache entry """
+        try:
+            metadata = self._load_metadata(os.path.join(rpath, 'pickled_meta'))
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return ()  # e.g. a partially written entry
+        return metadata.get('prerender_blobs', ())
+
+    def _release_blobs(self, spider, blobs):
+        """
+        Remove blobs which are not linked by other cache entries;
+        return the number of bytes released.
+        """
+        count = size = 0
+        for name in blobs:
+            path = os.path.join(self.blobs_dir, name)
+            try:
+                stat = os.stat(path)
+                if stat.st_nlink > 1:
+                    continue
+                os.remove(path)
+            except OSError:
+                continue  # removed already
+            count += 1
+            size += stat.st_size
+        self.blob_bytes -= size
+        if count and self.stats is not None:
+            self.stats.inc_value('prerender/httpcache/blobs/collected', count,
+                                 spider=spider)
+            self.stats.inc_value('prerender/httpcache/blobs/collected_bytes',
+                                 size, spider=spider)
+        return size
+
+    def _compressed(self, data):
+        return data if self._compress is None else self._compress(data)
+
+    def _blob_path(self, data):
+        key = hashlib.sha1(data).hexdigest()
+        if self.compression is not None:
+            key += '.' + self.compression
+        return os.path.join(self.blobs_dir, key[0:2], key)
+
+    def _write_blob(self, path, data):
+        """
+        Make ``path`` a link to a blob with ``data``. Return (blob path,
+        size of the blob if it is created) tuple; blob path is None if
+        a copy of the blob is stored instead.
+        """
+        blob = self._blob_path(data)
+        created = 0
+        if os.path.exists(blob):
+            self._inc_stats('prerender/httpcache/blobs/deduplicated')
+            self._inc_stats('prerender/httpcache/blobs/deduplicated_bytes',
+                            len(data))
+        else:
+            compressed = self._compressed(data)
+            self._write_atomic(blob, compressed)
+            created = len(compressed)
+        tmp_path = path + '.tmp'
+        try:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            os.link(blob, tmp_path)
+        except OSError as e:
+            # e.g. too many links, links are not supported, or the blob
+            # is just removed by garbage collection: store a copy
+            logger.debug("Can't link %(blob)s: %(error)s",
+                         {'blob': blob, 'error': e})
+            self._write_atomic(path, self._compressed(data))
+            return None, created
+        replace_file(tmp_path, path)
+        return blob, created
+
+    def _write_atomic(self, path, data):
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        replace_file(tmp_path, path)
+
+    def _writing(self, key):
+        """ Return True if the cache entry is being written """
+        return False
+
+    def _inc_stats(self, key, count=1):
+        if self.stats is None:
+            return
+        if threadable.isInIOThread():
+            self.stats.inc_value(key, count)
+        else:
+            # cache entries can be written in other threads
+            reactor.callFromThread(self.stats.inc_value, key, count)
+
+    def collect_garbage(self):
+        """
+        Remove blobs which are not used by cache entries anymore.
+        Return (number of removed blobs, their size in bytes) tuple.
+        """
+        count = size = 0
+        for path in self._blob_paths():
+            stat = os.stat(path)
+            if stat.st_nlink <= 1:
+                os.remove(path)
+                count += 1
+                size += stat.st_size
+        self.blob_bytes -= size
+        return count, size
+
+    def _blob_paths(self):
+        if not os.path.isdir(self.blobs_dir):
+            return
+        for dirname in os.listdir(self.blobs_dir):
+            dirpath = os.path.join(self.blobs_dir, dirname)
+            for name in os.listdir(dirpath):
+                if not name.endswith('.tmp'):  # being written
+                    yield os.path.join(dirpath, name)
 
-class PrerenderAwareFSCacheStorage(FilesystemCacheStorage):
     def _get_request_path(self, spider, request):
-        key = prerender_request_fingerprint(request)
+        key = self._fingerprint(request)
         return os.path.join(self.cachedir, spider.name, key[0:2], key)
+
+
+class PrerenderAwareThreadedFSCacheStorage(PrerenderAwareFSCacheStorage):
+    """
+    PrerenderAwareFSCacheStorage which writes cache entries in a pool of
+    ``PRERENDER_HTTPCACHE_IO_THREADS`` threads instead of the reactor thread.
+    No more than ``PRERENDER_HTTPCACHE_WRITE_QUEUE_SIZE`` responses wait
+    to be written; when the queue is full, responses are written in the
+    reactor thread. Responses which are not written yet are returned
+    from memory.
+
+    Cached responses can be read in the thread pool in advance using
+    ``prefetch`` method; PrerenderCachePrefetchMiddleware calls it before
+    HttpCacheMiddleware looks the response up.
+    """
+    def __init__(self, settings):
+        super(PrerenderAwareThreadedFSCacheStorage, self).__init__(settings)
+        self.io_threads = settings.getint('PRERENDER_HTTPCACHE_IO_THREADS', 4)
+        self.write_queue_size = settings.getint(
+            'PRERENDER_HTTPCACHE_WRITE_QUEUE_SIZE', 100)
+        self.prefetch_size = settings.getint(
+            'PRERENDER_HTTPCACHE_PREFETCH_SIZE', 100)
+        self.threadpool = None
+        self.write_latency = LatencyStats()
+        # key => (spider, request, response, time it is queued)
+        self._pending = {}
+        self._writing_keys = set()
+        # written entries, processed in the reactor thread
+        self._completed = deque()
+        # key => response or None (not cached)
+        self._prefetched = OrderedDict()
+        # key => token of a prefetch which is in progress; a token is
+        # dropped when the response is stored, as the prefetch can be stale
+        self._prefetching = {}
+
+    def open_spider(self, spider):
+        super(PrerenderAwareThreadedFSCacheStorage, self).open_spider(spider)
+        self.threadpool = ThreadPool(minthreads=0, maxthreads=self.io_threads,
+                                     name='prerender-httpcache')
+        self.threadpool.start()
+
+    def close_spider(self, spider):
+        threadpool, self.threadpool = self.threadpool, None
+        threadpool.stop()  # queued writes are finished
+        self._process_completed()
+        if self.stats is not None:
+            self.write_latency.to_stats(self.stats, spider=spider)
+        super(PrerenderAwareThreadedFSCacheStorage, self).close_spider(spider)
+
+    def retrieve_response(self, spider, request):
+        key = self._fingerprint(request)
+        if key in self._pending:
+            response = self._pending[key][2]
+            response = response.replace(flags=list(response.flags))
+        elif key in self._prefetched:
+            response = self._prefetched.pop(key)
+            self._inc_stats('prerender/httpcache/prefetch/used')
+        else:
+            return super(PrerenderAwareThreadedFSCacheStorage,
+                         self).retrieve_response(spider, request)
+        self._entry_retrieved(spider, request, response)
+        return response
+
+    def prefetch(self, spider, request):
+        """
+        Read a cached response in the thread pool; return a Deferred
+        which fires with None when the response is read.
+        """
+        key = self._fingerprint(request)
+        if self.threadpool is None or key in self._pending or \
+                key in self._prefetched or key in self._prefetching or \
+                (self.keys is not None and not self._key_indexed(request)):
+            return defer.succeed(None)
+        token = self._prefetching[key] = object()
+        d = threads.deferToThreadPool(reactor, self.threadpool,
+                                      self._load_entry, spider, request)
+        d.addCallback(self._prefetched_entry, key, token)
+        d.addErrback(self._prefetch_failed, key, token, request, spider)
+        return d
+
+    def _prefetch_done(self, key, token):
+        """ Return True if the prefetch is still valid """
+        if self._prefetching.get(key) is not token:
+            return False  # the response was stored while it was read
+        del self._prefetching[key]
+        return True
+
+    def _prefetched_entry(self, response, key, token):
+        if self._prefetch_done(key, token):
+            self._prefetched[key] = response
+            while len(self._prefetched) > self.prefetch_size:
+                self._prefetched.popitem(last=False)
+            self._inc_stats('prerender/httpcache/prefetch/count')
+
+    def _prefetch_failed(self, failure, key, token, request, spider):
+        self._prefetch_done(key, token)
+        # it is read again by retrieve_response
+        logger.warning("Error prefetching %(request)s from HTTP cache",
+                       {'request': request},
+                       exc_info=failure_to_exc_info(failure),
+                       extra={'spider': spider})
+
+    def store_response(self, spider, request, response):
+        key = self._fingerprint(request)
+        self._prefetched.pop(key, None)
+        self._prefetching.pop(key, None)
+        if key not in self._pending and \
+                len(self._pending) >= self.write_queue_size:
+            self._inc_stats('prerender/httpcache/write_queue/full')
+            super(PrerenderAwareThreadedFSCacheStorage, self).store_response(
+                spider, request, response)
+            return
+        self._pending[key] = (spider, request, response, time())
+        # a response which is being written is written again when
+        # it is done, so files of an entry are not written concurrently
+        if key not in self._writing_keys:
+            self._start_write(key)
+        self._update_queue_stats()
+
+    def _start_write(self, key):
+        self._writing_keys.add(key)
+        args = (key,) + self._pending[key]
+        if self.threadpool is not None:
+            self.threadpool.callInThread(self._write, *args)
+        else:  # the spider is closed
+            self._write(*args)
+            self._process_completed()
+
+    def _write(self, key, spider, request, response, queued_at):
+        try:
+            blob_bytes = self._store_entry(spider, request, response)
+            error = None
+        except Exception:
+            blob_bytes, error = 0, failure.Failure()
+        self._completed.append((key, spider, request, response, queued_at,
+                                blob_bytes, error))
+        if not threadable.isInIOThread():
+            reactor.callFromThread(self._process_completed)
+
+    def _process_completed(self):
+        while self._completed:
+            key, spider, request, response, queued_at, blob_bytes, error = \
+                self._completed.popleft()
+            self._writing_keys.discard(key)
+            if error is None:
+                self._entry_stored(spider, request, blob_bytes)
+                self.write_latency.add('prerender/httpcache/write_latency',
+                                       time() - queued_at)
+            else:
+                logger.error("Error writing %(request)s to HTTP cache",
+                             {'request': request},
+                             exc_info=failure_to_exc_info(error),
+                             extra={'spider': spider})
+                self._inc_stats('prerender/httpcache/write_errors')
+            if self._pending[key][2] is response:
+                del self._pending[key]
+            else:  # stored again while it was written
+                self._start_write(key)
+        self._update_queue_stats()
+
+    def _update_queue_stats(self):
+        if self.stats is not None:
+            depth = len(self._pending)
+            self.stats.set_value('prerender/httpcache/write_queue/depth', depth)
+            self.stats.max_value('prerender/httpcache/write_queue/max_depth',
+                                 depth)
+
+    def _writing(self, key):
+        return key in self._writing_keys
+
+
+class PrerenderAwareSqliteCacheStorage(_PrerenderCacheStorageMixin):
+    """
+    HTTP cache storage which keeps responses of a spider in a single SQLite
+    database, ``<HTTPCACHE_DIR>/<spider name>.sqlite``, keyed by
+    ``prerender_request_fingerprint``.
+
+    Writes are committed in batches of ``PRERENDER_HTTPCACHE_SQLITE_BATCH_SIZE``
+    responses, or ``PRERENDER_HTTPCACHE_SQLITE_COMMIT_INTERVAL`` seconds after
+    the first uncommitted write. The database uses write-ahead logging,
+    so other processes can read it while the crawl is running.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS responses (
+            fingerprint TEXT PRIMARY KEY,
+            url TEXT,
+            method TEXT,
+            status INTEGER,
+            response_url TEXT,
+            headers BLOB,
+            body BLOB,
+            timestamp REAL,
+            compression TEXT
+        )
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.batch_size = settings.getint('PRERENDER_HTTPCACHE_SQLITE_BATCH_SIZE',
+                                          100)
+        self.commit_interval = settings.getfloat(
+            'PRERENDER_HTTPCACHE_SQLITE_COMMIT_INTERVAL', 1.0)
+        self.compression, self._compress = get_cache_compressor(settings)
+        self._init_fingerprints(settings)
+        self.db = None
+        self._pending = 0
+        self._commit_call = None
+
+    def open_spider(self, spider):
+        path = os.path.join(self.cachedir, '%s.sqlite' % spider.name)
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(self.schema)
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(responses)')]
+        if 'compression' not in columns:
+            # database created by an older version
+            self.db.execute('ALTER TABLE responses ADD COLUMN compression TEXT')
+        self.db.commit()
+        self._open_stats(spider)
+        logger.debug("Using SQLite cache storage in %(path)s", {'path': path},
+                     extra={'spider': spider})
+
+    def close_spider(self, spider):
+        self._commit()
+        self.db.close()
+
+    def retrieve_response(self, spider, request):
+        row = self.db.execute(
+            'SELECT status, response_url, headers, body, timestamp, '
+            'compression FROM responses WHERE fingerprint = ?',
+            (self._fingerprint(request),)).fetchone()
+        response = None
+        if row is not None:
+            status, url, headers, body, timestamp, compression = row
+            if not 0 < self.expiration_secs < time() - timestamp:
+                response = self._build_response(status, url, headers, body,
+                                                compression)
+        self._count_lookup(spider, request, response)
+        return response
+
+    def _build_response(self, status, url, headers, body, compression):
+        headers = Headers(headers_raw_to_dict(
+            decompress_cached(bytes(headers), compression)))
+        respcls = responsetypes.from_args(headers=headers, url=url)
+        return respcls(url=url, headers=headers, status=status,
+                       body=decompress_cached(bytes(body), compression))
+
+    def _encode(self, data):
+        if self._compress is not None:
+            data = self._compress(data)
+        return sqlite3.Binary(data)
+
+    def store_response(self, spider, request, response):
+        self.db.execute(
+            'INSERT OR REPLACE INTO responses '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (self._fingerprint(request), request.url, request.method,
+             response.status, response.url,
+             self._encode(headers_dict_to_raw(response.headers)),
+             self._encode(response.body), time(), self.compression))
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self._commit()
+        elif self._commit_call is None:
+            # the write lock is held until commit; don't block other
+            # processes for long when responses are stored slowly
+            self._commit_call = reactor.callLater(self.commit_interval,
+                                                  self._commit)
+
+    def _commit(self):
+        if self._commit_call is not None and self._commit_call.active():
+            self._commit_call.cancel()
+        self._commit_call = None
+        if self._pending:
+            self.db.commit()
+            self._pending = 0
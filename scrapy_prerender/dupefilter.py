@@ -4,7 +4,13 @@ To handle "prerender" Request meta key properly a custom DupeFilter must be set.
 See https://github.com/scrapy/scrapy/issues/900 for more info.
 """
 from __future__ import absolute_import
-from copy import deepcopy
+import binascii
+import hashlib
+import os
+import sys
+import weakref
+
+from six.moves.urllib.parse import urljoin
 
 try:
     from scrapy.dupefilters import RFPDupeFilter
@@ -12,21 +18,183 @@ except ImportError:
     # scrapy < 1.0
     from scrapy.dupefilter import RFPDupeFilter
 
+from scrapy import Request
+from scrapy.utils.job import job_dir
 from scrapy.utils.url import canonicalize_url
 from scrapy.utils.request import request_fingerprint
 
-from .utils import dict_hash
+from .utils import dict_hash, streaming_dict_hash, to_bytes
+from .serializers import canonical_json
+from .fingerprints import DEFAULT_FINGERPRINT_POLICY, FingerprintPolicy
+from .seen import DigestTable, MmapDigestTable, ScalableBloomFilter
 
 
-def prerender_request_fingerprint(request, include_headers=None):
-    """ Request fingerprint which takes 'prerender' meta key into account """
+_fingerprint_cache = weakref.WeakKeyDictionary()
+
+# base of server-independent URLs of processed requests in version 2
+# fingerprints
+PROCESSED_REQUEST_URL = 'http://prerender/'
+
+# request.meta keys used by fingerprint functions; they are sent along
+# with requests when fingerprints are computed by other processes
+FINGERPRINT_META_KEYS = (
+    'prerender',
+    '_prerender_processed',
+    '_prerender_fingerprint_url',
+)
+
+# PRERENDER_DUPEFILTER_MODE => name of the file in JOBDIR
+DUPEFILTER_MODES = {
+    'set': 'requests.seen',
+    'compact': 'requests.seen.table',
+    'bloom': 'requests.seen.bloom',
+    'mmap': 'requests.seen.mmap',
+}
+
+
+def prerender_request_fingerprint(request, include_headers=None, version=1,
+                                  policy=None):
+    """
+    Request fingerprint which takes 'prerender' meta key into account.
+    ``version`` is a key of FINGERPRINT_VERSIONS; fingerprints of different
+    versions don't match, so changing it invalidates HTTP cache entries
+    and dupefilter state. ``policy`` is a FingerprintPolicy which selects
+    and normalizes parts of ``meta['prerender']`` to use; by default
+    all of it is used.
+
+    Fingerprints are cached per request object, like Scrapy does for
+    ``request_fingerprint``. Request attributes can't be changed without
+    ``Request.replace``, which creates a new request, but
+    ``meta['prerender']`` can be modified in place; code which does it
+    after the fingerprint is computed must call
+    ``invalidate_prerender_fingerprint(request)``.
+    """
+    include_headers = _normalize_include_headers(include_headers)
+    if policy is None:
+        policy = DEFAULT_FINGERPRINT_POLICY
+    cache = _fingerprint_cache.setdefault(request, {})
+    cache_key = _cache_key(request, include_headers, version, policy)
+    if cache_key not in cache:
+        cache[cache_key] = _prerender_request_fingerprint(
+            request, include_headers, version, policy)
+    return cache[cache_key]
+
+
+def prerender_request_fingerprints(requests, include_headers=None, version=1,
+                                   policy=None, pool=None, chunksize=1000):
+    """
+    Return a list of ``prerender_request_fingerprint`` results for
+    ``requests``. If ``pool`` (a ``multiprocessing.Pool``) is passed,
+    fingerprints which are not cached yet are computed by pool processes
+    in chunks of ``chunksize`` requests. Results are cached, so that
+    e.g. the dupefilter doesn't compute them again.
+    """
+    requests = list(requests)
+    if pool is None:
+        return [prerender_request_fingerprint(request, include_headers,
+                                              version, policy)
+                for request in requests]
+
+    include_headers = _normalize_include_headers(include_headers)
+    if policy is None:
+        policy = DEFAULT_FINGERPRINT_POLICY
+    results = [None] * len(requests)
+    missing = []
+    for i, request in enumerate(requests):
+        cache = _fingerprint_cache.get(request, {})
+        key = _cache_key(request, include_headers, version, policy)
+        results[i] = cache.get(key)
+        if results[i] is None:
+            missing.append(i)
+
+    chunks = [missing[start:start + chunksize]
+              for start in range(0, len(missing), chunksize)]
+    tasks = [([_picklable_request(requests[i], include_headers) for i in chunk],
+              include_headers, version, policy) for chunk in chunks]
+    for chunk, fingerprints in zip(chunks, pool.map(_fingerprint_chunk, tasks)):
+        for i, fp in zip(chunk, fingerprints):
+            request = requests[i]
+            key = _cache_key(request, include_headers, version, policy)
+            _fingerprint_cache.setdefault(request, {})[key] = fp
+            results[i] = fp
+    return results
+
+
+def _normalize_include_headers(include_headers):
+    if include_headers:
+        return tuple(to_bytes(h.lower()) for h in sorted(include_headers))
+    return None
+
+
+def _cache_key(request, include_headers, version, policy):
+    return (include_headers, version, policy,
+            bool(request.meta.get('_prerender_processed')))
+
+
+def _picklable_request(request, include_headers):
+    """
+    Return request data used by fingerprints; unlike requests it can be
+    sent to other processes (callbacks are often spider methods).
+    """
+    meta = {key: request.meta[key] for key in FINGERPRINT_META_KEYS
+            if key in request.meta}
+    headers = {h: request.headers.getlist(h) for h in include_headers or ()
+               if h in request.headers}
+    return request.url, request.method, request.body, headers, meta
+
+
+def _fingerprint_chunk(task):
+    """ Compute fingerprints of _picklable_request results """
+    requests, include_headers, version, policy = task
+    return [
+        _prerender_request_fingerprint(
+            Request(url, method=method, body=body, headers=headers, meta=meta),
+            include_headers, version, policy)
+        for url, method, body, headers, meta in requests
+    ]
+
+
+def get_fingerprint_version(settings):
+    """ Return PRERENDER_FINGERPRINT_VERSION setting value """
+    version = settings.getint('PRERENDER_FINGERPRINT_VERSION', 1)
+    if version not in FINGERPRINT_VERSIONS:
+        raise ValueError("Unknown PRERENDER_FINGERPRINT_VERSION: %r" % version)
+    return version
+
+
+def invalidate_prerender_fingerprint(request):
+    """ Drop cached fingerprints of a request after its meta is changed """
+    _fingerprint_cache.pop(request, None)
+
+
+def _prerender_request_fingerprint(request, include_headers, version, policy):
+    try:
+        fingerprint_func = FINGERPRINT_VERSIONS[version]
+    except KeyError:
+        raise ValueError("Unknown fingerprint version: %r" % version)
 
-    fp = request_fingerprint(request, include_headers=include_headers)
     if 'prerender' not in request.meta:
-        return fp
+        return request_fingerprint(request, include_headers=include_headers)
+    return fingerprint_func(request, include_headers, policy)
+
+
+def _fingerprint_v1(request, include_headers, policy):
+    # policy returns a copy, so changing args['url'] is fine
+    prerender_options = policy.apply(request.meta['prerender'])
+    args = prerender_options.get('args', {})
 
-    prerender_options = deepcopy(request.meta['prerender'])
-    args = prerender_options.setdefault('args', {})
+    if request.meta.get('_prerender_processed'):
+        # Body of a request sent to Prerender depends on the serializer
+        # and compression settings; fingerprint the canonical form instead.
+        # Requests are distributed between Prerender servers, so the first
+        # server is used (the same as fingerprints of previous releases
+        # when a single server is used).
+        # Plain Request is used to avoid PrerenderRequest meta processing.
+        request = request.replace(
+            cls=Request, body=canonical_json(args),
+            url=request.meta.get('_prerender_fingerprint_url', request.url))
+
+    fp = request_fingerprint(request, include_headers=include_headers)
 
     if 'url' in args:
         args['url'] = canonicalize_url(args['url'], keep_fragments=True)
@@ -34,10 +202,244 @@ def prerender_request_fingerprint(request, include_headers=None):
     return dict_hash(prerender_options, fp)
 
 
+def _fingerprint_v2(request, include_headers, policy):
+    meta_options = request.meta['prerender']
+    # Version 1 fingerprints must stay the same as in previous releases,
+    # so only version 2 ignores internal keys (they are set by middlewares
+    # and depend on the crawl state) and Prerender state.
+    prerender_options = {key: value for key, value in meta_options.items()
+                         if not key.startswith('_')}
+    args = prerender_options['args'] = dict(meta_options.get('args', {}))
+    local_arg_fingerprints = meta_options.get('_local_arg_fingerprints')
+    if local_arg_fingerprints:
+        _restore_local_arg_fingerprints(args, local_arg_fingerprints)
+    if policy != DEFAULT_FINGERPRINT_POLICY:
+        prerender_options = policy.apply(prerender_options)
+        args = prerender_options.get('args', {})
+
+    arg_url = args.get('url')
+    if arg_url is not None:
+        args['url'] = canonicalize_url(arg_url, keep_fragments=True)
+
+    if request.meta.get('_prerender_processed'):
+        # Body of a request sent to Prerender is made of args, which are
+        # hashed anyway, so it is not serialized again. Prerender server
+        # URL is not used: requests are distributed between servers.
+        url = urljoin(PROCESSED_REQUEST_URL, meta_options.get('endpoint', ''))
+        body = b''
+    else:
+        # usually the target URL is the same as args['url'], and it is
+        # canonicalized already (a fragment doesn't matter, because
+        # args['url'] is hashed anyway)
+        if arg_url is not None and arg_url == request.url:
+            url = args['url']
+        else:
+            url = canonicalize_url(request.url)
+        body = request.body
+
+    fp = _request_digest(request, url, body, include_headers)
+    return streaming_dict_hash(prerender_options, fp)
+
+
+def _request_digest(request, url, body, include_headers):
+    """
+    ``request_fingerprint`` of a request with a canonical ``url`` and
+    ``body``, without creating a new request and canonicalizing the URL.
+    """
+    fp = hashlib.sha1()
+    fp.update(to_bytes(request.method))
+    fp.update(to_bytes(url))
+    fp.update(body or b'')
+    for header in include_headers or ():
+        if header in request.headers:
+            fp.update(header)
+            for value in request.headers.getlist(header):
+                fp.update(value)
+    return fp.hexdigest()
+
+
+def _restore_local_arg_fingerprints(args, local_arg_fingerprints):
+    """
+    Arguments from ``cache_args`` are sent to Prerender either as values
+    (with ``save_args``) or as ``load_args`` keys, depending on what is
+    stored on the server. Replace them with local fingerprints, so that
+    fingerprints don't depend on Prerender state.
+    """
+    load_args = dict(args.pop('load_args', {}))
+    save_args = [name for name in args.pop('save_args', [])
+                 if name not in local_arg_fingerprints]
+    for name, fp in local_arg_fingerprints.items():
+        load_args.pop(name, None)
+        args[name] = fp
+    if load_args:
+        args['load_args'] = load_args
+    if save_args:
+        args['save_args'] = save_args
+
+
+# version => fingerprint function.
+# Version 1 fingerprints are compatible with scrapy-prerender < 0.8;
+# version 2 fingerprints are much faster to compute for large arguments.
+FINGERPRINT_VERSIONS = {
+    1: _fingerprint_v1,
+    2: _fingerprint_v2,
+}
+
+
 class PrerenderAwareDupeFilter(RFPDupeFilter):
     """
     DupeFilter that takes 'prerender' meta key in account.
     It should be used with PrerenderMiddleware.
+
+    ``mode`` selects how fingerprints of seen requests are stored:
+    ``'set'`` is a Python set of hex strings (like RFPDupeFilter),
+    ``'compact'`` is a DigestTable of ``digest_size``-byte binary digests,
+    ``'bloom'`` is a ScalableBloomFilter with ``error_rate`` false positive
+    rate, ``'mmap'`` is a MmapDigestTable stored in a memory-mapped file
+    (in ``path`` directory or in a temporary file). ``capacity`` is an expected number of requests; containers grow
+    when it is exceeded.
     """
+    fingerprint_version = 1
+    fingerprint_policy = DEFAULT_FINGERPRINT_POLICY
+    stats = None
+
+    def __init__(self, path=None, debug=False, mode='set', digest_size=16,
+                 capacity=100000, error_rate=0.001):
+        if mode not in DUPEFILTER_MODES:
+            raise ValueError("Unknown PRERENDER_DUPEFILTER_MODE: %r" % mode)
+        self.mode = mode
+        self.seen_path = None
+        if mode == 'set':
+            super(PrerenderAwareDupeFilter, self).__init__(path, debug)
+            return
+
+        # requests.seen file is not used
+        super(PrerenderAwareDupeFilter, self).__init__(None, debug)
+        if path:
+            self.seen_path = os.path.join(path, DUPEFILTER_MODES[mode])
+        if mode == 'mmap':
+            self.fingerprints = MmapDigestTable(self.seen_path, digest_size,
+                                                capacity)
+        elif self.seen_path and os.path.exists(self.seen_path):
+            self.fingerprints = self._load(self.seen_path)
+        elif mode == 'compact':
+            self.fingerprints = DigestTable(digest_size, capacity)
+        else:
+            self.fingerprints = ScalableBloomFilter(error_rate, capacity)
+
+    def _load(self, path):
+        if self.mode == 'compact':
+            return DigestTable.load(path)
+        return ScalableBloomFilter.load(path)
+
+    @classmethod
+    def from_settings(cls, settings):
+        digest_size = settings.getint('PRERENDER_DUPEFILTER_DIGEST_SIZE', 16)
+        if digest_size not in (16, 20):
+            raise ValueError("PRERENDER_DUPEFILTER_DIGEST_SIZE must be 16 or 20")
+        dupefilter = cls(
+            job_dir(settings),
+            settings.getbool('DUPEFILTER_DEBUG'),
+            mode=settings.get('PRERENDER_DUPEFILTER_MODE', 'set'),
+            digest_size=digest_size,
+            capacity=settings.getint('PRERENDER_DUPEFILTER_CAPACITY', 100000),
+            error_rate=settings.getfloat('PRERENDER_DUPEFILTER_ERROR_RATE', 0.001),
+        )
+        dupefilter.fingerprint_version = get_fingerprint_version(settings)
+        dupefilter.fingerprint_policy = FingerprintPolicy.from_settings(settings)
+        return dupefilter
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        dupefilter = cls.from_settings(crawler.settings)
+        dupefilter.stats = crawler.stats
+        return dupefilter
+
     def request_fingerprint(self, request):
-        return prerender_request_fingerprint(request)
+        return prerender_request_fingerprint(
+            request,
+            version=self.fingerprint_version,
+            policy=self.fingerprint_policy,
+        )
+
+    def request_seen(self, request):
+        if self.mode == 'set':
+            return super(PrerenderAwareDupeFilter, self).request_seen(request)
+        fp = self.request_fingerprint(request)
+        return not self.fingerprints.add(binascii.unhexlify(fp))
+
+    def _fingerprint_seen(self, fp):
+        if self.mode == 'set':
+            return fp in self.fingerprints
+        return binascii.unhexlify(fp) in self.fingerprints
+
+    def prefilter(self, requests, pool=None, chunksize=10000,
+                  pool_chunksize=1000):
+        """
+        Filter an iterable of requests (e.g. start requests) in chunks of
+        ``chunksize``: fingerprints are computed for the whole chunk
+        (by ``pool`` processes in ``pool_chunksize`` parts, if a pool
+        is passed), and requests which
+        were seen already are dropped. Requests are not marked as seen:
+        the scheduler still calls ``request_seen`` for them, but their
+        fingerprints are cached by then.
+        """
+        chunk = []
+        for request in requests:
+            if not isinstance(request, Request):
+                yield request
+                continue
+            chunk.append(request)
+            if len(chunk) >= chunksize:
+                for request in self._prefilter_chunk(chunk, pool, pool_chunksize):
+                    yield request
+                chunk = []
+        for request in self._prefilter_chunk(chunk, pool, pool_chunksize):
+            yield request
+
+    def _prefilter_chunk(self, requests, pool, pool_chunksize):
+        fingerprints = prerender_request_fingerprints(
+            requests,
+            version=self.fingerprint_version,
+            policy=self.fingerprint_policy,
+            pool=pool,
+            chunksize=pool_chunksize,
+        )
+        for request, fp in zip(requests, fingerprints):
+            if request.dont_filter or not self._fingerprint_seen(fp):
+                yield request
+            elif self.stats is not None:
+                self.stats.inc_value('prerender/dupefilter/prefiltered')
+
+    def memory_usage(self):
+        """ Estimated memory used by fingerprints of seen requests, bytes """
+        if self.mode != 'set':
+            return self.fingerprints.memory_usage()
+        # set's hash table + 40-char str objects
+        return (sys.getsizeof(self.fingerprints) +
+                len(self.fingerprints) * sys.getsizeof('0' * 40))
+
+    def _update_stats(self):
+        if self.stats is None:
+            return
+        self.stats.set_value('prerender/dupefilter/memory_bytes',
+                             self.memory_usage())
+        self.stats.set_value('prerender/dupefilter/fingerprints',
+                             len(self.fingerprints))
+
+    def open(self):
+        self._update_stats()
+
+    def close(self, reason):
+        self._update_stats()
+        if self.mode == 'mmap':
+            self.fingerprints.close()
+        elif self.seen_path:
+            self.fingerprints.save(self.seen_path)
+        super(PrerenderAwareDupeFilter, self).close(reason)
+
+    def log(self, request, spider):
+        super(PrerenderAwareDupeFilter, self).log(request, spider)
+        if 'prerender' in request.meta:
+            spider.crawler.stats.inc_value('prerender/dupefilter/filtered',
+                                           spider=spider)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Scrapy extensions for monitoring Prerender usage.
+"""
+from __future__ import absolute_import
+import json
+import logging
+import time
+
+from twisted.internet import task
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from scrapy_prerender.middleware import PrerenderMiddleware
+from scrapy_prerender.stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+
+def find_prerender_middleware(crawler):
+    """ Return PrerenderMiddleware instance used by crawler, or None """
+    engine = getattr(crawler, 'engine', None)
+    if engine is None:
+        return None
+    for mw in engine.downloader.middleware.middlewares:
+        if isinstance(mw, PrerenderMiddleware):
+            return mw
+    return None
+
+
+class PrerenderStatsExtension(object):
+    """
+    Log Prerender stats periodically, like Scrapy LogStats does for pages
+    and items: renders per minute, bytes sent and received, in-flight
+    renders per Prerender server, 498 retry rate, cache_args hit rate and
+    latency percentiles. All rates and percentiles are computed for the
+    last interval.
+
+    If ``filename`` is set, snapshots are also appended
+    to this file as JSON lines.
+    """
+    counters = {
+        'renders': 'prerender/response_count',
+        'request_bytes': 'prerender/request_bytes',
+        'response_bytes': 'prerender/response_bytes',
+        'retries_498': 'prerender/498_retry_count',
+        'cache_args_hits': 'prerender/cache_args/hit',
+        'cache_args_misses': 'prerender/cache_args/miss',
+    }
+    latency_stages = ('render', 'total')
+
+    def __init__(self, crawler, interval=60.0, filename=None):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = interval
+        self.multiplier = 60.0 / self.interval
+        self.filename = filename
+        self.task = None
+        self.file = None
+        self._prev_counters = {}
+        self._prev_histograms = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        interval = crawler.settings.getfloat('PRERENDER_STATS_INTERVAL', 60.0)
+        if not interval:
+            raise NotConfigured
+        o = cls(crawler, interval,
+                crawler.settings.get('PRERENDER_STATS_FILE'))
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def spider_opened(self, spider):
+        self._prev_counters = {}
+        self._prev_histograms = {}
+        if self.filename:
+            self.file = open(self.filename, 'a')
+        self.task = task.LoopingCall(self.log, spider)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task and self.task.running:
+            self.task.stop()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def snapshot(self):
+        """ Return a dict with Prerender stats of the last interval """
+        counters = {name: self.stats.get_value(key, 0)
+                    for name, key in self.counters.items()}
+        delta = {name: value - self._prev_counters.get(name, 0)
+                 for name, value in counters.items()}
+        self._prev_counters = counters
+
+        cache_args_total = delta['cache_args_hits'] + delta['cache_args_misses']
+        snapshot = {
+            'time': time.time(),
+            'renders': counters['renders'],
+            'renders_per_min': delta['renders'] * self.multiplier,
+            'request_bytes': delta['request_bytes'],
+            'response_bytes': delta['response_bytes'],
+            'retry_498_rate': (float(delta['retries_498']) / delta['renders']
+                               if delta['renders'] else 0.0),
+            'cache_args_hit_rate': (float(delta['cache_args_hits']) /
+                                    cache_args_total
+                                    if cache_args_total else None),
+            'inflight': {},
+            'latency': {},
+        }
+
+        mw = find_prerender_middleware(self.crawler)
+        if mw is None:
+            return snapshot
+        for backend in mw.backend_pool.backends:
+            snapshot['inflight'][backend.url] = backend.outstanding
+        if mw.latency_stats is not None:
+            for stage in self.latency_stages:
+                name = 'prerender/latency/%s' % stage
+                histogram = mw.latency_stats.get(name)
+                if histogram is None:
+                    continue
+                previous = self._prev_histograms.get(name, LatencyHistogram())
+                interval_histogram = histogram.since(previous)
+                self._prev_histograms[name] = histogram.copy()
+                snapshot['latency'][stage] = {
+                    'p%d' % p: round(interval_histogram.percentile(p), 4)
+                    for p in mw.latency_stats.percentiles
+                }
+        return snapshot
+
+    def log(self, spider):
+        snapshot = self.snapshot()
+        msg = ("Rendered %(renders)d pages (at %(renders_per_min)d pages/min), "
+               "sent %(request_bytes)d bytes, received %(response_bytes)d bytes, "
+               "in-flight: %(inflight)s, 498 retries: %(retry_498)s, "
+               "cache_args hits: %(cache_args_hits)s, latency: %(latency)s")
+        log_args = {
+            'renders': snapshot['renders'],
+            'renders_per_min': snapshot['renders_per_min'],
+            'request_bytes': snapshot['request_bytes'],
+            'response_bytes': snapshot['response_bytes'],
+            'inflight': ', '.join('%s=%d' % item for item in
+                                  sorted(snapshot['inflight'].items())) or '-',
+            'retry_498': '%.1f%%' % (snapshot['retry_498_rate'] * 100),
+            'cache_args_hits': (
+                '-' if snapshot['cache_args_hit_rate'] is None
+                else '%.1f%%' % (snapshot['cache_args_hit_rate'] * 100)),
+            'latency': ', '.join(
+                '%s p50/p95/p99=%.2f/%.2f/%.2fs' % (
+                    stage, values['p50'], values['p95'], values['p99'])
+                for stage, values in sorted(snapshot['latency'].items())
+            ) or '-',
+        }
+        logger.info(msg, log_args, extra={'spider': spider})
+        if self.file is not None:
+            self.file.write(json.dumps(snapshot, sort_keys=True) + '\n')
+            self.file.flush()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Policies which select and normalize parts of ``meta['prerender']``
+used for request fingerprints.
+"""
+from __future__ import absolute_import
+import fnmatch
+import re
+
+import six
+from scrapy.utils.misc import load_object
+
+
+def sort_headers(headers):
+    """
+    Normalize headers: header names are lowercased and headers are sorted.
+    Dicts, lists of (name, value) pairs and HAR lists are supported.
+
+    >>> sort_headers({'User-Agent': 'foo', 'Accept': '*/*'})
+    [['accept', '*/*'], ['user-agent', 'foo']]
+    >>> sort_headers([{'name': 'B', 'value': '1'}, {'name': 'a', 'value': '2'}])
+    [['a', '2'], ['b', '1']]
+    """
+    if isinstance(headers, dict):
+        pairs = headers.items()
+    else:
+        pairs = [(h['name'], h.get('value', '')) if isinstance(h, dict) else h
+                 for h in headers]
+    return sorted([name.lower(), value] for name, value in pairs)
+
+
+class DropCookies(object):
+    """
+    Cookie normalizer: cookies with names matching one of ``patterns``
+    (shell-style wildcards) are dropped, other cookies are sorted.
+    Cookies can be a {name: value} dict or a list of HAR cookies.
+
+    >>> drop = DropCookies(['_ga*'])
+    >>> drop([{'name': 'sid', 'value': '1'}, {'name': '_ga', 'value': '2'}])
+    [{'name': 'sid', 'value': '1'}]
+    """
+    # analytics and advertising cookies which change on every visit
+    default_patterns = ['_ga', '_ga_*', '_gid', '_gat*', '__utm*', '_fbp',
+                        '_gcl_*', '_hj*', 'AMP_TOKEN']
+
+    def __init__(self, patterns=None):
+        if patterns is None:
+            patterns = self.default_patterns
+        self.patterns = tuple(patterns)
+        self._regex = _compile(self.patterns)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.getlist('PRERENDER_FINGERPRINT_VOLATILE_COOKIES',
+                                    cls.default_patterns))
+
+    def __call__(self, cookies):
+        if isinstance(cookies, dict):
+            return {name: value for name, value in cookies.items()
+                    if not self._regex.match(name)}
+        cookies = [c for c in cookies if not self._regex.match(c['name'])]
+        return sorted(cookies, key=lambda c: (c['name'], c.get('domain', ''),
+                                              c.get('path', '')))
+
+    def __eq__(self, other):
+        return isinstance(other, DropCookies) and self.patterns == other.patterns
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.patterns)
+
+
+ARG_NORMALIZERS = {
+    'sort_headers': sort_headers,
+    'drop_volatile_cookies': DropCookies,
+}
+
+
+def _compile(patterns):
+    if not patterns:
+        return re.compile(r'(?!)')  # matches nothing
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(p)
+                               for p in patterns))
+
+
+def _load_normalizer(normalizer, settings=None):
+    if isinstance(normalizer, six.string_types):
+        normalizer = ARG_NORMALIZERS.get(normalizer) or load_object(normalizer)
+    if isinstance(normalizer, type):
+        if settings is not None and hasattr(normalizer, 'from_settings'):
+            return normalizer.from_settings(settings)
+        return normalizer()
+    return normalizer
+
+
+class FingerprintPolicy(object):
+    """
+    Select which parts of ``meta['prerender']`` are used for request
+    fingerprints, and how Prerender arguments are normalized.
+
+    ``include`` and ``exclude`` are lists of key paths with shell-style
+    wildcards: ``'session_id'`` is a key of ``meta['prerender']``,
+    ``'args.wait'`` is a Prerender argument. If ``include`` is not empty
+    only matching keys are used. Keys matching ``exclude`` patterns are
+    not used. By default all keys are used; internal keys (``'_*'``)
+    are never used by version 2 fingerprints.
+
+    ``arg_normalizers`` is a {argument name: normalizer} dict; a normalizer
+    is a function which returns a normalized argument value, its import
+    path, or one of ARG_NORMALIZERS names.
+
+    >>> policy = FingerprintPolicy(exclude=['_*', 'args.wait'])
+    >>> policy.apply({'args': {'url': 'http://example.com', 'wait': 0.5},
+    ...               '_replaced_args': []})
+    {'args': {'url': 'http://example.com'}}
+    """
+    default_exclude = ()
+
+    def __init__(self, include=(), exclude=default_exclude,
+                 arg_normalizers=None):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.arg_normalizers = {
+            name: _load_normalizer(normalizer)
+            for name, normalizer in (arg_normalizers or {}).items()
+        }
+        self._include_regex = _compile(self.include)
+        self._exclude_regex = _compile(self.exclude)
+        # args container must be kept if some of its keys are included
+        self._include_args = not self.include or any(
+            p == 'args' or p.startswith('args.') or fnmatch.fnmatchcase('args', p)
+            for p in self.include)
+        # policies are used as parts of fingerprint cache keys
+        self._cached_key = (
+            self.include, self.exclude,
+            tuple(sorted(self.arg_normalizers.items(), key=lambda item: item[0])))
+        self._hash = hash(self._cached_key)
+
+    @classmethod
+    def from_settings(cls, settings):
+        normalizers = settings.getdict('PRERENDER_FINGERPRINT_ARG_NORMALIZERS')
+        return cls(
+            include=settings.getlist('PRERENDER_FINGERPRINT_INCLUDE'),
+            exclude=settings.getlist('PRERENDER_FINGERPRINT_EXCLUDE',
+                                     cls.default_exclude),
+            arg_normalizers={
+                name: _load_normalizer(normalizer, settings)
+                for name, normalizer in normalizers.items()
+            },
+        )
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        return (isinstance(other, FingerprintPolicy) and
+                self._cached_key == other._cached_key)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+    def _selected(self, path, parent=None):
+        if self._exclude_regex.match(path):
+            return False
+        if parent is not None:
+            if self._exclude_regex.match(parent):
+                return False
+            if self._include_regex.match(parent):
+                return True
+        return not self.include or bool(self._include_regex.match(path))
+
+    def apply(self, prerender_options):
+        """
+        Return a copy of ``prerender_options`` with selected keys and
+        normalized arguments; argument values themselves are not copied.
+        """
+        result = {}
+        for key, value in prerender_options.items():
+            if key != 'args' and self._selected(key):
+                result[key] = value
+
+        if not self._include_args or self._exclude_regex.match('args'):
+            return result
+
+        args = {}
+        for name, value in prerender_options.get('args', {}).items():
+            if not self._selected('args.' + name, 'args'):
+                continue
+            normalizer = self.arg_normalizers.get(name)
+            args[name] = value if normalizer is None else normalizer(value)
+        result['args'] = args
+        return result
+
+
+DEFAULT_FINGERPRINT_POLICY = FingerprintPolicy()
@@ -2,28 +2,54 @@
 from __future__ import absolute_import
 
 import copy
-import json
 import logging
+import multiprocessing
+import os
+import signal
+import time
 import warnings
 from collections import defaultdict
 
-from six.moves.urllib.parse import urljoin
+from six.moves.urllib.parse import urljoin, urlparse
 from six.moves.http_cookiejar import CookieJar
 
 import scrapy
 from scrapy.exceptions import NotConfigured
 from scrapy.http.headers import Headers
 from scrapy.http.response.text import TextResponse
+from scrapy.resolver import dnscache
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.job import job_dir
 from scrapy import signals
+from twisted.internet import defer
+from twisted.internet.error import (
+    TimeoutError,
+    DNSLookupError,
+    ConnectionRefusedError,
+    ConnectionDone,
+    ConnectError,
+    ConnectionLost,
+    TCPTimedOutError,
+)
+from twisted.web.client import ResponseFailed
 
 from scrapy_prerender.responsetypes import responsetypes
 from scrapy_prerender.cookies import jar_to_har, har_to_jar
 from scrapy_prerender.utils import (
     scrapy_headers_to_unicode_dict,
-    json_based_hash,
+    _cached_json_based_hash,
+    HashCache,
     parse_x_prerender_saved_arguments_header,
+    compress_body,
+    to_bytes,
 )
 from scrapy_prerender.response import get_prerender_status, get_prerender_headers
+from scrapy_prerender.serializers import get_json_serializer, json_compact
+from scrapy_prerender.dupefilter import invalidate_prerender_fingerprint
+from scrapy_prerender.backends import BackendPool, BalancePolicy
+from scrapy_prerender.throttle import AdaptiveConcurrency, CapacityGate
+from scrapy_prerender.stats import LatencyStats
+from scrapy_prerender import signals as prerender_signals
 
 
 logger = logging.getLogger(__name__)
@@ -33,8 +59,9 @@ class SlotPolicy(object):
     PER_DOMAIN = 'per_domain'
     SINGLE_SLOT = 'single_slot'
     SCRAPY_DEFAULT = 'scrapy_default'
+    ADAPTIVE = 'adaptive'
 
-    _known = {PER_DOMAIN, SINGLE_SLOT, SCRAPY_DEFAULT}
+    _known = {PER_DOMAIN, SINGLE_SLOT, SCRAPY_DEFAULT, ADAPTIVE}
 
 
 class PrerenderCookiesMiddleware(object):
@@ -84,6 +111,7 @@ class PrerenderCookiesMiddleware(object):
         har_to_jar(jar, cookies)
 
         prerender_args['cookies'] = jar_to_har(jar)
+        invalidate_prerender_fingerprint(request)
         self._debug_cookie(request, spider)
 
     def process_response(self, request, response, spider):
@@ -155,6 +183,52 @@ class PrerenderDeduplicateArgsMiddleware(object):
     middleware.
     """
     local_values_key = '_prerender_local_values'
+    hash_cache_filename = 'prerender_hash_cache.json'
+
+    def __init__(self, stats=None, jobdir=None, hash_cache=None):
+        self.stats = stats
+        self.jobdir = jobdir
+        self.hash_cache = hash_cache if hash_cache is not None else HashCache()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        max_entries = settings.getint('PRERENDER_HASH_CACHE_MAX_ENTRIES', 10000)
+        max_bytes = settings.get('PRERENDER_HASH_CACHE_MAX_BYTES')
+        if max_bytes is not None:
+            max_bytes = settings.getint('PRERENDER_HASH_CACHE_MAX_BYTES')
+        if max_entries <= 0 or (max_bytes is not None and max_bytes <= 0):
+            raise NotConfigured(
+                "PRERENDER_HASH_CACHE_MAX_ENTRIES and "
+                "PRERENDER_HASH_CACHE_MAX_BYTES must be positive")
+        mw = cls(stats=crawler.stats, jobdir=job_dir(settings),
+                 hash_cache=HashCache(max_entries, max_bytes))
+        crawler.signals.connect(mw.spider_opened, signals.spider_opened)
+        crawler.signals.connect(mw.spider_closed, signals.spider_closed)
+        return mw
+
+    @property
+    def _hash_cache_path(self):
+        if self.jobdir:
+            return os.path.join(self.jobdir, self.hash_cache_filename)
+
+    def spider_opened(self, spider):
+        path = self._hash_cache_path
+        if path and os.path.exists(path):
+            count = self.hash_cache.load(path)
+            logger.debug("Loaded %d cache_args hashes from %s", count, path,
+                         extra={'spider': spider})
+
+    def spider_closed(self, spider):
+        path = self._hash_cache_path
+        if path:
+            self.hash_cache.save(path)
+        self.stats.set_value('prerender/hash_cache/evictions',
+                             self.hash_cache.evictions, spider=spider)
+        self.stats.set_value('prerender/hash_cache/entries',
+                             len(self.hash_cache), spider=spider)
+        self.stats.set_value('prerender/hash_cache/bytes',
+                             self.hash_cache.bytes, spider=spider)
 
     def process_spider_output(self, response, result, spider):
         for el in result:
@@ -196,14 +270,120 @@ class PrerenderDeduplicateArgsMiddleware(object):
             if name not in args:
                 continue
             value = args[name]
-            fp = 'LOCAL+' + json_based_hash(value)
+            # stable hashes are slower without xxhash; they are needed
+            # only if the cache is saved to JOBDIR
+            fp, cached = _cached_json_based_hash(value,
+                                                 stable=bool(self.jobdir),
+                                                 cache=self.hash_cache)
+            if self.stats is not None:
+                self.stats.inc_value('prerender/hash_cache/%s' % (
+                    'hit' if cached else 'miss'), spider=spider)
+            fp = 'LOCAL+' + fp
             spider.state[self.local_values_key][fp] = value
             args[name] = fp
             request.meta['prerender']['_replaced_args'].append(name)
 
+        invalidate_prerender_fingerprint(request)
         return request
 
 
+class PrerenderPrefilterMiddleware(object):
+    """
+    Spider middleware which passes start requests through
+    PrerenderAwareDupeFilter.prefilter: fingerprints of start requests
+    are computed in bulk by a pool of processes, and requests seen
+    before (e.g. in a resumed job) are dropped before they get to
+    the scheduler. It should process start requests after
+    PrerenderDeduplicateArgsMiddleware, i.e. it needs a smaller order.
+    """
+    def __init__(self, crawler, processes=1, chunksize=10000):
+        self.crawler = crawler
+        self.processes = processes
+        self.chunksize = chunksize
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        processes = crawler.settings.getint('PRERENDER_PREFILTER_PROCESSES', 0)
+        return cls(
+            crawler,
+            processes=processes or multiprocessing.cpu_count(),
+            chunksize=crawler.settings.getint('PRERENDER_PREFILTER_CHUNK_SIZE',
+                                              10000),
+        )
+
+    def _get_dupefilter(self):
+        # start requests are consumed after the engine slot is created
+        slot = getattr(self.crawler.engine, 'slot', None)
+        scheduler = getattr(slot, 'scheduler', None)
+        return getattr(scheduler, 'df', None)
+
+    def process_start_requests(self, start_requests, spider):
+        dupefilter = self._get_dupefilter()
+        if not hasattr(dupefilter, 'prefilter'):
+            logger.warning("PrerenderPrefilterMiddleware requires "
+                           "PrerenderAwareDupeFilter; start requests are "
+                           "not prefiltered", extra={'spider': spider})
+            for request in start_requests:
+                yield request
+            return
+
+        pool = None
+        if self.processes > 1:
+            pool = multiprocessing.Pool(self.processes, _init_prefilter_worker)
+        pool_chunksize = max(1, self.chunksize // (4 * self.processes))
+        try:
+            for request in dupefilter.prefilter(start_requests, pool,
+                                                self.chunksize, pool_chunksize):
+                yield request
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+
+def _init_prefilter_worker():
+    # Forked workers inherit Scrapy signal handlers, which would keep
+    # them running on SIGTERM; Ctrl-C is handled by the main process.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class PrerenderCachePrefetchMiddleware(object):
+    """
+    Downloader middleware which reads cached responses in the thread pool
+    of PrerenderAwareThreadedFSCacheStorage before HttpCacheMiddleware
+    looks them up, so that the reactor thread doesn't wait for disk reads.
+    It must process requests before HttpCacheMiddleware, i.e. it needs
+    a smaller order. Scrapy 2.0+ is required.
+    """
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.storage = None
+        crawler.signals.connect(self.spider_opened, signals.spider_opened)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('HTTPCACHE_ENABLED'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        # downloader middlewares don't exist yet when this one is created
+        self.storage = self._get_storage()
+
+    def _get_storage(self):
+        middleware = self.crawler.engine.downloader.middleware
+        for mw in middleware.middlewares:
+            storage = getattr(mw, 'storage', None)
+            if hasattr(storage, 'prefetch'):
+                return storage
+
+    def process_request(self, request, spider):
+        if self.storage is None or request.meta.get('dont_cache', False):
+            return None
+        return self.storage.prefetch(spider, request)
+
+
 class PrerenderMiddleware(object):
     """
     Scrapy downloader and spider middleware that passes requests
@@ -218,16 +398,53 @@ class PrerenderMiddleware(object):
     default_endpoint = "render.json"
     prerender_extra_timeout = 5.0
     default_policy = SlotPolicy.PER_DOMAIN
+    default_balance_policy = BalancePolicy.ROUND_ROBIN
+    backend_failure_statuses = {502, 503, 504}
+    backend_failure_exceptions = (
+        defer.TimeoutError, TimeoutError, DNSLookupError,
+        ConnectionRefusedError, ConnectionDone, ConnectError,
+        ConnectionLost, TCPTimedOutError, ResponseFailed,
+    )
+    probe_priority_adjust = +1000
+    congestion_exceptions = (defer.TimeoutError, TimeoutError, TCPTimedOutError)
     rescheduling_priority_adjust = +100
     retry_498_priority_adjust = +50
     remote_keys_key = '_prerender_remote_keys'
-
-    def __init__(self, crawler, prerender_base_url, slot_policy, log_400):
+    request_compression_encodings = {'gzip', 'deflate'}
+
+    def __init__(self, crawler, prerender_base_url, slot_policy, log_400,
+                 json_serializer=json_compact, request_compression=None,
+                 request_compression_min_size=1024,
+                 request_compression_level=6, backend_pool=None,
+                 probe_path='_ping', probe_timeout=10.0,
+                 adaptive_concurrency=None, backend_concurrency=0,
+                 latency_stats=None, latency_stats_per_domain=False):
         self.crawler = crawler
         self.prerender_base_url = prerender_base_url
+        if backend_pool is None:
+            backend_pool = BackendPool.from_urls([prerender_base_url])
+        self.backend_pool = backend_pool
+        self.probe_path = probe_path
+        self.probe_timeout = probe_timeout
+        if adaptive_concurrency is None:
+            adaptive_concurrency = AdaptiveConcurrency()
+        self.adaptive_concurrency = adaptive_concurrency
+        self.backend_concurrency = backend_concurrency
+        self.capacity_gate = CapacityGate()
         self.slot_policy = slot_policy
         self.log_400 = log_400
+        self.json_serializer = json_serializer
+        self.request_compression = request_compression
+        self.request_compression_min_size = request_compression_min_size
+        self.request_compression_level = request_compression_level
+        self.latency_stats = latency_stats
+        self.latency_stats_per_domain = latency_stats_per_domain
         self.crawler.signals.connect(self.spider_opened, signals.spider_opened)
+        self.crawler.signals.connect(self.spider_closed, signals.spider_closed)
+        # the signal is available in Scrapy 1.8+
+        if hasattr(signals, 'request_reached_downloader'):
+            self.crawler.signals.connect(self._request_reached_downloader,
+                                         signals.request_reached_downloader)
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -239,7 +456,71 @@ class PrerenderMiddleware(object):
         if slot_policy not in SlotPolicy._known:
             raise NotConfigured("Incorrect slot policy: %r" % slot_policy)
 
-        return cls(crawler, prerender_base_url, slot_policy, log_400)
+        serializer_name = crawler.settings.get('PRERENDER_JSON_SERIALIZER',
+                                               'json')
+        try:
+            json_serializer = get_json_serializer(serializer_name)
+        except (ValueError, ImportError, NameError) as e:
+            raise NotConfigured("Incorrect JSON serializer %r: %s" % (
+                serializer_name, e))
+
+        request_compression = crawler.settings.get(
+            'PRERENDER_REQUEST_COMPRESSION') or None
+        if (request_compression is not None and
+                request_compression not in cls.request_compression_encodings):
+            raise NotConfigured("Incorrect request compression: %r" %
+                                request_compression)
+
+        prerender_urls = crawler.settings.get('PRERENDER_URLS') or [
+            prerender_base_url]
+        balance_policy = crawler.settings.get('PRERENDER_BALANCE_POLICY',
+                                              cls.default_balance_policy)
+        try:
+            backend_pool = BackendPool.from_urls(prerender_urls, balance_policy)
+        except (ValueError, ImportError, NameError) as e:
+            raise NotConfigured("Incorrect Prerender backends %r / %r: %s" % (
+                prerender_urls, balance_policy, e))
+        if crawler.settings.getbool('PRERENDER_CIRCUIT_BREAKER_ENABLED'):
+            backend_pool.enable_circuit_breakers(
+                failure_threshold=crawler.settings.getint(
+                    'PRERENDER_CIRCUIT_BREAKER_THRESHOLD', 5),
+                reset_timeout=crawler.settings.getfloat(
+                    'PRERENDER_CIRCUIT_BREAKER_RESET_TIMEOUT', 30.0),
+            )
+
+        backend_concurrency = crawler.settings.getint(
+            'PRERENDER_BACKEND_CONCURRENCY', 0)
+        if backend_concurrency and scrapy.version_info < (2, 0):
+            # requests wait for capacity in process_request, and
+            # returning a Deferred from it requires Scrapy 2.0+
+            raise NotConfigured("PRERENDER_BACKEND_CONCURRENCY requires "
+                                "Scrapy 2.0 or newer")
+
+        latency_stats = None
+        if crawler.settings.getbool('PRERENDER_LATENCY_STATS', True):
+            latency_stats = LatencyStats(crawler.settings.getint(
+                'PRERENDER_LATENCY_STATS_MAX_HISTOGRAMS', 10000))
+
+        return cls(
+            crawler, prerender_base_url, slot_policy, log_400,
+            backend_pool=backend_pool,
+            probe_path=crawler.settings.get(
+                'PRERENDER_CIRCUIT_BREAKER_PROBE_PATH', '_ping'),
+            probe_timeout=crawler.settings.getfloat(
+                'PRERENDER_CIRCUIT_BREAKER_PROBE_TIMEOUT', 10.0),
+            adaptive_concurrency=AdaptiveConcurrency.from_settings(
+                crawler.settings),
+            backend_concurrency=backend_concurrency,
+            latency_stats=latency_stats,
+            latency_stats_per_domain=crawler.settings.getbool(
+                'PRERENDER_LATENCY_STATS_PER_DOMAIN'),
+            json_serializer=json_serializer,
+            request_compression=request_compression,
+            request_compression_min_size=crawler.settings.getint(
+                'PRERENDER_REQUEST_COMPRESSION_MIN_SIZE', 1024),
+            request_compression_level=crawler.settings.getint(
+                'PRERENDER_REQUEST_COMPRESSION_LEVEL', 6),
+        )
 
     def spider_opened(self, spider):
         if not hasattr(spider, 'state'):
@@ -248,6 +529,12 @@ class PrerenderMiddleware(object):
         # local fingerprint => key returned by prerender
         spider.state.setdefault(self.remote_keys_key, {})
 
+    def spider_closed(self, spider):
+        # don't keep requests waiting for capacity forever
+        self.capacity_gate.cancel_all()
+        if self.latency_stats is not None:
+            self.latency_stats.to_stats(self.crawler.stats, spider=spider)
+
     @property
     def _argument_values(self):
         key = PrerenderDeduplicateArgsMiddleware.local_values_key
@@ -271,14 +558,13 @@ class PrerenderMiddleware(object):
             return request
 
         if request.meta.get("_prerender_processed"):
-            # don't process the same request more than once
-            return
+            # don't process the same request more than once;
+            # the request is going to be sent to Prerender now.
+            return self._backend_request_started(request)
 
         prerender_options = request.meta['prerender']
         request.meta['_prerender_processed'] = True
-
-        slot_policy = prerender_options.get('slot_policy', self.slot_policy)
-        self._set_download_slot(request, request.meta, slot_policy)
+        request.meta['_prerender_start_time'] = time.time()
 
         args = prerender_options.setdefault('args', {})
 
@@ -296,9 +582,11 @@ class PrerenderMiddleware(object):
                 if fp in self._remote_keys:
                     load_args[name] = self._remote_keys[fp]
                     del args[name]
+                    self.crawler.stats.inc_value('prerender/cache_args/hit')
                 else:
                     save_args.append(name)
                     args[name] = self._argument_values[fp]
+                    self.crawler.stats.inc_value('prerender/cache_args/miss')
 
                 local_arg_fingerprints[name] = fp
 
@@ -321,8 +609,7 @@ class PrerenderMiddleware(object):
             if headers:
                 args.setdefault('headers', headers)
 
-        body = json.dumps(args, ensure_ascii=False, sort_keys=True, indent=4)
-        # print(body)
+        body = self.json_serializer(args)
 
         if 'timeout' in args:
             # User requested a Prerender timeout explicitly.
@@ -349,11 +636,27 @@ class PrerenderMiddleware(object):
                 request.meta['download_timeout'] = timeout_expected
 
         endpoint = prerender_options.setdefault('endpoint', self.default_endpoint)
-        prerender_base_url = prerender_options.get('prerender_url', self.prerender_base_url)
+        prerender_base_url = prerender_options.get('prerender_url')
+        if prerender_base_url is None:
+            self._probe_backends(spider)
+            backend = self.backend_pool.choose(self._get_balance_key(args))
+            prerender_base_url = backend.url
+            request.meta['_prerender_backend'] = backend.url
+            # fingerprints (e.g. HTTP cache keys) must not depend on
+            # the chosen backend
+            request.meta['_prerender_fingerprint_url'] = urljoin(
+                self.backend_pool.backends[0].url, endpoint)
         prerender_url = urljoin(prerender_base_url, endpoint)
 
+        slot_policy = prerender_options.get('slot_policy', self.slot_policy)
+        self._set_download_slot(request, request.meta, slot_policy,
+                                prerender_base_url)
+
         headers = Headers({'Content-Type': 'application/json'})
         headers.update(prerender_options.get('prerender_headers', {}))
+        body = self._encode_body(body, headers)
+        # meta['prerender'] of the original request is changed above
+        invalidate_prerender_fingerprint(request)
         new_request = request.replace(
             url=prerender_url,
             method='POST',
@@ -362,21 +665,38 @@ class PrerenderMiddleware(object):
             priority=request.priority + self.rescheduling_priority_adjust
         )
         self.crawler.stats.inc_value('prerender/%s/request_count' % endpoint)
+        self.crawler.stats.inc_value('prerender/request_bytes', len(body))
         return new_request
 
     def process_response(self, request, response, spider):
         if not request.meta.get("_prerender_processed"):
             return response
 
+        # decoded parts of a PrerenderAwareFSCacheStorage entry
+        # (PRERENDER_HTTPCACHE_DECODED); it is stale for downloaded responses
+        cached_data = request.meta.pop('_prerender_cached_data', None)
+        if 'cached' not in response.flags:
+            cached_data = None
+
+        self._backend_request_finished(request, response=response)
+
         prerender_options = request.meta['prerender']
         if not prerender_options:
             return response
 
+        self._adapt_concurrency(request, response=response)
+        self._record_latency(request, response)
+
         # update stats
         endpoint = prerender_options['endpoint']
         self.crawler.stats.inc_value(
             'prerender/%s/response_count/%s' % (endpoint, response.status)
         )
+        if 'cached' not in response.flags:
+            # HTTP cache hits are not renders
+            self.crawler.stats.inc_value('prerender/response_count')
+            self.crawler.stats.inc_value('prerender/response_bytes',
+                                         len(response.body))
 
         # handle save_args/load_args
         self._process_x_prerender_saved_arguments(request, response)
@@ -384,20 +704,171 @@ class PrerenderMiddleware(object):
             logger.debug("Got HTTP 498 response for {}; "
                          "sending arguments again.".format(request),
                          extra={'spider': spider})
+            self.crawler.stats.inc_value('prerender/498_retry_count')
             return self._498_retry_request(request, response)
 
         if prerender_options.get('dont_process_response', False):
             return response
 
-        response = self._change_response_class(request, response)
+        response = self._change_response_class(request, response,
+                                               cached_data)
 
         if self.log_400 and get_prerender_status(response) == 400:
             self._log_400(request, response, spider)
 
         return response
 
-    def _change_response_class(self, request, response):
-        from scrapy_prerender import PrerenderResponse, PrerenderTextResponse
+    def process_exception(self, request, exception, spider):
+        if not request.meta.get("_prerender_processed"):
+            return
+        self._backend_request_finished(request, exception=exception)
+        self._adapt_concurrency(request, exception=exception)
+
+    def _get_balance_key(self, args):
+        """ Requests with the same key are sent to the same backend
+        by 'consistent_hash' balance policy """
+        if len(self.backend_pool.backends) == 1:
+            return None
+        return urlparse(args['url']).hostname
+
+    def _backend_request_started(self, request):
+        """
+        Track a request which is about to be sent to a Prerender server.
+        If PRERENDER_BACKEND_CONCURRENCY is set, return a Deferred which
+        fires when both the download slot and the server have room.
+        """
+        backend = self.backend_pool.get(request.meta.get('_prerender_backend'))
+        if backend is None:
+            request.meta['_prerender_sent_time'] = time.time()
+            return
+        if self.backend_concurrency:
+            limits = self._capacity_limits(request, backend)
+            request.meta['_prerender_capacity_keys'] = [k for k, _ in limits]
+            dfd = self.capacity_gate.acquire(limits)
+            if dfd is not None:
+                self.crawler.stats.inc_value(
+                    'prerender/backend/%s/capacity_wait_count' % backend.url)
+                return dfd.addCallback(
+                    lambda _: self._backend_request_sent(request, backend))
+        self._backend_request_sent(request, backend)
+
+    def _capacity_limits(self, request, backend):
+        slot_key = self._get_slot_key(request)
+        return [
+            (('slot', slot_key), self._get_slot_concurrency(slot_key)),
+            (('backend', backend.url), self.backend_concurrency),
+        ]
+
+    def _backend_request_sent(self, request, backend):
+        request.meta['_prerender_sent_time'] = time.time()
+        backend.outstanding += 1
+        request.meta['_prerender_inflight'] = True
+        self.crawler.stats.inc_value(
+            'prerender/backend/%s/request_count' % backend.url)
+
+    def _backend_request_finished(self, request, response=None, exception=None):
+        if not request.meta.pop('_prerender_inflight', False):
+            return
+        backend = self.backend_pool.get(request.meta['_prerender_backend'])
+        backend.outstanding -= 1
+        capacity_keys = request.meta.pop('_prerender_capacity_keys', None)
+        if capacity_keys:
+            self.capacity_gate.release(capacity_keys)
+        if response is not None and 'cached' in response.flags:
+            # HTTP cache hits say nothing about the backend health
+            return
+        if response is not None:
+            self.crawler.stats.inc_value(
+                'prerender/backend/%s/response_count/%s' % (
+                    backend.url, response.status))
+            failed = response.status in self.backend_failure_statuses
+            reason = 'HTTP %s' % response.status
+        else:
+            self.crawler.stats.inc_value(
+                'prerender/backend/%s/exception_count/%s' % (
+                    backend.url, exception.__class__.__name__))
+            failed = isinstance(exception, self.backend_failure_exceptions)
+            reason = exception.__class__.__name__
+
+        if backend.breaker is None:
+            return
+        if failed:
+            self._backend_failed(backend, reason)
+        elif backend.breaker.record_success():
+            self._backend_circuit_closed(backend)
+
+    def _backend_failed(self, backend, reason):
+        if not backend.breaker.record_failure(time.time()):
+            return
+        logger.warning(
+            "Prerender server %(backend)s is unavailable (%(reason)s); "
+            "requests are sent to other servers for %(timeout)s seconds",
+            {'backend': backend.url, 'reason': reason,
+             'timeout': backend.breaker.reset_timeout},
+            extra={'spider': self.crawler.spider},
+        )
+        self.crawler.stats.inc_value(
+            'prerender/backend/%s/circuit_opened' % backend.url)
+        self.crawler.signals.send_catch_log(
+            signal=prerender_signals.backend_circuit_opened,
+            backend=backend.url,
+            reason=reason,
+        )
+
+    def _backend_circuit_closed(self, backend):
+        logger.info("Prerender server %(backend)s is available again",
+                    {'backend': backend.url},
+                    extra={'spider': self.crawler.spider})
+        self.crawler.stats.inc_value(
+            'prerender/backend/%s/circuit_closed' % backend.url)
+        self.crawler.signals.send_catch_log(
+            signal=prerender_signals.backend_circuit_closed,
+            backend=backend.url,
+        )
+
+    def _probe_backends(self, spider):
+        """
+        Send probe requests to servers with open circuit breakers
+        when their reset timeouts expire.
+        """
+        now = time.time()
+        for backend in self.backend_pool.backends:
+            if backend.breaker is None or not backend.breaker.should_probe(now):
+                continue
+            backend.breaker.half_open()
+            probe = scrapy.Request(
+                urljoin(backend.url, self.probe_path),
+                priority=self.probe_priority_adjust,
+                dont_filter=True,
+                meta={
+                    'dont_retry': True,
+                    'dont_cache': True,
+                    'dont_redirect': True,
+                    'dont_obey_robotstxt': True,
+                    'download_timeout': self.probe_timeout,
+                },
+            )
+            self.crawler.stats.inc_value(
+                'prerender/backend/%s/probe_count' % backend.url)
+            dfd = self.crawler.engine.download(probe, spider)
+            dfd.addCallbacks(self._probe_succeeded, self._probe_failed,
+                             callbackArgs=(backend,), errbackArgs=(backend,))
+
+    def _probe_succeeded(self, response, backend):
+        if response.status in self.backend_failure_statuses:
+            self._backend_failed(backend, 'probe HTTP %s' % response.status)
+        elif backend.breaker.record_success(probe=True):
+            self._backend_circuit_closed(backend)
+
+    def _probe_failed(self, failure, backend):
+        self._backend_failed(backend, 'probe %s' % failure.type.__name__)
+
+    def _change_response_class(self, request, response, cached_data=None):
+        from scrapy_prerender import (
+            PrerenderResponse, PrerenderTextResponse, PrerenderJsonResponse)
+        if cached_data is not None:
+            return response.replace(cls=PrerenderJsonResponse, request=request,
+                                    payload=cached_data)
         if not isinstance(response, (PrerenderResponse, PrerenderTextResponse)):
             # create a custom Response subclass based on response Content-Type
             # XXX: usually request is assigned to response only when all
@@ -451,16 +922,112 @@ class PrerenderMiddleware(object):
             self._remote_keys.pop(fp, None)
             # print('remote_keys after:', self._remote_keys)
 
-        body = json.dumps(args, ensure_ascii=False, sort_keys=True, indent=4)
-        # print(body)
+        headers = request.headers.copy()
+        body = self._encode_body(self.json_serializer(args), headers)
+        self.crawler.stats.inc_value('prerender/request_bytes', len(body))
+        # it is a retry of the same render, like requests from RetryMiddleware
         request = request.replace(
             meta=meta,
             body=body,
-            priority=request.priority+self.retry_498_priority_adjust
+            headers=headers,
+            priority=request.priority+self.retry_498_priority_adjust,
+            dont_filter=True,
         )
         return request
 
-    def _set_download_slot(self, request, meta, slot_policy):
+    def _encode_body(self, body, headers):
+        """
+        Compress request body if request compression is enabled
+        and the body is large enough; update Content-Encoding header.
+        """
+        body = to_bytes(body)
+        headers.pop('Content-Encoding', None)
+        if (self.request_compression is None or
+                len(body) < self.request_compression_min_size):
+            return body
+        headers['Content-Encoding'] = self.request_compression
+        return compress_body(body, self.request_compression,
+                             self.request_compression_level)
+
+    def _record_latency(self, request, response):
+        """
+        Add request timings to latency histograms: 'wait' is time between
+        request processing by PrerenderMiddleware and sending the request
+        to Prerender (time in scheduler queue and capacity waits),
+        'render' is time between sending the request and getting
+        a response, 'total' is their sum.
+        """
+        if self.latency_stats is None or 'cached' in response.flags:
+            return
+        sent_time = request.meta.get('_prerender_sent_time')
+        if sent_time is None:
+            return
+        now = time.time()
+        start_time = request.meta.get('_prerender_start_time', sent_time)
+        timings = [
+            ('wait', sent_time - start_time),
+            ('render', now - sent_time),
+            ('total', now - start_time),
+        ]
+        prefixes = ['prerender',
+                    'prerender/%s' % request.meta['prerender']['endpoint']]
+        backend = request.meta.get('_prerender_backend')
+        if backend is not None:
+            prefixes.append('prerender/backend/%s' % backend)
+        if self.latency_stats_per_domain:
+            domain = urlparse(request.meta['prerender']['args']['url']).hostname
+            prefixes.append('prerender/domain/%s' % domain)
+        for prefix in prefixes:
+            for stage, value in timings:
+                self.latency_stats.add('%s/latency/%s' % (prefix, stage), value)
+
+    def _get_adaptive_slot_key(self, request):
+        policy = request.meta['prerender'].get('slot_policy', self.slot_policy)
+        if policy != SlotPolicy.ADAPTIVE:
+            return None
+        return request.meta.get('download_slot')
+
+    def _request_reached_downloader(self, request, spider):
+        """
+        Set concurrency of an adaptive download slot before the first
+        request is sent, instead of the default Scrapy slot concurrency.
+        """
+        if not request.meta.get('_prerender_processed'):
+            return
+        key = self._get_adaptive_slot_key(request)
+        if key is None:
+            return
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None:
+            slot.concurrency = self.adaptive_concurrency.concurrency(key)
+
+    def _adapt_concurrency(self, request, response=None, exception=None):
+        """ Update concurrency of an adaptive download slot """
+        if response is not None and 'cached' in response.flags:
+            return  # nothing was sent to Prerender
+        key = self._get_adaptive_slot_key(request)
+        if key is None:
+            return
+        now = time.time()
+        if response is not None:
+            decreased = self.adaptive_concurrency.response_received(
+                key, response.status, request.meta.get('download_latency'), now)
+        elif isinstance(exception, self.congestion_exceptions):
+            decreased = self.adaptive_concurrency.congestion(key, now)
+        else:
+            return
+
+        concurrency = self.adaptive_concurrency.concurrency(key)
+        if decreased:
+            self.crawler.stats.inc_value(
+                'prerender/adaptive/%s/decrease_count' % key)
+        self.crawler.stats.set_value(
+            'prerender/adaptive/%s/concurrency' % key, concurrency)
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None:
+            slot.concurrency = concurrency
+
+    def _set_download_slot(self, request, meta, slot_policy, prerender_base_url):
         if slot_policy == SlotPolicy.PER_DOMAIN:
             # Use the same download slot to (sort of) respect download
             # delays and concurrency options.
@@ -474,7 +1041,23 @@ class PrerenderMiddleware(object):
             # Use standard Scrapy concurrency setup
             pass
 
+        elif slot_policy == SlotPolicy.ADAPTIVE:
+            # Use a slot per Prerender server; its concurrency is adjusted
+            # according to render latency and server errors.
+            meta['download_slot'] = '__prerender__%s' % prerender_base_url
+
     def _get_slot_key(self, request_or_response):
-        return self.crawler.engine.downloader._get_slot_key(
-            request_or_response, None
-        )
+        """ Return a download slot key Scrapy downloader would use """
+        if 'download_slot' in request_or_response.meta:
+            return request_or_response.meta['download_slot']
+        key = urlparse_cached(request_or_response).hostname or ''
+        if self.crawler.settings.getint('CONCURRENT_REQUESTS_PER_IP'):
+            key = dnscache.get(key, key)
+        return key
+
+    def _get_slot_concurrency(self, key):
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None:
+            return slot.concurrency
+        return (self.crawler.settings.getint('CONCURRENT_REQUESTS_PER_IP') or
+                self.crawler.settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN'))
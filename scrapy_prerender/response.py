@@ -19,6 +19,22 @@ def get_prerender_headers(resp):
     return getattr(resp, 'prerender_response_headers', resp.headers)
 
 
+def encode_prerender_payload(key, body, binary, data):
+    """
+    Return Prerender JSON response data made of (body key, body, binary
+    values, other data) parts returned by
+    ``scrapy_prerender.cache.decode_prerender_payload``.
+    ``data`` is updated in place.
+    """
+    if key == 'html':
+        data[key] = body.decode('utf8')
+    else:
+        data[key] = base64.b64encode(body).decode('ascii')
+    for name, value in binary.items():
+        data[name] = base64.b64encode(value).decode('ascii')
+    return data
+
+
 class _PrerenderResponseMixin(object):
     """
     This mixin fixes response.url and adds response.real_url
@@ -105,11 +121,17 @@ class PrerenderJsonResponse(PrerenderResponse):
       status is available as ``response.prerender_response_status``;
     * response.body is set to the value of 'html' key,
       or to base64-decoded value of 'body' key;
+
+    ``payload`` argument allows to create a response from already decoded
+    JSON data parts (e.g. stored in HTTP cache, see
+    ``scrapy_prerender.cache.decode_prerender_payload``) instead of
+    the body; ``response.data`` is built from them on first access.
     """
     def __init__(self, *args, **kwargs):
         self.cookiejar = None
         self._cached_ubody = None
         self._cached_data = None
+        self._payload = kwargs.pop('payload', None)
         self._cached_selector = None
         kwargs.pop('encoding', None)  # encoding is always utf-8
         super(PrerenderJsonResponse, self).__init__(*args, **kwargs)
@@ -121,7 +143,11 @@ class PrerenderJsonResponse(PrerenderResponse):
     @property
     def data(self):
         if self._cached_data is None:
-            self._cached_data = json.loads(self._ubody)
+            if self._payload is not None:
+                self._cached_data = encode_prerender_payload(*self._payload)
+                self._payload = None
+            else:
+                self._cached_data = json.loads(self._ubody)
         return self._cached_data
 
     @property
@@ -155,14 +181,21 @@ class PrerenderJsonResponse(PrerenderResponse):
 
     def _load_from_json(self):
         """ Fill response attributes from JSON results """
+        if self._payload is not None:
+            # other data is enough, base64 values are not encoded again
+            key, body, _, data = self._payload
+        else:
+            data = self.data
+            key = next((k for k in ('body', 'html') if k in data), None)
+            body = None
 
         # response.status
-        if 'http_status' in self.data:
-            self.status = int(self.data['http_status'])
+        if 'http_status' in data:
+            self.status = int(data['http_status'])
         elif self._prerender_options().get('http_status_from_error_code', False):
-            if 'error' in self.data:
+            if 'error' in data:
                 try:
-                    error = self.data['info']['error']
+                    error = data['info']['error']
                 except KeyError:
                     error = ''
                 http_code_m = re.match(r'http(\d{3})', error)
@@ -170,18 +203,25 @@ class PrerenderJsonResponse(PrerenderResponse):
                     self.status = int(http_code_m.group(1))
 
         # response.url
-        if 'url' in self.data:
-            self._url = self.data['url']
+        if 'url' in data:
+            self._url = data['url']
 
         # response.body
-        if 'body' in self.data:
-            self._body = base64.b64decode(self.data['body'])
+        if key == 'body':
+            if body is not None:
+                self._body = body
+            else:
+                self._body = base64.b64decode(data['body'])
             self._cached_ubody = self._body.decode(self.encoding)
-        elif 'html' in self.data:
-            self._cached_ubody = self.data['html']
-            self._body = self._cached_ubody.encode(self.encoding)
+        elif key == 'html':
+            if body is not None:
+                # decoded on first access
+                self._body = body
+            else:
+                self._cached_ubody = data['html']
+                self._body = self._cached_ubody.encode(self.encoding)
             self.headers[b"Content-Type"] = b"text/html; charset=utf-8"
 
         # response.headers
-        if 'headers' in self.data:
-            self.headers = headers_to_scrapy(self.data['headers'])
+        if 'headers' in data:
+            self.headers = headers_to_scrapy(data['headers'])
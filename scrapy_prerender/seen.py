@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-compact containers for request fingerprints, used by
+PrerenderAwareDupeFilter instead of a Python set of hex strings.
+
+Both containers store binary digests (e.g. ``binascii.unhexlify(fp)``);
+``add(digest)`` returns True if the digest wasn't seen before.
+"""
+from __future__ import absolute_import
+import math
+import mmap
+import os
+import struct
+import tempfile
+
+from .utils import replace_file
+
+
+# first 8 bytes of a digest are used as a hash table index
+_INDEX = struct.Struct('<Q')
+_BLOOM_HASHES = struct.Struct('<QQ')
+
+
+def _check_digest_size(digest_size):
+    if not 8 <= digest_size <= 64:
+        raise ValueError("digest_size must be from 8 to 64 bytes")
+
+
+def _check_magic(magic, expected, path):
+    if magic != expected:
+        raise ValueError("%s is not a %r file" % (path, expected))
+
+
+class DigestTable(object):
+    """
+    A set of fixed-size binary digests stored in an open-addressing hash
+    table with linear probing, backed by a single bytearray. It takes
+    ``digest_size`` bytes per slot, and the table is kept from 35% to 70%
+    full, i.e. 1.4x-3x ``digest_size`` bytes per digest, compared to
+    ~130 bytes per 40-char hex string in a Python set.
+
+    Digests longer than ``digest_size`` are truncated; the all-zeros value
+    marks empty slots, so an all-zeros digest is stored as ``...\\x01``.
+
+    >>> table = DigestTable(digest_size=16)
+    >>> table.add(b'0123456789abcdef0123')
+    True
+    >>> table.add(b'0123456789abcdef')
+    False
+    >>> len(table), b'0123456789abcdefXXXX' in table
+    (1, True)
+    """
+    max_load = 0.7
+    magic = b'PRDT'
+    # magic, format version, digest size, capacity, number of digests
+    header = struct.Struct('<4sBB2xQQ8x')
+    format_version = 1
+
+    def __init__(self, digest_size=16, capacity=1024):
+        _check_digest_size(digest_size)
+        self.digest_size = digest_size
+        self._empty = b'\x00' * digest_size
+        self._count = 0
+        self._set_capacity(self.slots_for(capacity))
+        self._slots = self._allocate(self._capacity)
+
+    @classmethod
+    def slots_for(cls, capacity):
+        """ Return a number of slots needed to store ``capacity`` digests """
+        slots = 8
+        while slots * cls.max_load < capacity:
+            slots *= 2
+        return slots
+
+    def _set_capacity(self, slots):
+        self._capacity = slots
+        self._mask = slots - 1
+        self._max_count = int(slots * self.max_load)
+
+    def _allocate(self, slots):
+        return bytearray(slots * self.digest_size)
+
+    def _normalize(self, digest):
+        digest = bytes(digest[:self.digest_size])
+        if len(digest) != self.digest_size:
+            raise ValueError("Digest is shorter than %d bytes" % self.digest_size)
+        if digest == self._empty:
+            digest = digest[:-1] + b'\x01'
+        return digest
+
+    def _find(self, digest):
+        """ Return (offset of the digest or of an empty slot, found) """
+        size = self.digest_size
+        slots = self._slots
+        mask = self._mask
+        empty = self._empty
+        i = _INDEX.unpack_from(digest)[0] & mask
+        while True:
+            offset = i * size
+            current = slots[offset:offset + size]
+            if current == digest:
+                return offset, True
+            if current == empty:
+                return offset, False
+            i = (i + 1) & mask
+
+    def __contains__(self, digest):
+        return self._find(self._normalize(digest))[1]
+
+    def __len__(self):
+        return self._count
+
+    def add(self, digest):
+        digest = self._normalize(digest)
+        offset, found = self._find(digest)
+        if found:
+            return False
+        self._slots[offset:offset + self.digest_size] = digest
+        self._count += 1
+        if self._count > self._max_count:
+            self._resize(self._capacity * 2)
+        return True
+
+    def __iter__(self):
+        size = self.digest_size
+        slots = self._slots
+        for offset in range(0, self._capacity * size, size):
+            digest = bytes(slots[offset:offset + size])
+            if digest != self._empty:
+                yield digest
+
+    def _resize(self, slots):
+        old_slots, old_capacity = self._slots, self._capacity
+        self._set_capacity(slots)
+        self._slots = self._allocate(slots)
+        self._rehash(old_slots, old_capacity)
+
+    def _rehash(self, old_slots, old_capacity):
+        """ Copy digests from ``old_slots`` buffer to the table """
+        size = self.digest_size
+        slots = self._slots
+        empty = self._empty
+        for old_offset in range(0, old_capacity * size, size):
+            digest = old_slots[old_offset:old_offset + size]
+            if digest != empty:
+                offset = self._find(digest)[0]
+                slots[offset:offset + size] = digest
+
+    def memory_usage(self):
+        """ Estimated memory usage, bytes """
+        return self._capacity * self.digest_size
+
+    def save(self, path):
+        """
+        Write the table to a file in DigestTable format (for subclasses too);
+        the file is replaced atomically.
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(DigestTable.header.pack(
+                DigestTable.magic, DigestTable.format_version,
+                self.digest_size, self._capacity, self._count))
+            f.write(self._slots)
+        replace_file(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            magic, version, digest_size, slots, count = cls.header.unpack(
+                f.read(cls.header.size))
+            _check_magic(magic, cls.magic, path)
+            table = cls(digest_size)
+            table._set_capacity(slots)
+            table._slots = table._allocate(slots)
+            if f.readinto(table._slots) != len(table._slots):
+                raise ValueError("%s is truncated" % path)
+        table._count = count
+        return table
+
+
+class MmapDigestTable(DigestTable):
+    """
+    DigestTable stored in a memory-mapped file at ``path`` (a temporary
+    file if ``path`` is None). An existing file is opened without reading
+    it: the OS loads pages of the table when they are accessed and writes
+    changed pages back, so even a large table opens instantly.
+
+    The file is flushed every ``flush_every`` added digests and when the
+    table is closed. A table which wasn't closed properly is still usable
+    (only digests added after the last flush can be lost on OS crash),
+    but its size is recounted when it is opened.
+    """
+    magic = b'PRDM'
+    # magic, format version, digest size, clean flag, capacity, count
+    header = struct.Struct('<4sBB?xQQ8x')
+    # mmap offset must be a multiple of the allocation granularity
+    data_offset = mmap.ALLOCATIONGRANULARITY
+
+    def __init__(self, path=None, digest_size=16, capacity=1024,
+                 flush_every=10000):
+        self.path = path
+        self.flush_every = flush_every
+        self._unflushed = 0
+        if path is not None and os.path.exists(path):
+            self._open(path)
+        else:
+            _check_digest_size(digest_size)
+            self.digest_size = digest_size
+            self._empty = b'\x00' * digest_size
+            self._count = 0
+            self._set_capacity(self.slots_for(capacity))
+            self._file, self._slots = self._create(path, self._capacity)
+        self._write_header(clean=False)
+
+    def _open(self, path):
+        self._file = open(path, 'r+b')
+        magic, version, digest_size, clean, slots, count = self.header.unpack(
+            self._file.read(self.header.size))
+        _check_magic(magic, self.magic, path)
+        self.digest_size = digest_size
+        self._empty = b'\x00' * digest_size
+        self._set_capacity(slots)
+        self._slots = mmap.mmap(self._file.fileno(), slots * digest_size,
+                                offset=self.data_offset)
+        self._count = count if clean else sum(1 for _ in self)
+
+    def _create(self, path, slots):
+        f = open(path, 'w+b') if path is not None else tempfile.TemporaryFile()
+        f.truncate(self.data_offset + slots * self.digest_size)
+        return f, mmap.mmap(f.fileno(), slots * self.digest_size,
+                            offset=self.data_offset)
+
+    def _write_header(self, clean):
+        self._file.seek(0)
+        self._file.write(self.header.pack(
+            self.magic, self.format_version, self.digest_size, clean,
+            self._capacity, self._count))
+        self._file.flush()
+
+    def add(self, digest):
+        added = super(MmapDigestTable, self).add(digest)
+        if added:
+            self._unflushed += 1
+            if self._unflushed >= self.flush_every:
+                self.flush()
+        return added
+
+    def _resize(self, slots):
+        # the table is rebuilt in a new file which replaces the old one
+        old_file, old_slots, old_capacity = self._file, self._slots, self._capacity
+        tmp_path = self.path + '.tmp' if self.path is not None else None
+        self._set_capacity(slots)
+        self._file, self._slots = self._create(tmp_path, slots)
+        self._rehash(old_slots, old_capacity)
+        old_slots.close()
+        old_file.close()
+        if tmp_path is not None:
+            replace_file(tmp_path, self.path)
+        self.flush()
+
+    def flush(self):
+        self._slots.flush()
+        self._write_header(clean=False)
+        self._unflushed = 0
+
+    def close(self):
+        self._slots.flush()
+        self._write_header(clean=True)
+        self._slots.close()
+        self._file.close()
+
+    @classmethod
+    def load(cls, path):
+        return cls(path)
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter for binary digests (16 bytes or longer) with a given
+    ``capacity`` and false positive rate ``error_rate`` at full capacity.
+    Bit positions are derived from the digest (double hashing), so
+    digests must be uniformly distributed, like SHA1 fingerprints are.
+    """
+    header = struct.Struct('<QQQBd')  # capacity, count, bits, hashes, error
+
+    def __init__(self, capacity, error_rate):
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        self.capacity = max(1, int(capacity))
+        self.error_rate = error_rate
+        self.count = 0
+        self.num_bits = int(math.ceil(
+            -self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(
+            self.num_bits / float(self.capacity) * math.log(2))))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, digest):
+        h1, h2 = _BLOOM_HASHES.unpack_from(digest)
+        h2 |= 1
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, digest):
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(digest))
+
+    def add(self, digest):
+        """ Add a digest; return False if it is (probably) present already """
+        bits = self._bits
+        added = False
+        for pos in self._positions(digest):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def memory_usage(self):
+        return len(self._bits)
+
+    def write(self, f):
+        f.write(self.header.pack(self.capacity, self.count, self.num_bits,
+                                 self.num_hashes, self.error_rate))
+        f.write(self._bits)
+
+    @classmethod
+    def read(cls, f):
+        capacity, count, num_bits, num_hashes, error_rate = cls.header.unpack(
+            f.read(cls.header.size))
+        bloom = cls(capacity, error_rate)
+        bloom.count = count
+        bloom.num_bits = num_bits
+        bloom.num_hashes = num_hashes
+        bloom._bits = bytearray((num_bits + 7) // 8)
+        if f.readinto(bloom._bits) != len(bloom._bits):
+            raise ValueError("Bloom filter data is truncated")
+        return bloom
+
+
+class ScalableBloomFilter(object):
+    """
+    A Bloom filter which grows as needed (Almeida et al., 2007): when the
+    current filter is full a new one is added, ``growth`` times larger,
+    with a ``tightening`` times smaller false positive rate, so that
+    the overall false positive rate stays below ``error_rate``.
+
+    A false positive means that a new request is filtered as a duplicate.
+
+    >>> seen = ScalableBloomFilter(error_rate=0.001, initial_capacity=100)
+    >>> seen.add(b'0123456789abcdef0123')
+    True
+    >>> seen.add(b'0123456789abcdef0123')
+    False
+    """
+    magic = b'PRBF'
+    # magic, format version, growth, error rate, tightening, filter count
+    header = struct.Struct('<4sBB2xddI')
+    format_version = 1
+
+    def __init__(self, error_rate=0.001, initial_capacity=100000, growth=2,
+                 tightening=0.5):
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        if not 0 < tightening < 1:
+            raise ValueError("tightening must be between 0 and 1")
+        self.error_rate = error_rate
+        self.initial_capacity = max(1, int(initial_capacity))
+        self.growth = int(growth)
+        self.tightening = tightening
+        self.filters = []
+
+    def _add_filter(self):
+        n = len(self.filters)
+        self.filters.append(BloomFilter(
+            capacity=self.initial_capacity * self.growth ** n,
+            error_rate=self.error_rate * (1 - self.tightening) * self.tightening ** n,
+        ))
+
+    def __contains__(self, digest):
+        return any(digest in bloom for bloom in self.filters)
+
+    def __len__(self):
+        return sum(bloom.count for bloom in self.filters)
+
+    def add(self, digest):
+        if any(digest in bloom for bloom in self.filters[:-1]):
+            return False
+        if self.filters:
+            current = self.filters[-1]
+            if current.count < current.capacity:
+                return current.add(digest)
+            if digest in current:
+                return False
+        self._add_filter()
+        return self.filters[-1].add(digest)
+
+    def memory_usage(self):
+        """ Estimated memory usage, bytes """
+        return sum(bloom.memory_usage() for bloom in self.filters)
+
+    def save(self, path):
+        """ Write filters to a file; the file is replaced atomically """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.header.pack(self.magic, self.format_version,
+                                     self.growth, self.error_rate,
+                                     self.tightening, len(self.filters)))
+            f.write(struct.pack('<Q', self.initial_capacity))
+            for bloom in self.filters:
+                bloom.write(f)
+        replace_file(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            magic, version, growth, error_rate, tightening, n = cls.header.unpack(
+                f.read(cls.header.size))
+            _check_magic(magic, cls.magic, path)
+            initial_capacity, = struct.unpack('<Q', f.read(8))
+            seen = cls(error_rate, initial_capacity, growth, tightening)
+            seen.filters = [BloomFilter.read(f) for _ in range(n)]
+        return seen
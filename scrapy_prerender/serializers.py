@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Serializers for JSON bodies of requests sent to Prerender.
+
+The serializer only affects the wire format. Request fingerprints
+(see ``prerender_request_fingerprint``) are computed from a canonical
+serialization of Prerender arguments, so switching serializers doesn't
+invalidate dupefilter state or HTTP cache entries.
+"""
+from __future__ import absolute_import
+import json
+
+from scrapy.utils.misc import load_object
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_compact(args):
+    """ Compact JSON without extra whitespace; keys are not sorted. """
+    return json.dumps(args, ensure_ascii=False, separators=(',', ':'))
+
+
+def json_pretty(args):
+    """
+    Sorted and indented JSON. This is the format scrapy-prerender used
+    for request bodies before serializers became configurable.
+    """
+    return json.dumps(args, ensure_ascii=False, sort_keys=True, indent=4)
+
+
+def orjson_compact(args):
+    """ Compact JSON built by orjson; it requires orjson package. """
+    return orjson.dumps(args, option=orjson.OPT_NON_STR_KEYS)
+
+
+JSON_SERIALIZERS = {
+    'json': json_compact,
+    'pretty': json_pretty,
+    'orjson': orjson_compact,
+}
+
+
+def get_json_serializer(name):
+    """
+    Return a serializer function for ``name``. ``name`` can be one of
+    JSON_SERIALIZERS keys, 'auto' (orjson if it is installed, json otherwise),
+    a callable or an import path of a callable.
+
+    >>> get_json_serializer('json')({"url": "http://example.com", "wait": 0.5})
+    '{"url":"http://example.com","wait":0.5}'
+    """
+    if callable(name):
+        return name
+    if name == 'auto':
+        name = 'json' if orjson is None else 'orjson'
+    if name == 'orjson' and orjson is None:
+        raise ValueError("orjson JSON serializer requires orjson package")
+    if name in JSON_SERIALIZERS:
+        return JSON_SERIALIZERS[name]
+    return load_object(name)
+
+
+def canonical_json(args):
+    """
+    Serialization of Prerender arguments used for request fingerprints.
+    It must never change, otherwise existing fingerprints become invalid.
+    """
+    return json_pretty(args)
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+Signals sent by scrapy-prerender. Connect to them using
+``crawler.signals.connect(handler, signal=...)``.
+"""
+
+# Sent when a circuit breaker of a Prerender server opens, i.e. the server
+# stops receiving requests. Arguments: backend (server URL), reason.
+backend_circuit_opened = object()
+
+# Sent when a circuit breaker of a Prerender server closes after
+# a successful probe, i.e. the server receives requests again.
+# Arguments: backend (server URL).
+backend_circuit_closed = object()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming latency statistics for Prerender requests.
+"""
+from __future__ import absolute_import
+import math
+
+
+class LatencyHistogram(object):
+    """
+    Histogram with logarithmic buckets. Percentiles are estimated with
+    ``precision`` relative error; memory usage depends only on the range of
+    values, not on their number (~800 buckets for 1ms...1h with 2% precision).
+
+    >>> h = LatencyHistogram()
+    >>> for i in range(1, 101):
+    ...     h.add(i / 10.0)
+    >>> h.count, h.max
+    (100, 10.0)
+    >>> abs(h.percentile(50) - 5.0) < 0.1
+    True
+    """
+    def __init__(self, precision=0.02, min_value=0.001):
+        self.min_value = min_value
+        self._log_base = math.log(1 + precision)
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        if value < self.min_value:
+            value = self.min_value
+        bucket = int(math.log(value / self.min_value) / self._log_base)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def copy(self):
+        histogram = LatencyHistogram(min_value=self.min_value)
+        histogram._log_base = self._log_base
+        histogram.merge(self)
+        return histogram
+
+    def since(self, previous):
+        """
+        Return a histogram of values added after ``previous`` (an earlier
+        copy of this histogram) was taken. ``max`` of the result is
+        an upper bound, not an exact value.
+
+        >>> h = LatencyHistogram()
+        >>> h.add(1.0)
+        >>> old = h.copy()
+        >>> h.add(2.0)
+        >>> h.since(old).count
+        1
+        """
+        histogram = LatencyHistogram(min_value=self.min_value)
+        histogram._log_base = self._log_base
+        for bucket, count in self.buckets.items():
+            count -= previous.buckets.get(bucket, 0)
+            if count:
+                histogram.buckets[bucket] = count
+        histogram.count = self.count - previous.count
+        histogram.total = self.total - previous.total
+        histogram.max = self.max
+        return histogram
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """ Return an estimate of p-th percentile (0 < p <= 100) """
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                # geometric middle of the bucket
+                value = self.min_value * math.exp((bucket + 0.5) * self._log_base)
+                return min(value, self.max)
+        return self.max
+
+
+class LatencyStats(object):
+    """
+    A set of named latency histograms. Histograms are created on demand,
+    but no more than ``max_histograms`` of them are kept; values for
+    other names are dropped.
+    """
+    percentiles = (50, 95, 99)
+
+    def __init__(self, max_histograms=10000):
+        self.max_histograms = max_histograms
+        self.histograms = {}
+
+    def add(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            if len(self.histograms) >= self.max_histograms:
+                return
+            histogram = self.histograms[name] = LatencyHistogram()
+        histogram.add(value)
+
+    def get(self, name):
+        return self.histograms.get(name)
+
+    def summary(self, name):
+        """ Return a dict with count, mean, max and percentiles """
+        histogram = self.histograms[name]
+        result = {
+            'count': histogram.count,
+            'mean': round(histogram.mean, 4),
+            'max': round(histogram.max, 4),
+        }
+        for p in self.percentiles:
+            result['p%d' % p] = round(histogram.percentile(p), 4)
+        return result
+
+    def to_stats(self, stats, spider=None):
+        """ Put summaries of all histograms to Scrapy stats """
+        for name in self.histograms:
+            for key, value in self.summary(name).items():
+                stats.set_value('%s/%s' % (name, key), value, spider=spider)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrency control for Prerender requests.
+"""
+from __future__ import absolute_import
+from collections import deque
+
+from twisted.internet import defer
+
+
+class _SlotState(object):
+    def __init__(self, concurrency):
+        self.concurrency = float(concurrency)
+        self.latency = None  # smoothed latency of healthy responses
+        self.last_decrease = None
+
+
+class AdaptiveConcurrency(object):
+    """
+    Additive increase / multiplicative decrease (AIMD) concurrency
+    controller, similar to TCP congestion control.
+
+    While render latency stays close to its usual value, concurrency
+    of a slot grows by ``increase`` per ``concurrency`` successful
+    responses, i.e. roughly by ``increase`` per "round" of requests.
+    Latency spikes (latency is more than ``latency_tolerance`` times
+    larger than usual), HTTP 429/503/504 responses and timeouts mean
+    the server queues requests; concurrency is multiplied by
+    ``decrease_factor`` then, at most once per ``cooldown`` seconds.
+    The usual latency is a moving average of all latencies, so it
+    adapts to permanent latency changes.
+    """
+    congestion_statuses = {429, 503, 504}
+    latency_smoothing = 0.1
+
+    def __init__(self, min_concurrency=1, max_concurrency=32,
+                 start_concurrency=4, increase=1.0, decrease_factor=0.5,
+                 latency_tolerance=2.0, cooldown=1.0):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.start_concurrency = start_concurrency
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.slots = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            min_concurrency=settings.getint(
+                'PRERENDER_ADAPTIVE_MIN_CONCURRENCY', 1),
+            max_concurrency=settings.getint(
+                'PRERENDER_ADAPTIVE_MAX_CONCURRENCY', 32),
+            start_concurrency=settings.getint(
+                'PRERENDER_ADAPTIVE_START_CONCURRENCY', 4),
+            increase=settings.getfloat('PRERENDER_ADAPTIVE_INCREASE', 1.0),
+            decrease_factor=settings.getfloat(
+                'PRERENDER_ADAPTIVE_DECREASE_FACTOR', 0.5),
+            latency_tolerance=settings.getfloat(
+                'PRERENDER_ADAPTIVE_LATENCY_TOLERANCE', 2.0),
+            cooldown=settings.getfloat('PRERENDER_ADAPTIVE_COOLDOWN', 1.0),
+        )
+
+    def _get_state(self, key):
+        if key not in self.slots:
+            self.slots[key] = _SlotState(self.start_concurrency)
+        return self.slots[key]
+
+    def concurrency(self, key):
+        """ Current concurrency of a slot """
+        return int(self._get_state(key).concurrency)
+
+    def response_received(self, key, status, latency, now):
+        """
+        Update slot concurrency using a response status and latency.
+        Return True if concurrency is decreased.
+        """
+        if status in self.congestion_statuses:
+            return self.congestion(key, now)
+        if latency is None:
+            return False
+
+        state = self._get_state(key)
+        if state.latency is None:
+            state.latency = latency
+            spike = False
+        else:
+            spike = latency > state.latency * self.latency_tolerance
+            # spikes are also taken into account, so that the usual latency
+            # follows a permanent latency change instead of keeping
+            # concurrency at its minimum
+            state.latency += self.latency_smoothing * (latency - state.latency)
+        if spike:
+            return self.congestion(key, now)
+
+        state.concurrency = min(
+            self.max_concurrency,
+            state.concurrency + self.increase / state.concurrency
+        )
+        return False
+
+    def congestion(self, key, now):
+        """
+        Decrease slot concurrency because of a queueing signal
+        (e.g. a timeout). Return True if concurrency is decreased.
+        """
+        state = self._get_state(key)
+        if (state.last_decrease is not None and
+                now - state.last_decrease < self.cooldown):
+            return False
+        state.last_decrease = now
+        state.concurrency = max(self.min_concurrency,
+                                state.concurrency * self.decrease_factor)
+        return True
+
+
+class CapacityGate(object):
+    """
+    Admission control with several levels of accounting.
+
+    A request holds one unit of capacity for each of its keys
+    (e.g. a download slot of the target domain and a Prerender server).
+    It is let through only when all keys have room; otherwise it waits
+    until other requests release their capacity. Released capacity goes
+    to waiting requests first, in FIFO order.
+    """
+    def __init__(self):
+        self.active = {}
+        self.waiting = deque()
+
+    def _fits(self, limits):
+        return all(self.active.get(key, 0) < limit for key, limit in limits)
+
+    def _take(self, limits):
+        for key, limit in limits:
+            self.active[key] = self.active.get(key, 0) + 1
+
+    def acquire(self, limits):
+        """
+        ``limits`` is a list of (key, limit) tuples. Return None if
+        capacity is acquired, or a Deferred which fires when it is acquired.
+        """
+        if self._fits(limits):
+            self._take(limits)
+            return None
+        dfd = defer.Deferred(self._cancel)
+        self.waiting.append((dfd, limits))
+        return dfd
+
+    def _cancel(self, dfd):
+        self.waiting = deque(item for item in self.waiting
+                             if item[0] is not dfd)
+
+    def cancel_all(self):
+        """
+        Cancel all waiting requests; their Deferreds fail
+        with CancelledError.
+        """
+        for dfd, limits in list(self.waiting):
+            dfd.cancel()
+
+    def release(self, keys):
+        for key in keys:
+            self.active[key] -= 1
+            if not self.active[key]:
+                del self.active[key]
+
+        # a key which is full for a waiting request stays blocked
+        # for requests behind it, to keep FIFO order
+        blocked = set()
+        admitted = []
+        waiting = deque()
+        for dfd, limits in self.waiting:
+            full = {key for key, limit in limits
+                    if key in blocked or self.active.get(key, 0) >= limit}
+            if full:
+                blocked |= full
+                waiting.append((dfd, limits))
+            else:
+                self._take(limits)
+                admitted.append(dfd)
+        self.waiting = waiting
+        for dfd in admitted:
+            dfd.callback(None)
@@ -2,6 +2,12 @@
 from __future__ import absolute_import
 import json
 import hashlib
+import os
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+
 import six
 
 from scrapy.http import Headers
@@ -21,6 +27,16 @@ except ImportError:
             return to_unicode(text, encoding, errors)
 
 
+def replace_file(src, dst):
+    """ Rename ``src`` to ``dst``, replacing ``dst`` if it exists """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:  # Python 2
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
 def dict_hash(obj, start=''):
     """ Return a hash for a dict, based on its contents """
     h = hashlib.sha1(to_bytes(start))
@@ -48,29 +64,175 @@ def dict_hash(obj, start=''):
     return h.hexdigest()
 
 
-def _process(value, sha=False):
+def _json_default(value):
+    if isinstance(value, bytes):
+        return {'__bytes__': value.decode('latin1')}
+    raise TypeError("Unsupported value type: %s" % value.__class__)
+
+
+_canonical_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'),
+                                      check_circular=False,
+                                      default=_json_default)
+
+
+def streaming_dict_hash(obj, start=''):
+    """
+    Return a hash for a dict, based on its contents. Unlike ``dict_hash``
+    it walks the structure once, serializing it to a canonical
+    (sorted, compact, ASCII-only) JSON stream which is fed to a single
+    hasher, so it is much faster for large nested values.
+    Lists and tuples are not distinguished.
+
+    >>> streaming_dict_hash({"foo": "bar", "bar": [1, 2.5, None, True]})
+    'e699e9ba3449b856aa41fafaeb0469c6a496f905'
+    """
+    h = hashlib.sha1(to_bytes(start))
+    try:
+        h.update(_canonical_encoder.encode(obj).encode('ascii'))
+    except TypeError as e:
+        raise ValueError(str(e))
+    return h.hexdigest()
+
+
+def _get_stable_hash():
+    """
+    Return (name, function) of the fastest available process-stable hash
+    function for bytes: xxh3_128 from xxhash package, or SHA1, which is
+    hardware-accelerated on modern CPUs and often faster than blake2b.
+    """
+    try:
+        import xxhash
+        return 'xxh3', lambda data: xxhash.xxh3_128(data).hexdigest()
+    except (ImportError, AttributeError):
+        return 'sha1', lambda data: hashlib.sha1(data).hexdigest()
+
+
+_stable_hash_name, _stable_hash = _get_stable_hash()
+
+
+def _process(value, sha=False, stable=False):
     if isinstance(value, (six.text_type, bytes)):
         if sha:
             return hashlib.sha1(to_bytes(value)).hexdigest()
+        if stable:
+            return _stable_hash_name, _stable_hash(to_bytes(value))
         return 'h', hash(value)
     if isinstance(value, dict):
-        return {_process(k, sha=True): _process(v, sha) for k, v in value.items()}
+        return {_process(k, sha=True): _process(v, sha, stable)
+                for k, v in value.items()}
     if isinstance(value, (list, tuple)):
-        return [_process(v, sha) for v in value]
+        return [_process(v, sha, stable) for v in value]
     return value
 
 
-def _fast_hash(value):
+def _fast_hash(value, stable=False):
     """
-    Return a hash for any JSON-serializable value.
-    Hash is not guaranteed to be the same in different Python processes,
-    but it is very fast to compute for data structures with large string
-    values.
+    Return a hash for any JSON-serializable value. It is very fast to
+    compute for data structures with large string values: Python caches
+    hashes of strings. Hash is not guaranteed to be the same in different
+    Python processes; pass ``stable=True`` to get a hash which is the same
+    in all processes (it depends on the hash function used for strings,
+    and it is faster than ``json_based_hash`` only if xxhash is installed).
+    """
+    return _json_based_hash(_process(value, stable=stable))
+
+
+class HashCache(object):
+    """
+    Thread-safe LRU cache for ``json_based_hash`` results, limited
+    by a number of entries and (optionally) by estimated memory usage.
+
+    >>> cache = HashCache(max_entries=2)
+    >>> cache.set('a', '1'); cache.set('b', '2'); cache.set('c', '3')
+    >>> cache.get('a'), cache.get('c'), len(cache), cache.evictions
+    (None, '3', 2, 1)
     """
-    return _json_based_hash(_process(value))
+    # OrderedDict node and hash table slot, approximately
+    entry_overhead = 100
+
+    def __init__(self, max_entries=10000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _entry_size(self, key, value):
+        return sys.getsizeof(key) + sys.getsizeof(value) + self.entry_overhead
+
+    def get(self, key):
+        """ Return a cached value or None; hit/miss counters are updated """
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # move to the end: the most recently used
+            del self._data[key]
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            old_value = self._data.pop(key, None)
+            if old_value is not None:
+                self.bytes -= self._entry_size(key, old_value)
+            self._data[key] = value
+            self.bytes += self._entry_size(key, value)
+            self._evict()
+
+    def set_limits(self, max_entries=None, max_bytes=None):
+        with self._lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self._data and (
+                (self.max_entries is not None and len(self._data) > self.max_entries) or
+                (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            key, value = self._data.popitem(last=False)
+            self.bytes -= self._entry_size(key, value)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def save(self, path):
+        """
+        Save cached entries to a JSON file; the file is replaced atomically.
+        Keys must be process-stable (see ``_fast_hash``); entries with other
+        keys are saved too, but they are never used after loading.
+        """
+        with self._lock:
+            items = list(self._data.items())
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(items, f)
+        replace_file(tmp_path, path)
+
+    def load(self, path):
+        """ Add entries from a file created by ``save``; return their count """
+        with open(path) as f:
+            items = json.load(f)
+        for key, value in items:
+            self.set(key, value)
+        return len(items)
+
+
+# fast hash => hash; PrerenderDeduplicateArgsMiddleware uses its own cache
+_hash_cache = HashCache()
 
 
-_hash_cache = {}  # fast hash => hash
 def json_based_hash(value):
     """
     Return a hash for any JSON-serializable value.
@@ -78,10 +240,25 @@ def json_based_hash(value):
     >>> json_based_hash({"foo": "bar", "baz": [1, 2]})
     '0570066939bea46c610bfdc35b20f37ef09d05ed'
     """
-    fp = _fast_hash(value)
-    if fp not in _hash_cache:
-        _hash_cache[fp] = _json_based_hash(_process(value, sha=True))
-    return _hash_cache[fp]
+    return _cached_json_based_hash(value)[0]
+
+
+def _cached_json_based_hash(value, stable=False, cache=None):
+    """
+    Return (json_based_hash(value), True if it was cached) tuple.
+    Pass ``stable=True`` if the cache is going to be saved and used
+    by other processes. ``cache`` is a HashCache (module-level one
+    by default).
+    """
+    if cache is None:
+        cache = _hash_cache
+    fp = _fast_hash(value, stable=stable)
+    result = cache.get(fp)
+    if result is not None:
+        return result, True
+    result = _json_based_hash(_process(value, sha=True))
+    cache.set(fp, result)
+    return result, False
 
 
 def _json_based_hash(value):
@@ -89,6 +266,26 @@ def _json_based_hash(value):
     return hashlib.sha1(v).hexdigest()
 
 
+def compress_body(body, content_encoding, level=6):
+    """
+    Compress request body using 'gzip' or 'deflate' content coding.
+
+    >>> body = b'{"url": "http://example.com"}' * 10
+    >>> zlib.decompress(compress_body(body, 'gzip'), 16 + zlib.MAX_WBITS) == body
+    True
+    >>> zlib.decompress(compress_body(body, 'deflate')) == body
+    True
+    """
+    if content_encoding == 'gzip':
+        wbits = 16 + zlib.MAX_WBITS
+    elif content_encoding == 'deflate':
+        wbits = zlib.MAX_WBITS
+    else:
+        raise ValueError("Unsupported content encoding: %r" % content_encoding)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(to_bytes(body)) + compressor.flush()
+
+
 def headers_to_scrapy(headers):
     """
     Return scrapy.http.Headers instance from headers data.
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A stand-in Prerender server for tests and load tests. It doesn't run
+a browser and doesn't fetch websites: responses are generated from request
+arguments, after a random delay.
+
+It supports render.html, render.json and execute endpoints, save_args and
+load_args (with HTTP 498 responses for unknown or forgotten arguments),
+cookies (cookies sent by a client are returned back together with
+a ``mock_visits`` counter cookie), random HTTP 503 errors and a _ping
+endpoint. Run it as a separate process::
+
+    python -m tests.mockprerender --port 8050 --latency 0.2 --error-rate 0.01
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import hashlib
+import json
+import random
+import sys
+import zlib
+
+import six
+from six.moves.urllib.parse import urlparse
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+
+from scrapy_prerender.utils import to_bytes, to_unicode
+
+
+LATENCY_DISTRIBUTIONS = {
+    'fixed': lambda rnd, mean: mean,
+    'uniform': lambda rnd, mean: rnd.uniform(0, 2 * mean),
+    'exponential': lambda rnd, mean: rnd.expovariate(1.0 / mean) if mean else 0,
+    # median is ``mean``, with a long tail
+    'lognormal': lambda rnd, mean: rnd.lognormvariate(0, 0.5) * mean,
+}
+
+
+def _make_html(url, size):
+    head = u'<html><head><title>%s</title></head><body>\n' % url
+    tail = u'</body></html>'
+    row = u'<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>\n'
+    rows = max(0, size - len(head) - len(tail)) // len(row)
+    return head + row * rows + tail
+
+
+def _arg_key(value):
+    return hashlib.sha1(to_bytes(json.dumps(value, sort_keys=True))).hexdigest()
+
+
+class MockPrerender(Resource, object):
+    """
+    Twisted resource emulating Prerender HTTP API. ``error_rate`` is
+    a share of requests answered with HTTP 503; ``forget_rate`` is
+    a probability that saved arguments are evicted before a request
+    which loads them, so that HTTP 498 is returned.
+    """
+    isLeaf = True
+    endpoints = {'render.html', 'render.json', 'execute'}
+
+    def __init__(self, latency=0.0, latency_distribution='fixed',
+                 error_rate=0.0, forget_rate=0.0, payload_size=10 * 1024,
+                 seed=None):
+        super(MockPrerender, self).__init__()
+        self.latency = latency
+        self.latency_distribution = LATENCY_DISTRIBUTIONS[latency_distribution]
+        self.error_rate = error_rate
+        self.forget_rate = forget_rate
+        self.payload_size = payload_size
+        self.random = random.Random(seed)
+        self.saved_args = {}
+        self.request_count = 0
+
+    def render_GET(self, request):
+        if request.path == b'/_ping':
+            return b'ok'
+        args = {to_unicode(k): to_unicode(v[0]) for k, v in request.args.items()}
+        return self._delayed(request, args)
+
+    def render_POST(self, request):
+        body = request.content.read()
+        encoding = request.getHeader(b'content-encoding')
+        if encoding == b'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == b'deflate':
+            body = zlib.decompress(body)
+        try:
+            args = json.loads(to_unicode(body))
+        except ValueError:
+            return self._error(request, 400, 'BadRequest', 'invalid JSON')
+        return self._delayed(request, args)
+
+    def _delayed(self, request, args):
+        self.request_count += 1
+        delay = max(0.0, self.latency_distribution(self.random, self.latency))
+        call = reactor.callLater(delay, self._finish, request, args)
+        request.notifyFinish().addErrback(lambda _: call.active() and call.cancel())
+        return NOT_DONE_YET
+
+    def _finish(self, request, args):
+        request.write(self._render(request, args))
+        request.finish()
+
+    def _render(self, request, args):
+        endpoint = to_unicode(request.path).strip('/')
+        if endpoint not in self.endpoints:
+            return self._error(request, 404, 'NotFound', endpoint)
+        if 'url' not in args:
+            return self._error(request, 400, 'BadOption', 'url is required')
+        if self.random.random() < self.error_rate:
+            return self._error(request, 503, 'GlobalTimeoutError',
+                               'render is taking too long')
+
+        missing = self._load_args(args)
+        if missing:
+            return self._error(request, 498, 'ExpiredArguments',
+                               'expired arguments', expired=missing)
+        self._save_args(request, args)
+
+        html = _make_html(args['url'], self.payload_size)
+        if endpoint == 'render.html':
+            request.setHeader(b'content-type', b'text/html; charset=utf-8')
+            return to_bytes(html)
+
+        request.setHeader(b'content-type', b'application/json')
+        result = {
+            'url': args['url'],
+            'http_status': 200,
+            'headers': [{'name': 'Content-Type',
+                         'value': 'text/html; charset=utf-8'}],
+            'html': html,
+        }
+        if endpoint == 'execute':
+            result['cookies'] = self._cookies(args)
+            result['args'] = {k: v for k, v in args.items()
+                              if k not in {'lua_source', 'cookies'}}
+        return to_bytes(json.dumps(result))
+
+    def _load_args(self, args):
+        """ Replace load_args by saved values; return names of missing args """
+        load_args = args.pop('load_args', {})
+        missing = []
+        for name, key in load_args.items():
+            if key in self.saved_args and self.random.random() < self.forget_rate:
+                del self.saved_args[key]
+            if key not in self.saved_args:
+                missing.append(name)
+            else:
+                args[name] = self.saved_args[key]
+        return missing
+
+    def _save_args(self, request, args):
+        save_args = args.pop('save_args', [])
+        if isinstance(save_args, six.string_types):
+            save_args = save_args.split(',')
+        keys = []
+        for name in save_args:
+            key = _arg_key(args[name])
+            self.saved_args[key] = args[name]
+            keys.append('%s=%s' % (name, key))
+        if keys:
+            request.setHeader(b'X-Prerender-Saved-Arguments',
+                              to_bytes(';'.join(keys)))
+
+    def _cookies(self, args):
+        cookies = [c for c in args.get('cookies', [])
+                   if c['name'] != 'mock_visits']
+        visits = [c for c in args.get('cookies', [])
+                  if c['name'] == 'mock_visits']
+        count = int(visits[0]['value']) if visits else 0
+        domain = urlparse(args['url']).hostname
+        cookies.append({'name': 'mock_visits', 'value': str(count + 1),
+                        'domain': domain, 'path': '/', 'httpOnly': False,
+                        'secure': False})
+        return cookies
+
+    def _error(self, request, status, error_type, description, **info):
+        request.setResponseCode(status)
+        request.setHeader(b'content-type', b'application/json')
+        return to_bytes(json.dumps({
+            'error': status,
+            'type': error_type,
+            'description': description,
+            'info': info,
+        }))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mock Prerender server")
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="mean (median for lognormal) latency, seconds")
+    parser.add_argument('--latency-distribution', default='fixed',
+                        choices=sorted(LATENCY_DISTRIBUTIONS))
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--forget-rate', type=float, default=0.0)
+    parser.add_argument('--payload-size', type=int, default=10 * 1024)
+    parser.add_argument('--seed', type=int)
+    opts = parser.parse_args(argv)
+    resource = MockPrerender(
+        latency=opts.latency,
+        latency_distribution=opts.latency_distribution,
+        error_rate=opts.error_rate,
+        forget_rate=opts.forget_rate,
+        payload_size=opts.payload_size,
+        seed=opts.seed,
+    )
+    port = reactor.listenTCP(opts.port, Site(resource), interface='127.0.0.1')
+
+    def print_listening():
+        host = port.getHost()
+        print('Mock Prerender running at http://%s:%d' % (host.host, host.port))
+        sys.stdout.flush()
+    reactor.callWhenRunning(print_listening)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
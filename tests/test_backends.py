@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from collections import Counter
+
+import pytest
+
+from scrapy_prerender.backends import (
+    Backend,
+    BackendPool,
+    BalancePolicy,
+    CircuitBreaker,
+)
+
+
+URLS = ['http://prerender1:8050', 'http://prerender2:8050',
+        'http://prerender3:8050']
+
+
+def _urls(pool, keys):
+    return [pool.choose(key).url for key in keys]
+
+
+def test_round_robin():
+    pool = BackendPool.from_urls(URLS, BalancePolicy.ROUND_ROBIN)
+    assert _urls(pool, [None] * 6) == URLS + URLS
+
+
+def test_single_backend():
+    pool = BackendPool.from_urls(URLS[:1], BalancePolicy.CONSISTENT_HASH)
+    assert _urls(pool, ['a', 'b', 'c']) == URLS[:1] * 3
+
+
+def test_least_outstanding():
+    pool = BackendPool.from_urls(URLS, BalancePolicy.LEAST_OUTSTANDING)
+    pool.get(URLS[0]).outstanding = 5
+    pool.get(URLS[1]).outstanding = 1
+    pool.get(URLS[2]).outstanding = 3
+    assert _urls(pool, [None] * 3) == [URLS[1]] * 3
+
+    # ties are broken evenly
+    for backend in pool.backends:
+        backend.outstanding = 0
+    assert set(_urls(pool, [None] * 3)) == set(URLS)
+
+
+def test_from_urls_order():
+    # the first URL is used in fingerprints; it must not depend on sorting
+    pool = BackendPool.from_urls({URLS[1]: 1, URLS[0]: 3})
+    assert [b.url for b in pool.backends] == [URLS[1], URLS[0]]
+    pool = BackendPool.from_urls(' %s, %s ,' % (URLS[1], URLS[0]))
+    assert [b.url for b in pool.backends] == [URLS[1], URLS[0]]
+
+
+def test_weighted():
+    pool = BackendPool.from_urls({URLS[0]: 3, URLS[1]: 1},
+                                 BalancePolicy.WEIGHTED)
+    urls = _urls(pool, [None] * 8)
+    assert Counter(urls) == {URLS[0]: 6, URLS[1]: 2}
+    # requests are interleaved
+    assert urls[:4].count(URLS[1]) == 1
+
+
+def test_consistent_hash():
+    pool = BackendPool.from_urls(URLS, BalancePolicy.CONSISTENT_HASH)
+    domains = ['example%d.com' % i for i in range(300)]
+    urls = _urls(pool, domains)
+    assert urls == _urls(pool, domains)
+    assert set(urls) == set(URLS)
+
+    # when a backend is unavailable only its domains are moved
+    balancer = pool.balancer
+    available = pool.backends[:2]
+    for domain, url in zip(domains, urls):
+        new_url = balancer.choose(available, domain).url
+        if url != URLS[2]:
+            assert new_url == url
+        else:
+            assert new_url in URLS[:2]
+
+
+def test_custom_balancer():
+    pool = BackendPool.from_urls(URLS, 'tests.test_backends.LastBalancer')
+    assert _urls(pool, [None, None]) == [URLS[2], URLS[2]]
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        BackendPool([])
+
+
+class LastBalancer(object):
+    def __init__(self, backends):
+        pass
+
+    def choose(self, backends, key):
+        return backends[-1]
+
+
+def test_backend_repr():
+    assert repr(Backend(URLS[0])) == \
+        "<Backend http://prerender1:8050 weight=1 outstanding=0>"
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    assert breaker.allows_requests
+    assert not breaker.record_failure(now=100)
+    assert not breaker.record_success()
+    assert not breaker.record_failure(now=100)
+    assert breaker.record_failure(now=101)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allows_requests
+
+    assert not breaker.should_probe(now=110)
+    assert breaker.should_probe(now=111)
+    breaker.half_open()
+    assert not breaker.allows_requests
+    assert not breaker.should_probe(now=200)
+
+    # a failed probe opens the breaker again
+    assert breaker.record_failure(now=200)
+    assert breaker.opened_at == 200
+    breaker.half_open()
+    # responses to requests sent before the breaker opened don't close it
+    assert not breaker.record_success()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.record_success(probe=True)
+    assert breaker.allows_requests
+    assert breaker.failures == 0
+
+
+def test_choose_skips_unavailable():
+    pool = BackendPool.from_urls(URLS, BalancePolicy.ROUND_ROBIN)
+    pool.enable_circuit_breakers(failure_threshold=1, reset_timeout=10)
+    pool.get(URLS[1]).breaker.record_failure(now=0)
+    assert set(_urls(pool, [None] * 6)) == {URLS[0], URLS[2]}
+
+    # when all backends are unavailable they are all used
+    pool.get(URLS[0]).breaker.record_failure(now=0)
+    pool.get(URLS[2]).breaker.record_failure(now=0)
+    assert set(_urls(pool, [None] * 6)) == set(URLS)
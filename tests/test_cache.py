@@ -0,0 +1,657 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import base64
+import errno
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import pytest
+import scrapy
+from pytest_twisted import inlineCallbacks
+from scrapy.extensions.httpcache import FilesystemCacheStorage
+from scrapy.http import HtmlResponse, Response
+from scrapy.utils.test import get_crawler
+from twisted.internet import reactor, task, threads
+
+from scrapy_prerender import (
+    PrerenderRequest,
+    PrerenderAwareFSCacheStorage,
+    PrerenderAwareThreadedFSCacheStorage,
+    PrerenderAwareSqliteCacheStorage,
+    PrerenderCachePrefetchMiddleware,
+    PrerenderJsonResponse,
+    PrerenderMiddleware,
+)
+from scrapy_prerender.cache import GZIP_MAGIC, ZSTD_MAGIC
+from scrapy_prerender.utils import compress_body
+
+
+def _get_storage(tmpdir, cls=PrerenderAwareFSCacheStorage, **settings):
+    settings.setdefault('HTTPCACHE_DIR', str(tmpdir))
+    crawler = get_crawler(settings_dict=settings)
+    crawler.stats.open_spider(None)
+    spider = scrapy.Spider.from_crawler(crawler, name='foo')
+    storage = cls(crawler.settings)
+    storage.open_spider(spider)
+    return storage, spider
+
+
+def _store(storage, spider, url="http://example.com", body=b'<html>hi</html>'):
+    req = PrerenderRequest(url)
+    storage.store_response(spider, req, HtmlResponse(
+        req.url, body=body, headers={'X-Foo': 'bar'}))
+    return req
+
+
+def _body_path(storage, spider, req):
+    return os.path.join(storage._get_request_path(spider, req), 'response_body')
+
+
+@pytest.mark.parametrize('compression, magic', [
+    ('gzip', GZIP_MAGIC),
+    ('zstd', ZSTD_MAGIC),
+])
+def test_compression(tmpdir, compression, magic):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    storage, spider = _get_storage(
+        tmpdir, PRERENDER_HTTPCACHE_COMPRESSION=compression,
+        PRERENDER_HTTPCACHE_COMPRESSION_LEVEL=1)
+    body = b'<html>' + b'hello ' * 10000 + b'</html>'
+    req = _store(storage, spider, body=body)
+    with open(_body_path(storage, spider, req), 'rb') as f:
+        stored = f.read()
+    assert stored.startswith(magic)
+    assert len(stored) < len(body) / 10
+
+    response = storage.retrieve_response(spider, req)
+    assert response.body == body
+    assert response.headers[b'X-Foo'] == b'bar'
+
+
+@pytest.mark.parametrize('old_settings', [{}, {'HTTPCACHE_GZIP': True}])
+def test_compression_reads_old_entries(tmpdir, old_settings):
+    # entries written by scrapy's FilesystemCacheStorage
+    storage, spider = _get_storage(tmpdir, **old_settings)
+    old_req = PrerenderRequest("http://example.com/old")
+    FilesystemCacheStorage.store_response(
+        storage, spider, old_req, HtmlResponse(old_req.url, body=b'old'))
+
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_COMPRESSION='gzip')
+    new_req = _store(storage, spider, "http://example.com/new", b'new')
+    assert storage.retrieve_response(spider, old_req).body == b'old'
+    assert storage.retrieve_response(spider, new_req).body == b'new'
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+@pytest.mark.parametrize('cls', [PrerenderAwareFSCacheStorage,
+                                 PrerenderAwareSqliteCacheStorage])
+def test_compression_content_encoding(tmpdir, cls, compression):
+    # HttpCacheMiddleware stores bodies before HttpCompressionMiddleware
+    # decodes them; they must be returned as is.
+    storage, spider = _get_storage(
+        tmpdir, cls, PRERENDER_HTTPCACHE_COMPRESSION=compression)
+    body = compress_body(b'<html>hi</html>', 'gzip')
+    req = PrerenderRequest("http://example.com")
+    storage.store_response(spider, req, Response(
+        req.url, body=body, headers={'Content-Encoding': 'gzip'}))
+    response = storage.retrieve_response(spider, req)
+    assert response.body == body
+    assert response.headers[b'Content-Encoding'] == b'gzip'
+    storage.close_spider(spider)
+
+
+def test_compression_invalid(tmpdir):
+    with pytest.raises(ValueError):
+        _get_storage(tmpdir, PRERENDER_HTTPCACHE_COMPRESSION='lzma')
+
+
+def _store_json(storage, spider, data, **meta):
+    req = PrerenderRequest("http://example.com", endpoint='render.json',
+                           meta=meta)
+    storage.store_response(spider, req, Response(
+        'http://127.0.0.1:8050/render.json', body=json.dumps(data).encode(),
+        headers={'Content-Type': 'application/json'}))
+    return req
+
+
+def _replay(storage, spider, req):
+    """ Retrieve a response like HttpCacheMiddleware and PrerenderMiddleware """
+    response = storage.retrieve_response(spider, req)
+    response.flags.append('cached')
+    mw = PrerenderMiddleware.from_crawler(spider.crawler)
+    req.meta['_prerender_processed'] = True
+    try:
+        return mw.process_response(req, response, spider)
+    finally:
+        del req.meta['_prerender_processed']  # it changes the fingerprint
+
+
+@pytest.mark.parametrize('data, body', [
+    ({'url': 'http://example.com/', 'html': u'<html>привет</html>',
+      'png': base64.b64encode(b'\x89PNG').decode('ascii'),
+      'http_status': 201},
+     u'<html>привет</html>'.encode('utf8')),
+    ({'url': 'http://example.com/', 'body': base64.b64encode(b'{}').decode(),
+      'headers': [{'name': 'X-Foo', 'value': 'bar'}]},
+     b'{}'),
+])
+def test_decoded_layout(tmpdir, data, body):
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_DECODED=True,
+                                   PRERENDER_HTTPCACHE_COMPRESSION='gzip')
+    req = _store_json(storage, spider, data)
+    files = os.listdir(storage._get_request_path(spider, req))
+    assert 'response_body' not in files
+    assert 'prerender_body' in files
+    assert ('prerender_png' in files) == ('png' in data)
+
+    # other downloader middlewares see a raw Prerender response
+    response = storage.retrieve_response(spider, req)
+    assert not isinstance(response, PrerenderJsonResponse)
+    assert response.url == 'http://127.0.0.1:8050/render.json'
+    assert response.headers[b'Content-Type'] == b'application/json'
+    assert response.body == b''
+
+    response = _replay(storage, spider, req)
+    assert isinstance(response, PrerenderJsonResponse)
+    assert '_prerender_cached_data' not in req.meta
+    assert response.data == data
+    assert response.body == body
+    assert response.url == 'http://example.com/'
+    assert response.real_url == 'http://127.0.0.1:8050/render.json'
+    assert response.status == data.get('http_status', 200)
+    assert response.prerender_response_headers[b'Content-Type'] == \
+        b'application/json'
+    if 'headers' in data:
+        assert response.headers[b'X-Foo'] == b'bar'
+
+
+def test_decoded_layout_lazy_data(tmpdir, monkeypatch):
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_DECODED=True)
+    png = b'\x89PNG' + b'\x00' * 1000
+    data = {'url': 'http://example.com/', 'http_status': 201,
+            'body': base64.b64encode(b'{}').decode('ascii'),
+            'png': base64.b64encode(png).decode('ascii')}
+    req = _store_json(storage, spider, data)
+
+    encoded = []
+    b64encode = base64.b64encode
+
+    def _b64encode(value):
+        encoded.append(value)
+        return b64encode(value)
+    monkeypatch.setattr(base64, 'b64encode', _b64encode)
+
+    response = _replay(storage, spider, req)
+    assert response.body == b'{}'
+    assert response.text == u'{}'
+    assert response.status == 201
+    assert response.url == 'http://example.com/'
+    assert encoded == []
+
+    assert response.data == data
+    assert sorted(encoded) == sorted([b'{}', png])
+
+    # a raw response is returned if it shouldn't be processed now
+    req.meta['prerender']['dont_process_response'] = True
+    response = storage.retrieve_response(spider, req)
+    assert not isinstance(response, PrerenderJsonResponse)
+    assert json.loads(response.body.decode('utf8')) == data
+
+
+def test_decoded_layout_not_used(tmpdir):
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_DECODED=True)
+    old_storage, _ = _get_storage(tmpdir)
+    data = {'url': 'http://example.com/', 'html': '<html></html>'}
+    requests = [
+        _store_json(storage, spider, {'foo': 'bar'}),
+        _store_json(storage, spider, data, prerender={
+            'endpoint': 'render.json', 'magic_response': False,
+            'args': {'url': 'http://example.com/'}}),
+        _store_json(old_storage, spider, data, prerender={
+            'endpoint': 'render.json', 'args': {'url': 'http://example.org/'}}),
+        _store(storage, spider),
+    ]
+    for req in requests:
+        assert os.path.exists(_body_path(storage, spider, req))
+        assert storage.retrieve_response(spider, req) is not None
+
+
+def _blobs(storage):
+    return sorted(
+        os.path.join(dirpath, name)
+        for dirpath, _, names in os.walk(storage.blobs_dir) for name in names)
+
+
+def test_deduplicate(tmpdir):
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_DEDUPLICATE=True,
+                                   PRERENDER_HTTPCACHE_COMPRESSION='gzip')
+    body = b'<html>login required</html>'
+    req1 = _store(storage, spider, "http://example.com/1", body)
+    req2 = _store(storage, spider, "http://example.com/2", body)
+    blob, = _blobs(storage)
+    assert blob.endswith('.gzip')
+    assert os.stat(blob).st_nlink == 3
+    assert os.path.samefile(blob, _body_path(storage, spider, req1))
+    for req in [req1, req2]:
+        assert storage.retrieve_response(spider, req).body == body
+    stats = spider.crawler.stats
+    assert stats.get_value('prerender/httpcache/blobs/deduplicated') == 1
+    assert stats.get_value('prerender/httpcache/blobs/deduplicated_bytes') == \
+        len(body)
+
+    # blobs which are still used are kept
+    _store(storage, spider, "http://example.com/1", b'<html>ok</html>')
+    assert os.stat(blob).st_nlink == 2
+    assert storage.collect_garbage() == (0, 0)
+    assert storage.retrieve_response(spider, req1).body == b'<html>ok</html>'
+
+    shutil.rmtree(storage._get_request_path(spider, req2))
+    size = os.path.getsize(blob)
+    storage.close_spider(spider)
+    assert not os.path.exists(blob)
+    assert len(_blobs(storage)) == 1
+    assert stats.get_value('prerender/httpcache/blobs/collected') == 1
+    assert stats.get_value('prerender/httpcache/blobs/collected_bytes') == size
+
+
+def test_deduplicate_decoded(tmpdir):
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_DEDUPLICATE=True,
+                                   PRERENDER_HTTPCACHE_DECODED=True)
+    data = {'html': '<html></html>', 'png': base64.b64encode(b'PNG').decode()}
+    req = _store_json(storage, spider, data)
+    assert len(_blobs(storage)) == 2
+    assert _replay(storage, spider, req).data == data
+
+
+def test_deduplicate_link_error(tmpdir, monkeypatch):
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_DEDUPLICATE=True)
+
+    def link(src, dst):
+        raise OSError(errno.EMLINK, 'Too many links')
+    monkeypatch.setattr(os, 'link', link)
+    req = _store(storage, spider)
+    assert not os.path.exists(_body_path(storage, spider, req) + '.tmp')
+    assert storage.retrieve_response(spider, req).body == b'<html>hi</html>'
+
+
+def _run_scheduled_compaction(storage):
+    call = storage._compaction_call
+    func, args = call.func, call.args
+    call.cancel()
+    func(*args)
+
+
+def test_max_bytes(tmpdir):
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_MAX_BYTES=10 ** 9)
+    requests = [_store(storage, spider, "http://example.com/%02d" % i, b'x' * 1000)
+                for i in range(10)]
+    sizes = dict(storage.index.items())
+    assert storage.index.total == sum(sizes.values())
+    assert storage._compaction_call is None
+    storage.retrieve_response(spider, requests[0])
+
+    # entry sizes are almost the same
+    storage.max_bytes = max(sizes.values()) * 5
+    storage.compaction_batch_size = 3
+    _store(storage, spider, "http://example.com/10", b'x' * 1000)
+    assert len(storage.index) == 11  # not evicted yet
+    total = storage.index.total
+    for size in [8, 5, 4]:
+        _run_scheduled_compaction(storage)
+        assert len(storage.index) == size
+    assert storage._compaction_call is None
+    # 4 entries fit into compaction_target * max_bytes
+    assert len(storage.index) == 4
+    stats = spider.crawler.stats
+    assert stats.get_value('prerender/httpcache/evicted') == 7
+    assert stats.get_value('prerender/httpcache/bytes') == storage.index.total
+    assert stats.get_value('prerender/httpcache/evicted_bytes') == \
+        total - storage.index.total
+    # least recently used entries are removed
+    for i, req in enumerate(requests):
+        cached = storage.retrieve_response(spider, req) is not None
+        assert cached == (i in (0, 8, 9))
+    index_path = storage._index_path(spider)
+    keys = list(storage.index)
+    storage.close_spider(spider)
+
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_MAX_BYTES=10 ** 9)
+    assert list(storage.index) == keys
+    storage.close_spider(spider)
+
+    # the index is rebuilt if it is missing
+    os.remove(index_path)
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_MAX_BYTES=10 ** 9)
+    assert sorted(storage.index) == sorted(keys)
+    assert storage.index.total == stats.get_value('prerender/httpcache/bytes')
+    storage.close_spider(spider)
+    assert os.path.exists(index_path)
+
+
+def test_max_bytes_stale_index(tmpdir):
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_MAX_BYTES=10 ** 9)
+    old = _store(storage, spider, "http://example.com/old")
+    removed = _store(storage, spider, "http://example.com/removed")
+    storage.close_spider(spider)
+    shutil.rmtree(storage._get_request_path(spider, removed))
+
+    # stored without updating the index
+    storage, spider = _get_storage(tmpdir)
+    new = _store(storage, spider, "http://example.com/new")
+
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_MAX_BYTES=10 ** 9)
+    fp = storage._fingerprint
+    assert list(storage.index) == [fp(old), fp(new)]
+    assert storage.index.total == sum(
+        storage._entry_size(storage._get_request_path(spider, req))
+        for req in [old, new])
+    # the stale entry can be evicted
+    storage.max_bytes = 1
+    storage.compact(spider)
+    assert len(storage.index) == 0
+    assert storage.retrieve_response(spider, new) is None
+    storage.close_spider(spider)
+
+
+def _disk_usage(*dirs):
+    inodes = {}
+    for dirname in dirs:
+        for dirpath, _, names in os.walk(dirname):
+            for name in names:
+                if name.startswith('.'):
+                    continue  # e.g. the access index
+                stat = os.stat(os.path.join(dirpath, name))
+                inodes[stat.st_ino] = stat.st_size
+    return sum(inodes.values())
+
+
+def test_max_bytes_deduplicate(tmpdir):
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_MAX_BYTES=10 ** 9,
+                                   PRERENDER_HTTPCACHE_DEDUPLICATE=True)
+    shared = [_store(storage, spider, "http://example.com/%d" % i, b'x' * 1000)
+              for i in range(3)]
+    unique = _store(storage, spider, "http://example.com/3", b'y' * 1000)
+    spider_dir = os.path.join(str(tmpdir), 'foo')
+    # shared blobs are counted once
+    assert storage.index.total + storage.blob_bytes == \
+        _disk_usage(spider_dir, storage.blobs_dir)
+    assert storage.blob_bytes == 2000
+
+    for req in shared:
+        storage.retrieve_response(spider, req)
+    storage.max_bytes = storage.index.total + storage.blob_bytes - 1
+    storage.compaction_batch_size = 2
+    storage.compact(spider)
+    # the blob of the evicted entry is removed, the shared blob is kept
+    assert storage.retrieve_response(spider, unique) is None
+    assert len(_blobs(storage)) == 1
+    assert storage.blob_bytes == 1000
+    assert storage.index.total + storage.blob_bytes == \
+        _disk_usage(spider_dir, storage.blobs_dir)
+    stats = spider.crawler.stats
+    assert stats.get_value('prerender/httpcache/blobs/collected') == 1
+    assert stats.get_value('prerender/httpcache/bytes') == \
+        storage.index.total + storage.blob_bytes
+    storage.close_spider(spider)
+
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_MAX_BYTES=10 ** 9,
+                                   PRERENDER_HTTPCACHE_DEDUPLICATE=True)
+    assert storage.blob_bytes == 1000
+    storage.close_spider(spider)
+
+
+@pytest.mark.parametrize('settings', [
+    {}, {'PRERENDER_HTTPCACHE_MAX_BYTES': 10 ** 9}])
+def test_key_index(tmpdir, settings):
+    storage, spider = _get_storage(tmpdir)
+    cached = _store(storage, spider, "http://example.com/1")
+    os.makedirs(os.path.join(str(tmpdir), 'foo', 'tmp'))
+
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_KEY_INDEX=True,
+                                   **settings)
+    assert len(storage.keys) == 1
+    read_meta = storage._read_meta
+    lookups = []
+
+    def _read_meta(spider, request):
+        lookups.append(request)
+        return read_meta(spider, request)
+    storage._read_meta = _read_meta
+
+    not_cached = PrerenderRequest("http://example.com/2")
+    assert storage.retrieve_response(spider, not_cached) is None
+    assert lookups == []
+    assert storage.retrieve_response(spider, cached) is not None
+    assert lookups == [cached]
+
+    _store(storage, spider, "http://example.com/2")
+    assert storage.retrieve_response(spider, not_cached) is not None
+    stats = spider.crawler.stats
+    assert stats.get_value('prerender/httpcache/key_index/skipped') == 1
+    assert stats.get_value('prerender/httpcache/miss') == 1
+    assert stats.get_value('prerender/httpcache/key_index/size') == 1
+    storage.close_spider(spider)
+
+
+def test_key_index_stale_access_index(tmpdir):
+    settings = {'PRERENDER_HTTPCACHE_MAX_BYTES': 10 ** 9}
+    storage, spider = _get_storage(tmpdir, **settings)
+    indexed = _store(storage, spider, "http://example.com/1")
+    storage.close_spider(spider)
+    # e.g. the process crashed before the index was committed
+    storage, spider = _get_storage(tmpdir)
+    not_indexed = _store(storage, spider, "http://example.com/2")
+    storage, spider = _get_storage(tmpdir, PRERENDER_HTTPCACHE_KEY_INDEX=True,
+                                   **settings)
+    assert len(storage.keys) == 2
+    assert storage.retrieve_response(spider, indexed) is not None
+    assert storage.retrieve_response(spider, not_indexed) is not None
+    storage.close_spider(spider)
+
+
+def _wait_for_writes(storage):
+    def check():
+        if storage._pending:
+            return task.deferLater(reactor, 0.01, check)
+    return check()
+
+
+@inlineCallbacks
+def test_threaded_storage(tmpdir):
+    storage, spider = _get_storage(tmpdir, PrerenderAwareThreadedFSCacheStorage,
+                                   PRERENDER_HTTPCACHE_IO_THREADS=2,
+                                   PRERENDER_HTTPCACHE_KEY_INDEX=True)
+    requests = [_store(storage, spider, "http://example.com/%d" % i,
+                       b'body %d' % i)
+                for i in range(20)]
+    stats = spider.crawler.stats
+    assert stats.get_value('prerender/httpcache/write_queue/max_depth') >= 1
+    # responses which are not written yet are returned from memory
+    assert storage.retrieve_response(spider, requests[0]).body == b'body 0'
+
+    yield _wait_for_writes(storage)
+    assert stats.get_value('prerender/httpcache/write_queue/depth') == 0
+    assert len(storage.keys) == 20
+    storage.close_spider(spider)
+    assert stats.get_value('prerender/httpcache/write_latency/count') == 20
+
+    storage, spider = _get_storage(tmpdir)
+    for i, req in enumerate(requests):
+        assert storage.retrieve_response(spider, req).body == b'body %d' % i
+
+
+@pytest.mark.parametrize('queue_size', [1, 100])
+def test_threaded_storage_close(tmpdir, queue_size):
+    storage, spider = _get_storage(tmpdir, PrerenderAwareThreadedFSCacheStorage,
+                                   PRERENDER_HTTPCACHE_IO_THREADS=1,
+                                   PRERENDER_HTTPCACHE_WRITE_QUEUE_SIZE=queue_size)
+    requests = [_store(storage, spider, "http://example.com/%d" % i,
+                       b'body %d' % i)
+                for i in range(50)]
+    # stored again while it is written
+    _store(storage, spider, "http://example.com/0", b'new body')
+    storage.close_spider(spider)
+    if queue_size == 1:
+        assert spider.crawler.stats.get_value(
+            'prerender/httpcache/write_queue/full') > 0
+
+    storage, spider = _get_storage(tmpdir)
+    assert storage.retrieve_response(spider, requests[0]).body == b'new body'
+    for i, req in enumerate(requests[1:], 1):
+        assert storage.retrieve_response(spider, req).body == b'body %d' % i
+
+
+@inlineCallbacks
+def test_threaded_storage_prefetch(tmpdir):
+    storage, spider = _get_storage(tmpdir)
+    cached = _store(storage, spider)
+    storage, spider = _get_storage(tmpdir, PrerenderAwareThreadedFSCacheStorage)
+    not_cached = PrerenderRequest("http://example.com/other")
+    for req in [cached, not_cached]:
+        result = yield storage.prefetch(spider, req)
+        assert result is None
+    assert len(storage._prefetched) == 2
+
+    def _read_meta(spider, request):
+        raise AssertionError("prefetched response is read again")
+    storage._read_meta = _read_meta
+    assert storage.retrieve_response(spider, cached).body == b'<html>hi</html>'
+    assert storage.retrieve_response(spider, not_cached) is None
+    stats = spider.crawler.stats
+    assert stats.get_value('prerender/httpcache/prefetch/used') == 2
+    assert stats.get_value('prerender/httpcache/hit') == 1
+    storage.close_spider(spider)
+
+
+@inlineCallbacks
+def test_threaded_storage_prefetch_stale(tmpdir):
+    storage, spider = _get_storage(tmpdir)
+    req = _store(storage, spider, body=b'old')
+    storage, spider = _get_storage(tmpdir, PrerenderAwareThreadedFSCacheStorage)
+    load_entry = storage._load_entry
+    read = threading.Event()
+    stored = threading.Event()
+
+    def _load_entry(spider, request):
+        response = load_entry(spider, request)
+        read.set()
+        stored.wait(10)
+        return response
+    storage._load_entry = _load_entry
+
+    # the response is stored while it is prefetched
+    prefetched = storage.prefetch(spider, req)
+    yield threads.deferToThread(read.wait, 10)
+    _store(storage, spider, req.url, body=b'new')
+    yield _wait_for_writes(storage)
+    stored.set()
+    yield prefetched
+    response = storage.retrieve_response(spider, req)
+    storage.close_spider(spider)
+    assert response.body == b'new'
+
+
+class _Stub(object):
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+@inlineCallbacks
+def test_prefetch_middleware(tmpdir):
+    storage, spider = _get_storage(tmpdir)
+    req = _store(storage, spider)
+    storage, spider = _get_storage(tmpdir, PrerenderAwareThreadedFSCacheStorage)
+    crawler = get_crawler(settings_dict={'HTTPCACHE_ENABLED': True})
+    crawler.engine = _Stub(downloader=_Stub(middleware=_Stub(
+        middlewares=[_Stub(), _Stub(storage=storage)])))
+    mw = PrerenderCachePrefetchMiddleware.from_crawler(crawler)
+    mw.spider_opened(spider)
+    # the storage is looked up once
+    crawler.engine = None
+    result = yield mw.process_request(req, spider)
+    assert result is None
+    assert list(storage._prefetched) == [storage._fingerprint(req)]
+    req = PrerenderRequest("http://example.com/2", meta={'dont_cache': True})
+    assert mw.process_request(req, spider) is None
+    storage.close_spider(spider)
+
+
+def _count_rows(tmpdir):
+    db = sqlite3.connect(str(tmpdir.join('foo.sqlite')))
+    try:
+        return db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_sqlite_storage(tmpdir):
+    storage, spider = _get_storage(
+        tmpdir, PrerenderAwareSqliteCacheStorage,
+        PRERENDER_HTTPCACHE_SQLITE_BATCH_SIZE=2)
+    req = _store(storage, spider, "http://example.com/1")
+    response = storage.retrieve_response(spider, req)
+    assert response.body == b'<html>hi</html>'
+    assert response.headers[b'X-Foo'] == b'bar'
+    assert response.url == req.url
+    assert storage.retrieve_response(
+        spider, PrerenderRequest("http://example.com/2")) is None
+
+    # other processes see committed batches only
+    assert _count_rows(tmpdir) == 0
+    _store(storage, spider, "http://example.com/2")
+    assert _count_rows(tmpdir) == 2
+    _store(storage, spider, "http://example.com/3")
+    assert _count_rows(tmpdir) == 2
+    storage.close_spider(spider)
+    assert _count_rows(tmpdir) == 3
+
+    stats = spider.crawler.stats.get_stats()
+    assert stats['prerender/httpcache/hit'] == 1
+    assert stats['prerender/httpcache/miss'] == 1
+
+    storage, spider = _get_storage(tmpdir, PrerenderAwareSqliteCacheStorage)
+    assert storage.retrieve_response(spider, req).body == b'<html>hi</html>'
+    storage.close_spider(spider)
+
+
+def test_sqlite_storage_expiration(tmpdir, monkeypatch):
+    storage, spider = _get_storage(tmpdir, PrerenderAwareSqliteCacheStorage,
+                                   HTTPCACHE_EXPIRATION_SECS=10)
+    req = _store(storage, spider)
+    assert storage.retrieve_response(spider, req) is not None
+    now = time.time()
+    monkeypatch.setattr('scrapy_prerender.cache.time', lambda: now + 20)
+    assert storage.retrieve_response(spider, req) is None
+    storage.close_spider(spider)
+
+
+def test_sqlite_storage_compression(tmpdir):
+    storage, spider = _get_storage(tmpdir, PrerenderAwareSqliteCacheStorage,
+                                   PRERENDER_HTTPCACHE_COMPRESSION='gzip')
+    body = b'<html>' + b'hello ' * 10000 + b'</html>'
+    req = _store(storage, spider, body=body)
+    storage.close_spider(spider)
+    db = sqlite3.connect(str(tmpdir.join('foo.sqlite')))
+    stored, = db.execute('SELECT body FROM responses').fetchone()
+    db.close()
+    assert bytes(stored).startswith(GZIP_MAGIC)
+
+    storage, spider = _get_storage(tmpdir, PrerenderAwareSqliteCacheStorage)
+    assert storage.retrieve_response(spider, req).body == body
+    storage.close_spider(spider)
+
+
+def test_sqlite_storage_old_schema(tmpdir):
+    db = sqlite3.connect(str(tmpdir.join('foo.sqlite')))
+    db.execute(PrerenderAwareSqliteCacheStorage.schema.replace(
+        ',\n            compression TEXT', ''))
+    db.close()
+    storage, spider = _get_storage(tmpdir, PrerenderAwareSqliteCacheStorage)
+    req = _store(storage, spider)
+    assert storage.retrieve_response(spider, req).body == b'<html>hi</html>'
+    storage.close_spider(spider)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import json
+
+import pytest
+import scrapy
+from scrapy.core.engine import ExecutionEngine
+from scrapy.exceptions import NotConfigured
+from scrapy.http import TextResponse
+from scrapy.utils.test import get_crawler
+
+from scrapy_prerender import (
+    PrerenderRequest,
+    PrerenderMiddleware,
+    PrerenderDeduplicateArgsMiddleware,
+)
+from scrapy_prerender.extensions import (
+    PrerenderStatsExtension,
+    find_prerender_middleware,
+)
+
+
+def _get_crawler(settings_dict=None):
+    settings_dict = dict(settings_dict or {})
+    settings_dict['DOWNLOAD_HANDLERS'] = {'s3': None}
+    settings_dict['DOWNLOADER_MIDDLEWARES'] = {
+        'scrapy_prerender.PrerenderMiddleware': 725,
+    }
+    crawler = get_crawler(settings_dict=settings_dict)
+    if not hasattr(crawler, 'logformatter'):
+        crawler.logformatter = None
+    crawler.engine = ExecutionEngine(crawler, lambda _: None)
+    crawler.stats.open_spider(None)
+    return crawler
+
+
+def _render(mw, req, latency=1.0, status=200, headers=None):
+    req = mw.process_request(req, None)
+    mw.process_request(req, None)
+    req.meta['_prerender_sent_time'] -= latency
+    resp = TextResponse(req.url, status=status, headers=headers,
+                        body=b'x' * 10)
+    return mw.process_response(req, resp, None)
+
+
+def test_disabled():
+    crawler = _get_crawler({'PRERENDER_STATS_INTERVAL': 0})
+    with pytest.raises(NotConfigured):
+        PrerenderStatsExtension.from_crawler(crawler)
+
+
+def test_snapshot():
+    crawler = _get_crawler({'PRERENDER_STATS_INTERVAL': 30})
+    ext = PrerenderStatsExtension.from_crawler(crawler)
+    mw = find_prerender_middleware(crawler)
+    assert isinstance(mw, PrerenderMiddleware)
+
+    spider = scrapy.Spider(name='foo')
+    crawler.spider = spider
+    mw.spider_opened(spider)
+    dedupe_mw = PrerenderDeduplicateArgsMiddleware()
+    reqs = [PrerenderRequest("http://example.com/%d" % i, endpoint='execute',
+                             args={'lua_source': 'function main() end'},
+                             cache_args=['lua_source'])
+            for i in range(2)]
+    reqs = list(dedupe_mw.process_start_requests(reqs, spider))
+    fp = reqs[0].meta['prerender']['args']['lua_source']
+    _render(mw, reqs[0], headers={
+        'X-Prerender-Saved-Arguments': 'lua_source=%s' % fp})
+    _render(mw, reqs[1], status=498)
+    req = mw.process_request(PrerenderRequest("http://example.com/3"), None)
+    mw.process_request(req, None)
+
+    snapshot = ext.snapshot()
+    assert snapshot['renders'] == 2
+    assert snapshot['renders_per_min'] == 4
+    assert snapshot['request_bytes'] == crawler.stats.get_value(
+        'prerender/request_bytes') > 0
+    assert snapshot['response_bytes'] == 20
+    assert snapshot['retry_498_rate'] == 0.5
+    assert snapshot['cache_args_hit_rate'] == 0.5
+    assert snapshot['inflight'] == {'http://127.0.0.1:8050': 1}
+    assert 0.9 < snapshot['latency']['render']['p50'] < 1.1
+
+    # only the last interval is reported
+    mw.process_response(req, TextResponse(req.url), None)
+    snapshot = ext.snapshot()
+    assert snapshot['renders'] == 3
+    assert snapshot['renders_per_min'] == 2
+    assert snapshot['retry_498_rate'] == 0.0
+    assert snapshot['inflight'] == {'http://127.0.0.1:8050': 0}
+    assert snapshot['latency']['render']['p50'] < 0.1
+
+    # HTTP cache hits are not renders
+    req = mw.process_request(PrerenderRequest("http://example.com/4"), None)
+    mw.process_request(req, None)
+    mw.process_response(req, TextResponse(req.url, flags=['cached'],
+                                          body=b'x'), None)
+    snapshot = ext.snapshot()
+    assert snapshot['renders'] == 3
+    assert snapshot['response_bytes'] == 0
+
+
+def test_log_to_file(tmpdir):
+    filename = str(tmpdir.join('stats.jl'))
+    crawler = _get_crawler({'PRERENDER_STATS_FILE': filename})
+    ext = PrerenderStatsExtension.from_crawler(crawler)
+    ext.spider_opened(None)
+    _render(find_prerender_middleware(crawler),
+            PrerenderRequest("http://example.com/1"))
+    ext.log(None)
+    ext.log(None)
+    ext.spider_closed(None, 'finished')
+    with open(filename) as f:
+        snapshots = [json.loads(line) for line in f]
+    assert [s['renders'] for s in snapshots] == [1, 1]
+    assert snapshots[0]['renders_per_min'] == 1
+    assert snapshots[1]['renders_per_min'] == 0
@@ -1,16 +1,29 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import multiprocessing
 from copy import deepcopy
 
 import pytest
 import scrapy
 from scrapy.dupefilters import request_fingerprint
 
-from scrapy_prerender import PrerenderRequest
-from scrapy_prerender.dupefilter import prerender_request_fingerprint
-from scrapy_prerender.utils import dict_hash
-
-from .test_middleware import _get_mw
+from scrapy_prerender import (
+    PrerenderRequest,
+    PrerenderMiddleware,
+    PrerenderAwareDupeFilter,
+    PrerenderDeduplicateArgsMiddleware,
+    PrerenderPrefilterMiddleware,
+    FingerprintPolicy,
+)
+from scrapy_prerender import dupefilter
+from scrapy_prerender.dupefilter import (
+    prerender_request_fingerprint,
+    prerender_request_fingerprints,
+    invalidate_prerender_fingerprint,
+)
+from scrapy_prerender.utils import dict_hash, streaming_dict_hash
+
+from .test_middleware import _get_crawler, _get_mw
 
 
 def test_dict_hash():
@@ -45,6 +58,23 @@ def test_dict_hash_invalid():
         dict_hash({"foo": scrapy})
 
 
+def test_streaming_dict_hash():
+    value = {"foo": "bar", "float": 1.1, "int": 2, "bool": False,
+             "bytes": b"\xff", "seq": ["x", (2, 3.7, {"x": 5, "y": None})]}
+    assert streaming_dict_hash(value) == streaming_dict_hash(deepcopy(value))
+    assert streaming_dict_hash(value) != streaming_dict_hash(value, 'start')
+    for key, other in [("float", 1.2), ("int", 3), ("bool", True),
+                       ("bool", 0), ("bytes", u"\xff"), ("seq", ["x"]),
+                       ("foo", "bar,")]:
+        changed = dict(value, **{key: other})
+        assert streaming_dict_hash(changed) != streaming_dict_hash(value)
+    # key order doesn't matter
+    assert streaming_dict_hash({"a": 1, "b": 2}) == \
+        streaming_dict_hash({"b": 2, "a": 1})
+    with pytest.raises(ValueError):
+        streaming_dict_hash({"foo": scrapy})
+
+
 def test_request_fingerprint_noprerender():
     r1 = scrapy.Request("http://example.com")
     r2 = scrapy.Request("http://example.com", meta={"foo": "bar"})
@@ -79,6 +109,116 @@ def test_request_fingerprint_prerender():
     assert_fingerprints_match(r2, r4)
 
 
+def test_fingerprint_cache(monkeypatch):
+    from scrapy_prerender import dupefilter
+    calls = []
+    compute = dupefilter._prerender_request_fingerprint
+
+    def _compute(request, include_headers, version, policy):
+        calls.append(request)
+        return compute(request, include_headers, version, policy)
+    monkeypatch.setattr(dupefilter, '_prerender_request_fingerprint', _compute)
+
+    r1 = PrerenderRequest("http://example.com", args={'wait': 0.5})
+    fp = prerender_request_fingerprint(r1)
+    assert prerender_request_fingerprint(r1) == fp
+    assert len(calls) == 1
+
+    # include_headers are a part of the cache key
+    fp_headers = prerender_request_fingerprint(r1, include_headers=['Accept'])
+    assert len(calls) == 2
+    assert prerender_request_fingerprint(r1, ['accept']) == fp_headers
+    assert len(calls) == 2
+
+    # Request.replace creates a new request with its own fingerprint
+    r2 = r1.replace(url="http://example.com/foo")
+    assert prerender_request_fingerprint(r2) != fp
+    assert len(calls) == 3
+
+    # in-place changes of meta require an explicit invalidation
+    r1.meta['prerender']['args']['wait'] = 1.0
+    assert prerender_request_fingerprint(r1) == fp
+    invalidate_prerender_fingerprint(r1)
+    assert prerender_request_fingerprint(r1) != fp
+    assert len(calls) == 4
+
+
+def test_fingerprint_cache_invalidated_by_middlewares():
+    from scrapy_prerender import (
+        PrerenderCookiesMiddleware,
+        PrerenderDeduplicateArgsMiddleware,
+    )
+    spider = scrapy.Spider(name='foo')
+    req = PrerenderRequest("http://example.com", endpoint='execute',
+                           args={'lua_source': 'function main() end'},
+                           cache_args=['lua_source'],
+                           cookies={'foo': 'bar'})
+    fp = prerender_request_fingerprint(req)
+    req, = PrerenderDeduplicateArgsMiddleware().process_start_requests(
+        [req], spider)
+    fp_dedupe = prerender_request_fingerprint(req)
+    assert fp_dedupe != fp
+    PrerenderCookiesMiddleware().process_request(req, spider)
+    assert prerender_request_fingerprint(req) != fp_dedupe
+
+
+def _versioned_request():
+    return PrerenderRequest('http://example.com/foo?y=2&x=1',
+                            endpoint='execute',
+                            args={'lua_source': 'function main() end',
+                                  'wait': 0.5,
+                                  'cookies': [{'name': 'a', 'value': 'b'}],
+                                  'headers': {'Accept': 'text/html'}})
+
+
+def test_fingerprint_version_1_is_stable():
+    # existing HTTP cache directories use these fingerprints
+    req = _versioned_request()
+    assert prerender_request_fingerprint(req) == \
+        'a9a18a567cf07c929e14c8c649da5e75fa5ac275'
+    processed = _get_mw().process_request(_versioned_request(), None)
+    assert prerender_request_fingerprint(processed, version=1) == \
+        '5a1d6f50ba384a8f4a4c937c8a4376d78db18839'
+    # meta is not changed
+    assert req.meta['prerender']['args']['url'] == req.url
+
+
+def test_fingerprint_versions():
+    req = _versioned_request()
+    fp1 = prerender_request_fingerprint(req, version=1)
+    fp2 = prerender_request_fingerprint(req, version=2)
+    assert fp1 != fp2
+    assert len(fp2) == len(fp1)
+    with pytest.raises(ValueError):
+        prerender_request_fingerprint(req, version=3)
+
+
+@pytest.mark.parametrize('include_headers', [None, ['Accept', 'X-Foo']])
+def test_request_digest(include_headers):
+    from scrapy.utils.url import canonicalize_url
+    request = scrapy.Request("http://example.com/foo?y=2&x=1", method='POST',
+                             body=b'{}', headers={'Accept': 'text/html'})
+    headers = dupefilter._normalize_include_headers(include_headers)
+    assert dupefilter._request_digest(
+        request, canonicalize_url(request.url), request.body, headers) == \
+        request_fingerprint(request, include_headers=include_headers)
+
+
+def test_dupefilter_fingerprint_version():
+    from scrapy.settings import Settings
+    from scrapy_prerender import PrerenderAwareDupeFilter
+    req = _versioned_request()
+    df = PrerenderAwareDupeFilter.from_settings(Settings())
+    assert df.request_fingerprint(req) == prerender_request_fingerprint(req)
+    df = PrerenderAwareDupeFilter.from_settings(
+        Settings({'PRERENDER_FINGERPRINT_VERSION': 2}))
+    assert df.request_fingerprint(req) == \
+        prerender_request_fingerprint(req, version=2)
+    with pytest.raises(ValueError):
+        PrerenderAwareDupeFilter.from_settings(
+            Settings({'PRERENDER_FINGERPRINT_VERSION': 5}))
+
+
 @pytest.fixture()
 def prerender_middleware():
     return _get_mw()
@@ -141,7 +281,16 @@ def requests():
     (14, {13, 12}),
     (15, set()),
 ])
-def test_duplicates(i, dupe_indices, requests, prerender_mw_process):
+@pytest.mark.parametrize('version', [1, 2])
+def test_duplicates(i, dupe_indices, version, requests, prerender_mw_process):
+    def assert_fingerprints_match(r1, r2):
+        assert prerender_request_fingerprint(r1, version=version) == \
+            prerender_request_fingerprint(r2, version=version)
+
+    def assert_fingerprints_dont_match(r1, r2):
+        assert prerender_request_fingerprint(r1, version=version) != \
+            prerender_request_fingerprint(r2, version=version)
+
     def assert_not_filtered(r1, r2):
         assert_fingerprints_dont_match(r1, r2)
         assert_fingerprints_dont_match(
@@ -152,8 +301,8 @@ def test_duplicates(i, dupe_indices, requests, prerender_mw_process):
     def assert_filtered(r1, r2):
         # request is filtered if it is filtered either
         # before rescheduling or after
-        fp1 = prerender_request_fingerprint(r1)
-        fp2 = prerender_request_fingerprint(r2)
+        fp1 = prerender_request_fingerprint(r1, version=version)
+        fp2 = prerender_request_fingerprint(r2, version=version)
         if fp1 != fp2:
             assert_fingerprints_match(
                 prerender_mw_process(r1),
@@ -168,3 +317,295 @@ def test_duplicates(i, dupe_indices, requests, prerender_mw_process):
         assert_filtered(requests[i], requests[j])
     for j in non_dupe_indices:
         assert_not_filtered(requests[i], requests[j])
+
+
+@pytest.mark.parametrize('serializer', ['json', 'pretty', 'orjson'])
+def test_fingerprint_doesnt_depend_on_serializer(serializer):
+    if serializer == 'orjson':
+        pytest.importorskip('orjson')
+    from .test_middleware import _get_crawler
+    from scrapy_prerender import PrerenderMiddleware
+
+    def _fingerprint(settings):
+        mw = PrerenderMiddleware.from_crawler(_get_crawler(settings))
+        req = PrerenderRequest("http://example.com/foo?x=1&y=2",
+                               endpoint='execute',
+                               args={'lua_source': 'function main() end',
+                                     'wait': 0.5})
+        return prerender_request_fingerprint(mw.process_request(req, None))
+
+    assert _fingerprint({'PRERENDER_JSON_SERIALIZER': 'pretty'}) == \
+        _fingerprint({'PRERENDER_JSON_SERIALIZER': serializer})
+
+
+def _cache_args_request(url="http://example.com"):
+    return PrerenderRequest(url, endpoint='execute',
+                            args={'lua_source': 'function main() end'},
+                            cache_args=['lua_source'])
+
+
+def _process_cache_args_requests(version=1):
+    """
+    Return a fingerprint of an unprocessed request which uses cache_args,
+    and processed requests which send and load the argument.
+    """
+    from .test_middleware import _get_crawler
+    from scrapy_prerender import (
+        PrerenderMiddleware,
+        PrerenderDeduplicateArgsMiddleware,
+    )
+    spider = scrapy.Spider(name='foo')
+    crawler = _get_crawler({})
+    crawler.spider = spider
+    mw = PrerenderMiddleware.from_crawler(crawler)
+    mw.spider_opened(spider)
+    dedupe_mw = PrerenderDeduplicateArgsMiddleware()
+
+    reqs = list(dedupe_mw.process_start_requests(
+        [_cache_args_request(), _cache_args_request()], spider))
+    fp = prerender_request_fingerprint(reqs[0], version=version)
+    saving = mw.process_request(reqs[0], spider)
+    assert 'save_args' in saving.meta['prerender']['args']
+    mw._remote_keys[saving.meta['prerender']['_local_arg_fingerprints']
+                    ['lua_source']] = 'remote-key'
+    loading = mw.process_request(reqs[1], spider)
+    assert 'load_args' in loading.meta['prerender']['args']
+    return fp, saving, loading
+
+
+def test_fingerprint_version_1_cache_args_is_stable():
+    # fingerprints of previous releases include internal keys
+    # and save_args/load_args
+    fp, saving, loading = _process_cache_args_requests()
+    assert fp == '7daad6ad7430fe5acf0808dda41943b45eed4498'
+    assert [prerender_request_fingerprint(r, version=1)
+            for r in [saving, loading]] == [
+        '2623a00ee5925c6e0f9792aea6e7c8822f1f1fa4',
+        '3f85d06b815d565e8cf7758d77d0fdaf17f57a83',
+    ]
+
+
+def test_fingerprint_doesnt_depend_on_remote_args_cache():
+    fp, saving, loading = _process_cache_args_requests(version=2)
+    assert prerender_request_fingerprint(saving, version=2) == \
+        prerender_request_fingerprint(loading, version=2)
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_fingerprint_policy(version):
+    from scrapy_prerender.fingerprints import FingerprintPolicy
+
+    def fp(request, **kwargs):
+        return prerender_request_fingerprint(
+            request, version=version, policy=FingerprintPolicy(**kwargs))
+
+    r1 = PrerenderRequest("http://example.com", args={'wait': 0.5},
+                          endpoint='execute', session_id='foo')
+    r2 = PrerenderRequest("http://example.com", args={'wait': 1.0},
+                          endpoint='execute', session_id='bar')
+    assert fp(r1) != fp(r2)
+    assert fp(r1, exclude=['session_id']) != fp(r2, exclude=['session_id'])
+    assert fp(r1, exclude=['args.wait']) != fp(r2, exclude=['args.wait'])
+    assert fp(r1, exclude=['session_id', 'args.wait']) == \
+        fp(r2, exclude=['session_id', 'args.wait'])
+    assert fp(r1, include=['args.url', 'endpoint']) == \
+        fp(r2, include=['args.url', 'endpoint'])
+    assert fp(r1, include=['args']) != fp(r2, include=['args'])
+
+    r3 = PrerenderRequest("http://example.com/foo", args={'wait': 0.5},
+                          endpoint='execute', session_id='foo')
+    assert fp(r1, include=['args.url']) != fp(r3, include=['args.url'])
+
+
+def test_fingerprint_policy_normalizers():
+    from scrapy_prerender.fingerprints import FingerprintPolicy
+    policy = FingerprintPolicy(arg_normalizers={
+        'headers': 'sort_headers',
+        'cookies': 'drop_volatile_cookies',
+    })
+
+    def fp(headers, cookies):
+        request = PrerenderRequest("http://example.com", args={
+            'headers': headers, 'cookies': cookies})
+        return prerender_request_fingerprint(request, policy=policy)
+
+    sid = {'name': 'sid', 'value': '1', 'domain': 'example.com'}
+    lang = {'name': 'lang', 'value': 'en', 'domain': 'example.com'}
+    ga = {'name': '_ga', 'value': 'GA1.2.3', 'domain': 'example.com'}
+    assert fp({'Accept': '*/*', 'X-Foo': 'bar'}, [sid, lang]) == \
+        fp([['x-foo', 'bar'], ['accept', '*/*']], [lang, ga, sid])
+    assert fp({'Accept': '*/*'}, [sid]) != fp({'Accept': 'text/html'}, [sid])
+    assert fp({}, [sid]) != fp({}, [lang])
+
+
+def test_fingerprint_policy_from_settings():
+    from scrapy.settings import Settings
+    from scrapy_prerender import PrerenderAwareDupeFilter
+    from scrapy_prerender.fingerprints import FingerprintPolicy, DropCookies
+
+    policy = FingerprintPolicy.from_settings(Settings({
+        'PRERENDER_FINGERPRINT_EXCLUDE': ['_*', 'session_id'],
+        'PRERENDER_FINGERPRINT_ARG_NORMALIZERS': {
+            'cookies': 'drop_volatile_cookies'},
+        'PRERENDER_FINGERPRINT_VOLATILE_COOKIES': ['tracking'],
+    }))
+    assert policy.exclude == ('_*', 'session_id')
+    assert policy.arg_normalizers['cookies'] == DropCookies(['tracking'])
+    assert FingerprintPolicy.from_settings(Settings()) == FingerprintPolicy()
+
+    df = PrerenderAwareDupeFilter.from_settings(Settings({
+        'PRERENDER_FINGERPRINT_EXCLUDE': ['_*', 'session_id']}))
+    r1 = PrerenderRequest("http://example.com", endpoint='execute',
+                          session_id='foo')
+    r2 = PrerenderRequest("http://example.com", endpoint='execute',
+                          session_id='bar')
+    assert df.request_fingerprint(r1) == df.request_fingerprint(r2)
+    assert prerender_request_fingerprint(r1) != \
+        prerender_request_fingerprint(r2)
+
+
+def test_hit_rate_stats(tmpdir):
+    from scrapy.http import HtmlResponse
+    from scrapy.utils.test import get_crawler
+    from scrapy_prerender import (
+        PrerenderAwareDupeFilter,
+        PrerenderAwareFSCacheStorage,
+    )
+    crawler = get_crawler(settings_dict={'HTTPCACHE_DIR': str(tmpdir)})
+    crawler.stats.open_spider(None)
+    spider = scrapy.Spider.from_crawler(crawler, name='foo')
+
+    storage = PrerenderAwareFSCacheStorage(crawler.settings)
+    storage.open_spider(spider)
+    req = PrerenderRequest("http://example.com")
+    assert storage.retrieve_response(spider, req) is None
+    storage.store_response(spider, req, HtmlResponse(req.url, body=b'hi'))
+    assert storage.retrieve_response(spider, req) is not None
+    storage.retrieve_response(spider, scrapy.Request("http://example.com"))
+
+    df = PrerenderAwareDupeFilter.from_settings(crawler.settings)
+    assert not df.request_seen(req)
+    assert df.request_seen(req)
+    df.log(req, spider)
+
+    stats = crawler.stats.get_stats()
+    assert stats['prerender/httpcache/hit'] == 1
+    assert stats['prerender/httpcache/miss'] == 1
+    assert stats['prerender/dupefilter/filtered'] == 1
+
+
+def _batch_requests():
+    spider = scrapy.Spider(name='foo')
+    mw = _get_mw()
+    reqs = [
+        scrapy.Request("http://example.com/plain"),
+        PrerenderRequest("http://example.com/a", args={'wait': 0.5},
+                         headers={'Accept': 'text/html'}),
+        _versioned_request(),
+    ]
+    reqs.append(mw.process_request(_versioned_request(), spider))
+    reqs.extend(PrerenderDeduplicateArgsMiddleware().process_start_requests(
+        [_cache_args_request()], spider))
+    return reqs
+
+
+@pytest.mark.parametrize('version', [1, 2])
+@pytest.mark.parametrize('include_headers', [None, ['Accept']])
+def test_batch_fingerprints(version, include_headers):
+    policy = FingerprintPolicy(exclude=['_*', 'args.wait'])
+    expected = [prerender_request_fingerprint(r, include_headers, version, policy)
+                for r in _batch_requests()]
+    assert len(set(expected)) == len(expected)
+
+    assert prerender_request_fingerprints(
+        _batch_requests(), include_headers, version, policy) == expected
+
+    pool = multiprocessing.Pool(2)
+    try:
+        reqs = _batch_requests()
+        assert prerender_request_fingerprints(
+            reqs, include_headers, version, policy, pool=pool,
+            chunksize=2) == expected
+    finally:
+        pool.close()
+        pool.join()
+    # results are cached
+    for req, fp in zip(reqs, expected):
+        cache_key = (dupefilter._normalize_include_headers(include_headers),
+                     version, policy,
+                     bool(req.meta.get('_prerender_processed')))
+        assert dupefilter._fingerprint_cache[req][cache_key] == fp
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_batch_fingerprints_backend_pool(version):
+    # processed requests are spread between backends, but their
+    # fingerprints must be the same in pool processes
+    crawler = _get_crawler({'PRERENDER_URLS': ['http://prerender1:8050',
+                                               'http://prerender2:8050']})
+    crawler.stats.open_spider(None)
+    mw = PrerenderMiddleware.from_crawler(crawler)
+    spider = scrapy.Spider(name='foo')
+
+    def requests():
+        return [mw.process_request(PrerenderRequest(
+            "http://example.com/%d" % i, endpoint='execute'), spider)
+            for i in range(4)]
+
+    reqs = requests()
+    assert len({req.url for req in reqs}) == 2
+    expected = prerender_request_fingerprints(reqs, version=version)
+
+    pool = multiprocessing.Pool(2)
+    try:
+        assert prerender_request_fingerprints(
+            requests(), version=version, pool=pool, chunksize=2) == expected
+    finally:
+        pool.close()
+        pool.join()
+
+
+def test_dupefilter_prefilter():
+    from scrapy.utils.test import get_crawler
+    crawler = get_crawler()
+    df = PrerenderAwareDupeFilter.from_crawler(crawler)
+    crawler.stats.open_spider(None)
+    seen = PrerenderRequest("http://example.com/1")
+    assert not df.request_seen(seen)
+    reqs = [PrerenderRequest("http://example.com/%d" % i) for i in range(5)]
+    reqs.append(PrerenderRequest("http://example.com/1", dont_filter=True))
+    reqs.append({'item': 1})
+    result = list(df.prefilter(reqs, chunksize=2))
+    assert [getattr(r, 'url', r) for r in result] == [
+        "http://example.com/0", "http://example.com/2", "http://example.com/3",
+        "http://example.com/4", "http://example.com/1", {'item': 1},
+    ]
+    assert crawler.stats.get_value('prerender/dupefilter/prefiltered') == 1
+    # requests are not marked as seen
+    assert not df.request_seen(reqs[0])
+
+
+class _Attrs(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def test_prefilter_middleware():
+    from scrapy.utils.test import get_crawler
+    crawler = get_crawler(settings_dict={'PRERENDER_PREFILTER_PROCESSES': 2})
+    mw = PrerenderPrefilterMiddleware.from_crawler(crawler)
+    spider = scrapy.Spider(name='foo')
+    reqs = [PrerenderRequest("http://example.com/%d" % (i % 3))
+            for i in range(10)]
+
+    # no dupefilter
+    crawler.engine = None
+    assert list(mw.process_start_requests(reqs, spider)) == reqs
+
+    df = PrerenderAwareDupeFilter.from_crawler(crawler)
+    df.request_seen(reqs[0])
+    crawler.engine = _Attrs(slot=_Attrs(scheduler=_Attrs(df=df)))
+    result = list(mw.process_start_requests(iter(reqs), spider))
+    assert result == [r for r in reqs if r.url != reqs[0].url]
+    for req in result:
+        assert req in dupefilter._fingerprint_cache
@@ -5,7 +5,7 @@ from twisted.web.resource import Resource
 from w3lib.url import canonicalize_url
 
 from scrapy_prerender import PrerenderRequest
-from .utils import crawl_items, requires_prerender, HtmlResource
+from .utils import crawl_items, make_crawler, requires_prerender, HtmlResource
 
 DEFAULT_SCRIPT = """
 function main(prerender)
@@ -306,3 +306,45 @@ def test_cookies(settings):
         'bomb': BOMB,
     }
     assert prerender_request_headers.get(b'Cookie') is None
+
+
+@inlineCallbacks
+def test_mock_prerender_crawl(settings):
+    """ Crawl through the full middleware stack using a mock Prerender """
+    from twisted.internet import reactor
+    from twisted.web.server import Site
+    from .mockprerender import MockPrerender
+
+    class ManyPagesSpider(scrapy.Spider):
+        def start_requests(self):
+            for i in range(30):
+                yield PrerenderRequest(
+                    'http://example.com/page/%d' % i,
+                    endpoint='execute',
+                    args={'lua_source': DEFAULT_SCRIPT},
+                    cache_args=['lua_source'],
+                )
+
+        def parse(self, response):
+            yield {'url': response.url, 'cookies': response.data['cookies']}
+
+    mock = MockPrerender(latency=0.01, latency_distribution='exponential',
+                         forget_rate=0.2, seed=0)
+    port = reactor.listenTCP(0, Site(mock), interface='127.0.0.1')
+    settings.set('PRERENDER_URL', 'http://127.0.0.1:%d' % port.getHost().port)
+    settings.set('CONCURRENT_REQUESTS', 1)
+    crawler = make_crawler(ManyPagesSpider, settings)
+    try:
+        yield crawler.crawl()
+    finally:
+        yield port.stopListening()
+
+    items = crawler.spider.collected_items
+    assert len(items) == 30
+    stats = crawler.stats.get_stats()
+    assert stats['prerender/498_retry_count'] > 0
+    assert stats['prerender/cache_args/hit'] > 0
+    # cookies are kept between requests of a session
+    visits = max(int(c['value']) for item in items for c in item['cookies']
+                 if c['name'] == 'mock_visits')
+    assert visits == 30
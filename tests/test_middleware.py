@@ -3,21 +3,31 @@ from __future__ import absolute_import
 import copy
 import json
 import base64
+import zlib
 
+import pytest
 import scrapy
+from twisted.internet import defer
+from twisted.internet.error import ConnectionRefusedError
+from scrapy.exceptions import NotConfigured
 from scrapy.core.engine import ExecutionEngine
 from scrapy.utils.test import get_crawler
 from scrapy.http import Response, TextResponse
 from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.downloadermiddlewares.httpcompression import (
+    HttpCompressionMiddleware)
 
 import scrapy_prerender
-from scrapy_prerender.utils import to_native_str
+import scrapy_prerender.signals
+from scrapy_prerender import utils
+from scrapy_prerender.utils import to_native_str, to_bytes, json_based_hash
 from scrapy_prerender import (
     PrerenderRequest,
     PrerenderMiddleware,
     SlotPolicy,
     PrerenderCookiesMiddleware,
     PrerenderDeduplicateArgsMiddleware,
+    prerender_request_fingerprint,
 )
 
 
@@ -449,15 +459,19 @@ def test_change_response_class_to_json_binary():
     assert resp2.body == b'non-decodable data: \x98\x11\xe7\x17\x8f'
 
 
-def test_magic_response_caching(tmpdir):
+@pytest.mark.parametrize('decoded', [False, True])
+def test_magic_response_caching(tmpdir, decoded):
     # prepare middlewares
     spider = scrapy.Spider(name='foo')
     crawler = _get_crawler({
         'HTTPCACHE_DIR': str(tmpdir.join('cache')),
         'HTTPCACHE_STORAGE': 'scrapy_prerender.PrerenderAwareFSCacheStorage',
-        'HTTPCACHE_ENABLED': True
+        'HTTPCACHE_ENABLED': True,
+        'PRERENDER_HTTPCACHE_DECODED': decoded,
     })
     cache_mw = HttpCacheMiddleware.from_crawler(crawler)
+    # rendered page headers must not be seen by HttpCompressionMiddleware
+    compression_mw = HttpCompressionMiddleware.from_crawler(crawler)
     mw = _get_mw()
     cookie_mw = _get_cookie_mw()
 
@@ -481,6 +495,10 @@ def test_magic_response_caching(tmpdir):
     resp_data = {
         'html': "<html><body>Hello</body></html>",
         'render_time': 0.5,
+        'headers': [
+            {'name': 'Content-Type', 'value': 'text/html; charset=utf-8'},
+            {'name': 'Content-Encoding', 'value': 'gzip'},
+        ],
     }
     resp_body = json.dumps(resp_data).encode('utf8')
     resp = TextResponse("http://example.com",
@@ -488,6 +506,7 @@ def test_magic_response_caching(tmpdir):
                         body=resp_body)
 
     resp2 = cache_mw.process_response(req, resp, spider)
+    resp2 = compression_mw.process_response(req, resp2, spider)
     resp3 = mw.process_response(req, resp2, spider)
     resp3 = cookie_mw.process_response(req, resp3, spider)
 
@@ -503,8 +522,10 @@ def test_magic_response_caching(tmpdir):
 
     # response should be from cache:
     assert cached_resp.__class__ is TextResponse
-    assert cached_resp.body == resp_body
+    assert cached_resp.body == (b'' if decoded else resp_body)
+    assert cached_resp.headers[b'Content-Type'] == b'application/json'
     resp2_1 = cache_mw.process_response(req, cached_resp, spider)
+    resp2_1 = compression_mw.process_response(req, resp2_1, spider)
     resp3_1 = mw.process_response(req, resp2_1, spider)
     resp3_1 = cookie_mw.process_response(req, resp3_1, spider)
 
@@ -613,6 +634,8 @@ def test_cache_args():
                         body=resp_body.encode('utf8'))
     req4 = mw.process_response(req3, resp, spider)
     assert isinstance(req4, PrerenderRequest)
+    # fingerprint of the retry is the same, so it must not be filtered
+    assert req4.dont_filter
 
     # process this request again
     req4, = list(dedupe_mw.process_spider_output(resp, [req4], spider))
@@ -765,3 +788,479 @@ def test_adjust_timeout():
     })
     req2 = mw.process_request(req2, None)
     assert req2.meta['download_timeout'] == 30
+
+
+def test_json_serializer_compact():
+    mw = _get_mw()
+    req = PrerenderRequest("http://example.com", args={'wait': 0.5})
+    req = mw.process_request(req, None)
+    assert req.body == b'{"url":"http://example.com","wait":0.5}'
+
+
+@pytest.mark.parametrize('serializer', ['json', 'pretty', 'auto'])
+def test_json_serializer_setting(serializer):
+    crawler = _get_crawler({'PRERENDER_JSON_SERIALIZER': serializer})
+    mw = PrerenderMiddleware.from_crawler(crawler)
+    args = {'wait': 0.5, 'lua_source': u'-- Привет', 'headers': {'X': 'y'}}
+    req = PrerenderRequest("http://example.com", args=args)
+    req = mw.process_request(req, None)
+    assert json.loads(req.body.decode('utf8')) == dict(args, url=req._original_url)
+
+
+def test_json_serializer_orjson():
+    pytest.importorskip('orjson')
+    crawler = _get_crawler({'PRERENDER_JSON_SERIALIZER': 'orjson'})
+    mw = PrerenderMiddleware.from_crawler(crawler)
+    req = PrerenderRequest("http://example.com", args={'wait': 0.5})
+    req = mw.process_request(req, None)
+    assert json.loads(req.body.decode('utf8')) == {'url': 'http://example.com',
+                                                   'wait': 0.5}
+
+
+def test_json_serializer_invalid():
+    crawler = _get_crawler({'PRERENDER_JSON_SERIALIZER': 'nonexisting'})
+    with pytest.raises(NotConfigured):
+        PrerenderMiddleware.from_crawler(crawler)
+
+
+@pytest.mark.parametrize(['encoding', 'wbits'], [
+    ('gzip', 16 + zlib.MAX_WBITS),
+    ('deflate', zlib.MAX_WBITS),
+])
+def test_request_compression(encoding, wbits):
+    crawler = _get_crawler({
+        'PRERENDER_REQUEST_COMPRESSION': encoding,
+        'PRERENDER_REQUEST_COMPRESSION_MIN_SIZE': 100,
+    })
+    mw = PrerenderMiddleware.from_crawler(crawler)
+
+    # small bodies are sent as-is
+    req = mw.process_request(PrerenderRequest("http://example.com"), None)
+    assert b'Content-Encoding' not in req.headers
+    assert json.loads(req.body.decode('utf8')) == {'url': 'http://example.com'}
+
+    args = {'lua_source': 'function main() end' + ' ' * 1000}
+    req = mw.process_request(PrerenderRequest("http://example.com",
+                                              args=args), None)
+    assert req.headers[b'Content-Encoding'] == to_bytes(encoding)
+    assert req.headers[b'Content-Type'] == b'application/json'
+    assert len(req.body) < 100
+    body = zlib.decompress(req.body, wbits)
+    assert json.loads(body.decode('utf8')) == dict(args, url='http://example.com')
+
+
+def test_request_compression_invalid():
+    crawler = _get_crawler({'PRERENDER_REQUEST_COMPRESSION': 'br'})
+    with pytest.raises(NotConfigured):
+        PrerenderMiddleware.from_crawler(crawler)
+
+
+def test_hash_cache_stats():
+    spider = scrapy.Spider(name='foo')
+    crawler = _get_crawler({'PRERENDER_HASH_CACHE_MAX_ENTRIES': 1})
+    dedupe_mw = PrerenderDeduplicateArgsMiddleware.from_crawler(crawler)
+    crawler.stats.open_spider(spider)
+    requests = [
+        PrerenderRequest('http://example.com/%d' % i, endpoint='execute',
+                         args={'lua_source': source},
+                         cache_args=['lua_source'])
+        for i, source in enumerate(['foo', 'foo', 'bar'])
+    ]
+    list(dedupe_mw.process_start_requests(requests, spider))
+    dedupe_mw.spider_closed(spider)
+    stats = crawler.stats.get_stats(spider)
+    assert stats['prerender/hash_cache/hit'] == 1
+    assert stats['prerender/hash_cache/miss'] == 2
+    assert stats['prerender/hash_cache/evictions'] == 1
+    assert stats['prerender/hash_cache/entries'] == 1
+
+
+def test_hash_cache_jobdir(tmpdir):
+    spider = scrapy.Spider(name='foo')
+    crawler = _get_crawler({'JOBDIR': str(tmpdir)})
+    dedupe_mw = PrerenderDeduplicateArgsMiddleware.from_crawler(crawler)
+    dedupe_mw.spider_opened(spider)
+    lua_source = 'function main(prerender) end'
+    req = PrerenderRequest('http://example.com', endpoint='execute',
+                           args={'lua_source': lua_source},
+                           cache_args=['lua_source'])
+    req, = dedupe_mw.process_start_requests([req], spider)
+    fp = req.meta['prerender']['args']['lua_source'][len('LOCAL+'):]
+    dedupe_mw.spider_closed(spider)
+
+    # a new process: the cache is loaded from JOBDIR
+    dedupe_mw = PrerenderDeduplicateArgsMiddleware.from_crawler(crawler)
+    dedupe_mw.spider_opened(spider)
+    assert len(dedupe_mw.hash_cache) == 1
+    assert utils._cached_json_based_hash(
+        lua_source, stable=True, cache=dedupe_mw.hash_cache) == (fp, True)
+    assert fp == json_based_hash(lua_source)
+
+
+def test_hash_cache_per_crawler():
+    spider = scrapy.Spider(name='foo')
+    crawler1 = _get_crawler({'PRERENDER_HASH_CACHE_MAX_ENTRIES': 1})
+    crawler2 = _get_crawler({'PRERENDER_HASH_CACHE_MAX_BYTES': 10 ** 6})
+    mw1 = PrerenderDeduplicateArgsMiddleware.from_crawler(crawler1)
+    mw2 = PrerenderDeduplicateArgsMiddleware.from_crawler(crawler2)
+    assert mw1.hash_cache is not mw2.hash_cache
+    assert (mw1.hash_cache.max_entries, mw1.hash_cache.max_bytes) == (1, None)
+    assert (mw2.hash_cache.max_entries, mw2.hash_cache.max_bytes) == (
+        10000, 10 ** 6)
+
+    requests = [
+        PrerenderRequest('http://example.com/%d' % i, endpoint='execute',
+                         args={'lua_source': source},
+                         cache_args=['lua_source'])
+        for i, source in enumerate(['foo', 'bar'])
+    ]
+    list(mw2.process_start_requests(requests, spider))
+    assert len(mw1.hash_cache) == 0
+    assert len(mw2.hash_cache) == 2
+
+
+@pytest.mark.parametrize('settings', [
+    {'PRERENDER_HASH_CACHE_MAX_ENTRIES': 0},
+    {'PRERENDER_HASH_CACHE_MAX_BYTES': 0},
+    {'PRERENDER_HASH_CACHE_MAX_BYTES': -1},
+])
+def test_hash_cache_invalid_limits(settings):
+    with pytest.raises(NotConfigured):
+        PrerenderDeduplicateArgsMiddleware.from_crawler(_get_crawler(settings))
+
+
+def test_request_compression_498_retry():
+    spider = scrapy.Spider(name='foo')
+    crawler = _get_crawler({
+        'PRERENDER_REQUEST_COMPRESSION': 'gzip',
+        'PRERENDER_REQUEST_COMPRESSION_MIN_SIZE': 1000,
+    })
+    mw = PrerenderMiddleware.from_crawler(crawler)
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    dedupe_mw = PrerenderDeduplicateArgsMiddleware()
+
+    lua_source = 'function main(prerender) end' + ' ' * 2000
+    fp = 'LOCAL+' + json_based_hash(lua_source)
+    mw._remote_keys[fp] = 'ba001160ef96fe2a3f938fea9e6762e204a562b3'
+    req = PrerenderRequest('http://example.com/baz', endpoint='execute',
+                           args={'lua_source': lua_source},
+                           cache_args=['lua_source'])
+    req, = list(dedupe_mw.process_start_requests([req], spider))
+    req = mw.process_request(req, spider)
+
+    # load_args request is small, it is not compressed
+    assert b'Content-Encoding' not in req.headers
+    assert 'load_args' in json.loads(req.body.decode('utf8'))
+
+    resp = TextResponse("http://127.0.0.1:8050/execute",
+                        headers={b'Content-Type': b'application/json'},
+                        status=498, body=b'{"error": 498}')
+    req2 = mw.process_response(req, resp, spider)
+    assert req2.headers[b'Content-Encoding'] == b'gzip'
+    body = zlib.decompress(req2.body, 16 + zlib.MAX_WBITS)
+    assert json.loads(body.decode('utf8')) == {
+        'lua_source': lua_source,
+        'save_args': ['lua_source'],
+        'url': 'http://example.com/baz',
+    }
+
+
+def test_backend_pool():
+    crawler = _get_crawler({
+        'PRERENDER_URLS': ['http://prerender1:8050', 'http://prerender2:8050'],
+        'PRERENDER_BALANCE_POLICY': 'least_outstanding',
+    })
+    crawler.stats.open_spider(None)
+    mw = PrerenderMiddleware.from_crawler(crawler)
+
+    # first pass: choose a backend
+    req1 = mw.process_request(PrerenderRequest("http://example.com/1"), None)
+    req2 = mw.process_request(PrerenderRequest("http://example.com/2"), None)
+    # second pass: requests are sent to backends
+    assert mw.process_request(req1, None) is None
+    assert req1.url == 'http://prerender1:8050/render'
+    assert mw.process_request(req2, None) is None
+    assert req2.url == 'http://prerender2:8050/render'
+    assert [b.outstanding for b in mw.backend_pool.backends] == [1, 1]
+
+    req3 = mw.process_request(PrerenderRequest("http://example.com/3"), None)
+    assert mw.process_request(req3, None) is None
+    assert [b.outstanding for b in mw.backend_pool.backends] == [2, 1]
+
+    resp = TextResponse(req1.url, body=b'<html></html>',
+                        headers={b'Content-Type': b'text/html'})
+    mw.process_response(req1, resp, None)
+    mw.process_exception(req3, ValueError(), None)
+    assert [b.outstanding for b in mw.backend_pool.backends] == [0, 1]
+
+    # a request with explicit prerender_url doesn't use the pool
+    req4 = PrerenderRequest("http://example.com/4",
+                            prerender_url='http://prerender3:8050')
+    req4 = mw.process_request(req4, None)
+    assert mw.process_request(req4, None) is None
+    assert req4.url == 'http://prerender3:8050/render'
+    assert [b.outstanding for b in mw.backend_pool.backends] == [0, 1]
+
+    stats = crawler.stats.get_stats()
+    assert stats['prerender/backend/http://prerender1:8050/request_count'] == 2
+    assert stats['prerender/backend/http://prerender2:8050/request_count'] == 1
+    assert stats['prerender/backend/http://prerender1:8050/response_count/200'] == 1
+    assert stats['prerender/backend/http://prerender1:8050/exception_count/ValueError'] == 1
+
+
+@pytest.mark.parametrize('urls', [
+    ['http://prerender1:8050', 'http://prerender2:8050'],
+    {'http://prerender1:8050': 1, 'http://prerender2:8050': 3},
+    'http://prerender1:8050, http://prerender2:8050',
+])
+@pytest.mark.parametrize('version', [1, 2])
+def test_backend_pool_fingerprints(version, urls):
+    crawler = _get_crawler({'PRERENDER_URLS': urls})
+    crawler.stats.open_spider(None)
+    mw = PrerenderMiddleware.from_crawler(crawler)
+    requests = [mw.process_request(PrerenderRequest("http://example.com"), None)
+                for _ in range(2)]
+    assert [req.url for req in requests] == [
+        'http://prerender1:8050/render', 'http://prerender2:8050/render']
+    fp1, fp2 = [prerender_request_fingerprint(req, version=version)
+                for req in requests]
+    assert fp1 == fp2
+
+    # fingerprints are the same as fingerprints of requests sent
+    # to a single server
+    crawler = _get_crawler({'PRERENDER_URL': 'http://prerender1:8050'})
+    crawler.stats.open_spider(None)
+    mw = PrerenderMiddleware.from_crawler(crawler)
+    req = mw.process_request(PrerenderRequest("http://example.com"), None)
+    assert prerender_request_fingerprint(req, version=version) == fp1
+
+
+def test_backend_pool_invalid_policy():
+    crawler = _get_crawler({'PRERENDER_URLS': ['http://prerender1:8050'],
+                            'PRERENDER_BALANCE_POLICY': 'random'})
+    with pytest.raises(NotConfigured):
+        PrerenderMiddleware.from_crawler(crawler)
+
+
+def test_circuit_breaker():
+    urls = ['http://prerender1:8050', 'http://prerender2:8050']
+    crawler = _get_crawler({
+        'PRERENDER_URLS': urls,
+        'PRERENDER_CIRCUIT_BREAKER_ENABLED': True,
+        'PRERENDER_CIRCUIT_BREAKER_THRESHOLD': 2,
+    })
+    crawler.stats.open_spider(None)
+    mw = PrerenderMiddleware.from_crawler(crawler)
+    events = []
+    crawler.signals.connect(
+        lambda backend, reason: events.append(('opened', backend, reason)),
+        signal=scrapy_prerender.signals.backend_circuit_opened, weak=False)
+    crawler.signals.connect(
+        lambda backend: events.append(('closed', backend)),
+        signal=scrapy_prerender.signals.backend_circuit_closed, weak=False)
+
+    def send():
+        req = mw.process_request(PrerenderRequest("http://example.com"), None)
+        mw.process_request(req, None)
+        return req
+
+    late = send()
+    if not late.url.startswith(urls[1]):
+        late = send()
+
+    # prerender2 fails
+    for i in range(2):
+        req1, req2 = send(), send()
+        assert req2.url.startswith(urls[1])
+        mw.process_response(req1, TextResponse(req1.url, status=200), None)
+        mw.process_response(req2, TextResponse(req2.url, status=503), None)
+    assert events == [('opened', urls[1], 'HTTP 503')]
+    assert [send().url for i in range(3)] == [urls[0] + '/render'] * 3
+
+    # a late success of a request sent before the breaker opened
+    # doesn't close it, even when it is half-open
+    breaker = mw.backend_pool.get(urls[1]).breaker
+    breaker.half_open()
+    mw.process_response(late, TextResponse(late.url, status=200), None)
+    assert events == [('opened', urls[1], 'HTTP 503')]
+    breaker.state = breaker.OPEN
+
+    # a probe is sent after a timeout; the breaker is closed if it succeeds
+    probes = []
+
+    def download(request, spider):
+        probes.append(request.url)
+        return defer.succeed(Response(request.url, status=200))
+    crawler.engine.download = download
+    mw.backend_pool.get(urls[1]).breaker.opened_at -= 60
+    send()
+    assert probes == [urls[1] + '/_ping']
+    assert events[-1] == ('closed', urls[1])
+    assert {send().url for i in range(4)} == {u + '/render' for u in urls}
+
+    # connection errors are failures too
+    for i in range(2):
+        req = send()
+        if req.url.startswith(urls[0]):
+            req = send()
+        mw.process_exception(req, ConnectionRefusedError(), None)
+    assert events[-1] == ('opened', urls[1], 'ConnectionRefusedError')
+
+    stats = crawler.stats.get_stats()
+    assert stats['prerender/backend/%s/circuit_opened' % urls[1]] == 2
+    assert stats['prerender/backend/%s/circuit_closed' % urls[1]] == 1
+    assert stats['prerender/backend/%s/probe_count' % urls[1]] == 1
+
+
+def test_circuit_breaker_cached():
+    url = 'http://prerender1:8050'
+    crawler = _get_crawler({
+        'PRERENDER_URLS': [url],
+        'PRERENDER_CIRCUIT_BREAKER_ENABLED': True,
+        'PRERENDER_CIRCUIT_BREAKER_THRESHOLD': 2,
+    })
+    crawler.stats.open_spider(None)
+    mw = PrerenderMiddleware.from_crawler(crawler)
+    backend = mw.backend_pool.backends[0]
+    for i in range(3):
+        req = mw.process_request(PrerenderRequest("http://example.com"), None)
+        mw.process_request(req, None)
+        # e.g. a 503 response stored by HttpCacheMiddleware
+        mw.process_response(
+            req, TextResponse(req.url, status=503, flags=['cached']), None)
+    assert backend.outstanding == 0
+    assert backend.breaker.state == backend.breaker.CLOSED
+    stats = crawler.stats.get_stats()
+    assert 'prerender/backend/%s/response_count/503' % url not in stats
+
+
+def test_slot_policy_adaptive():
+    crawler = _get_crawler({
+        'PRERENDER_URLS': ['http://prerender1:8050', 'http://prerender2:8050'],
+        'PRERENDER_ADAPTIVE_START_CONCURRENCY': 8,
+    })
+    crawler.stats.open_spider(None)
+    mw = PrerenderMiddleware.from_crawler(crawler)
+
+    def send(url):
+        req = PrerenderRequest(url, slot_policy=SlotPolicy.ADAPTIVE)
+        return mw.process_request(req, None)
+
+    req1 = send("http://example.com/1")
+    req2 = send("http://example.com/2")
+    req3 = send("http://example.com/3")
+    assert req1.meta['download_slot'] == '__prerender__http://prerender1:8050'
+    assert req2.meta['download_slot'] == '__prerender__http://prerender2:8050'
+    assert req3.meta['download_slot'] == req1.meta['download_slot']
+
+    class Slot(object):
+        concurrency = 1
+    slot = crawler.engine.downloader.slots[req1.meta['download_slot']] = Slot()
+
+    # the start concurrency is used before the first response
+    crawler.signals.send_catch_log(
+        scrapy.signals.request_reached_downloader, request=req1, spider=None)
+    assert slot.concurrency == 8
+
+    slot.concurrency = 1
+    req1.meta['download_latency'] = 0.5
+    mw.process_response(req1, TextResponse(req1.url, status=200), None)
+    assert slot.concurrency == 8
+    # cached responses don't change the concurrency
+    for status in [429, 503, 504]:
+        req = send("http://example.com/cached")
+        while req.meta['download_slot'] != req1.meta['download_slot']:
+            req = send("http://example.com/cached")
+        mw.process_response(
+            req, TextResponse(req.url, status=status, flags=['cached']), None)
+    assert slot.concurrency == 8
+    mw.process_response(req3, TextResponse(req3.url, status=503), None)
+    assert slot.concurrency == 4
+    stats = crawler.stats.get_stats()
+    assert stats['prerender/adaptive/__prerender__http://prerender1:8050/decrease_count'] == 1
+    assert stats['prerender/adaptive/__prerender__http://prerender1:8050/concurrency'] == 4
+
+
+@pytest.mark.skipif(scrapy.version_info < (2, 0),
+                    reason="PRERENDER_BACKEND_CONCURRENCY requires Scrapy 2.0+")
+def test_backend_concurrency():
+    crawler = _get_crawler({
+        'PRERENDER_URLS': ['http://prerender1:8050'],
+        'PRERENDER_BACKEND_CONCURRENCY': 3,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 2,
+    })
+    crawler.stats.open_spider(None)
+    mw = PrerenderMiddleware.from_crawler(crawler)
+
+    def send(url):
+        req = mw.process_request(PrerenderRequest(url), None)
+        dfd = mw.process_request(req, None)
+        sent = []
+        if dfd is not None:
+            dfd.addCallback(sent.append)
+        else:
+            sent.append(None)
+        return req, sent
+
+    backend = mw.backend_pool.backends[0]
+    req1, sent1 = send("http://example.com/1")
+    req2, sent2 = send("http://example.com/2")
+    req3, sent3 = send("http://example.com/3")  # example.com slot is full
+    req4, sent4 = send("http://example.org/1")
+    req5, sent5 = send("http://example.org/2")  # backend is full
+    assert [sent1, sent2, sent3, sent4, sent5] == [[None], [None], [], [None], []]
+    assert backend.outstanding == 3
+
+    mw.process_response(req4, TextResponse(req4.url), None)
+    assert sent5 == [None]
+    assert sent3 == []
+    mw.process_exception(req1, ValueError(), None)
+    assert sent3 == [None]
+    assert backend.outstanding == 3
+    stats = crawler.stats.get_stats()
+    assert stats['prerender/backend/http://prerender1:8050/capacity_wait_count'] == 2
+
+    # waiting requests are cancelled when the spider is closed
+    send("http://example.com/4")
+    failures = []
+    mw.capacity_gate.waiting[0][0].addErrback(failures.append)
+    mw.spider_closed(None)
+    assert not mw.capacity_gate.waiting
+    assert [f.type for f in failures] == [defer.CancelledError]
+
+
+def test_latency_stats():
+    crawler = _get_crawler({'PRERENDER_LATENCY_STATS_PER_DOMAIN': True})
+    crawler.stats.open_spider(None)
+    mw = PrerenderMiddleware.from_crawler(crawler)
+    req = mw.process_request(PrerenderRequest("http://example.com/1"), None)
+    mw.process_request(req, None)
+    req.meta['_prerender_start_time'] -= 2.0
+    req.meta['_prerender_sent_time'] -= 1.0
+    mw.process_response(req, TextResponse(req.url), None)
+
+    # cached responses are not counted
+    req = mw.process_request(PrerenderRequest("http://example.com/2"), None)
+    mw.process_request(req, None)
+    mw.process_response(req, TextResponse(req.url, flags=['cached']), None)
+
+    mw.spider_closed(None)
+    stats = crawler.stats.get_stats()
+    assert stats['prerender/render/latency/total/count'] == 1
+    assert 1.9 < stats['prerender/render/latency/total/p50'] < 2.1
+    assert 0.9 < stats['prerender/render/latency/wait/p95'] < 1.1
+    assert 0.9 < stats['prerender/render/latency/render/p99'] < 1.1
+    assert stats['prerender/backend/http://127.0.0.1:8050/latency/total/count'] == 1
+    assert stats['prerender/domain/example.com/latency/render/count'] == 1
+
+
+def test_latency_stats_disabled():
+    crawler = _get_crawler({'PRERENDER_LATENCY_STATS': False})
+    crawler.stats.open_spider(None)
+    mw = PrerenderMiddleware.from_crawler(crawler)
+    req = mw.process_request(PrerenderRequest("http://example.com/1"), None)
+    mw.process_request(req, None)
+    mw.process_response(req, TextResponse(req.url), None)
+    mw.spider_closed(None)
+    assert not [k for k in crawler.stats.get_stats() if '/latency/' in k]
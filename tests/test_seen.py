@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import hashlib
+import os
+
+import pytest
+from scrapy.utils.test import get_crawler
+
+from scrapy_prerender import PrerenderRequest, PrerenderAwareDupeFilter
+from scrapy_prerender.seen import (
+    DigestTable,
+    MmapDigestTable,
+    ScalableBloomFilter,
+)
+
+
+def _digests(n, start=0):
+    return [hashlib.sha1(str(i).encode('ascii')).digest()
+            for i in range(start, start + n)]
+
+
+@pytest.mark.parametrize('digest_size', [16, 20])
+def test_digest_table(digest_size):
+    table = DigestTable(digest_size, capacity=10)
+    digests = _digests(1000)
+    assert all(table.add(d) for d in digests)
+    assert not any(table.add(d) for d in digests)
+    assert len(table) == 1000
+    assert all(d in table for d in digests)
+    assert not any(d in table for d in _digests(1000, start=1000))
+    assert table.memory_usage() == table.slots_for(1000) * digest_size
+    assert sorted(table) == sorted(d[:digest_size] for d in digests)
+
+
+def test_digest_table_zero_digest():
+    table = DigestTable(16)
+    assert table.add(b'\x00' * 20)
+    assert b'\x00' * 16 in table
+    assert len(list(table)) == 1
+
+
+def test_digest_table_invalid():
+    with pytest.raises(ValueError):
+        DigestTable(4)
+    with pytest.raises(ValueError):
+        DigestTable(16).add(b'short')
+
+
+def test_digest_table_save_load(tmpdir):
+    path = str(tmpdir.join('table'))
+    table = DigestTable(20)
+    digests = _digests(100)
+    for d in digests:
+        table.add(d)
+    table.save(path)
+    assert not os.path.exists(path + '.tmp')
+
+    loaded = DigestTable.load(path)
+    assert loaded.digest_size == 20
+    assert len(loaded) == 100
+    assert all(d in loaded for d in digests)
+    assert loaded.add(_digests(1, start=100)[0])
+
+    with open(path, 'wb') as f:
+        f.write(b'\x00' * 64)
+    with pytest.raises(ValueError):
+        DigestTable.load(path)
+
+
+def test_mmap_digest_table(tmpdir):
+    path = str(tmpdir.join('table'))
+    table = MmapDigestTable(path, digest_size=20, capacity=10, flush_every=7)
+    digests = _digests(1000)
+    assert all(table.add(d) for d in digests)
+    assert not any(table.add(d) for d in digests)
+    assert len(table) == 1000
+    assert table.memory_usage() == table.slots_for(1000) * 20
+    table.close()
+    assert not os.path.exists(path + '.tmp')
+
+    table = MmapDigestTable(path, digest_size=16)
+    assert table.digest_size == 20
+    assert len(table) == 1000
+    assert all(d in table for d in digests)
+    assert not any(d in table for d in _digests(1000, start=1000))
+    # snapshot as a regular DigestTable
+    table.save(str(tmpdir.join('copy')))
+    assert sorted(DigestTable.load(str(tmpdir.join('copy')))) == sorted(table)
+    table.close()
+
+
+def test_mmap_digest_table_not_closed(tmpdir):
+    path = str(tmpdir.join('table'))
+    table = MmapDigestTable(path, flush_every=1000)
+    for d in _digests(10):
+        table.add(d)
+    table._slots.flush()  # written back by the OS, but the header is stale
+
+    table = MmapDigestTable(path)
+    assert len(table) == 10
+    assert all(d in table for d in _digests(10))
+    table.close()
+
+
+def test_mmap_digest_table_temporary_file():
+    table = MmapDigestTable(capacity=10)
+    assert all(table.add(d) for d in _digests(100))
+    assert len(table) == 100
+    table.close()
+
+
+def test_scalable_bloom_filter(tmpdir):
+    seen = ScalableBloomFilter(error_rate=0.01, initial_capacity=100)
+    digests = _digests(1000)
+    added = sum(seen.add(d) for d in digests)
+    assert added > 990  # false positives are possible
+    assert len(seen.filters) > 1
+    assert all(d in seen for d in digests)
+    false_positives = sum(d in seen for d in _digests(10000, start=1000))
+    assert false_positives < 10000 * 0.02  # estimates are approximate
+
+    path = str(tmpdir.join('bloom'))
+    seen.save(path)
+    loaded = ScalableBloomFilter.load(path)
+    assert len(loaded) == len(seen)
+    assert loaded.memory_usage() == seen.memory_usage()
+    assert all(d in loaded for d in digests)
+
+
+def _get_dupefilter(**settings):
+    crawler = get_crawler(settings_dict=settings)
+    return PrerenderAwareDupeFilter.from_crawler(crawler)
+
+
+@pytest.mark.parametrize('mode', ['set', 'compact', 'bloom', 'mmap'])
+def test_dupefilter_modes(mode, tmpdir):
+    jobdir = str(tmpdir)
+    df = _get_dupefilter(PRERENDER_DUPEFILTER_MODE=mode, JOBDIR=jobdir)
+    df.open()
+    r1 = PrerenderRequest('http://example.com', args={'wait': 0.5})
+    r2 = PrerenderRequest('http://example.com', args={'wait': 1.0})
+    r3 = PrerenderRequest('http://example.com', args={'wait': 0.5})
+    assert not df.request_seen(r1)
+    assert not df.request_seen(r2)
+    assert df.request_seen(r3)
+    df.close('finished')
+    assert df.stats.get_value('prerender/dupefilter/fingerprints') == 2
+    assert df.stats.get_value('prerender/dupefilter/memory_bytes') > 0
+    if mode != 'set':
+        assert not os.path.exists(os.path.join(jobdir, 'requests.seen'))
+
+    # state is restored from JOBDIR
+    df = _get_dupefilter(PRERENDER_DUPEFILTER_MODE=mode, JOBDIR=jobdir)
+    assert df.request_seen(r1)
+    assert not df.request_seen(
+        PrerenderRequest('http://example.com', args={'wait': 2.0}))
+    df.close('finished')
+
+
+def test_dupefilter_compact_memory_usage():
+    requests = [PrerenderRequest('http://example.com/%d' % i) for i in range(1000)]
+    usage = {}
+    for mode in ['set', 'compact', 'bloom']:
+        df = _get_dupefilter(PRERENDER_DUPEFILTER_MODE=mode,
+                             PRERENDER_DUPEFILTER_CAPACITY=1000)
+        for request in requests:
+            df.request_seen(request)
+        usage[mode] = df.memory_usage()
+    assert usage['bloom'] < usage['compact'] < usage['set']
+
+
+def test_dupefilter_invalid_settings():
+    with pytest.raises(ValueError):
+        _get_dupefilter(PRERENDER_DUPEFILTER_MODE='foo')
+    with pytest.raises(ValueError):
+        _get_dupefilter(PRERENDER_DUPEFILTER_DIGEST_SIZE=8)
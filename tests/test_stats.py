@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import random
+
+from scrapy.statscollectors import MemoryStatsCollector
+from scrapy.utils.test import get_crawler
+
+from scrapy_prerender.stats import LatencyHistogram, LatencyStats
+
+
+def test_histogram_percentiles():
+    rnd = random.Random(0)
+    values = [rnd.expovariate(1.0) for i in range(10000)]
+    histogram = LatencyHistogram(precision=0.02)
+    for value in values:
+        histogram.add(value)
+    values.sort()
+    for p in [50, 95, 99]:
+        exact = values[int(len(values) * p / 100.0) - 1]
+        assert abs(histogram.percentile(p) - exact) / exact < 0.02
+    assert histogram.max == values[-1]
+    assert histogram.count == 10000
+    # memory is bounded
+    assert len(histogram.buckets) < 1000
+
+
+def test_histogram_empty_and_small_values():
+    histogram = LatencyHistogram()
+    assert histogram.percentile(50) == 0.0
+    assert histogram.mean == 0.0
+    # values smaller than min_value are recorded as min_value
+    histogram.add(0)
+    assert histogram.percentile(99) == histogram.min_value
+
+
+def test_histogram_merge():
+    h1, h2 = LatencyHistogram(), LatencyHistogram()
+    for i in range(1, 51):
+        h1.add(i)
+        h2.add(i + 50)
+    h1.merge(h2)
+    assert h1.count == 100
+    assert h1.max == 100
+    assert abs(h1.percentile(50) - 50) < 1
+
+
+def test_latency_stats():
+    stats = LatencyStats(max_histograms=2)
+    stats.add('a', 1.0)
+    stats.add('a', 3.0)
+    stats.add('b', 1.0)
+    stats.add('c', 1.0)
+    assert sorted(stats.histograms) == ['a', 'b']
+    summary = stats.summary('a')
+    assert summary['count'] == 2
+    assert summary['mean'] == 2.0
+    assert summary['max'] == 3.0
+    assert set(summary) == {'count', 'mean', 'max', 'p50', 'p95', 'p99'}
+
+    collector = MemoryStatsCollector(get_crawler())
+    stats.to_stats(collector)
+    assert collector.get_value('a/count') == 2
+    assert collector.get_value('b/p99') > 0
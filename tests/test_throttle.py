@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+from twisted.internet import defer
+
+from scrapy_prerender.throttle import AdaptiveConcurrency, CapacityGate
+
+
+def test_additive_increase():
+    aimd = AdaptiveConcurrency(start_concurrency=4, max_concurrency=6)
+    assert aimd.concurrency('a') == 4
+    for i in range(5):
+        assert not aimd.response_received('a', 200, 1.0, now=i)
+    assert aimd.concurrency('a') == 5
+    for i in range(100):
+        aimd.response_received('a', 200, 1.0, now=i)
+    assert aimd.concurrency('a') == 6
+
+    # slots are independent
+    assert aimd.concurrency('b') == 4
+
+
+def test_multiplicative_decrease():
+    aimd = AdaptiveConcurrency(start_concurrency=16, min_concurrency=2,
+                               cooldown=5)
+    aimd.response_received('a', 200, 1.0, now=0)
+    assert aimd.response_received('a', 503, None, now=1)
+    assert aimd.concurrency('a') == 8
+
+    # only one decrease per cooldown period
+    assert not aimd.congestion('a', now=2)
+    assert aimd.concurrency('a') == 8
+
+    # latency spikes
+    assert not aimd.response_received('a', 200, 1.5, now=7)
+    assert aimd.response_received('a', 200, 5.0, now=7)
+    assert aimd.concurrency('a') == 4
+
+    assert aimd.congestion('a', now=20)
+    assert aimd.congestion('a', now=30)
+    assert aimd.concurrency('a') == 2
+
+
+def test_latency_change():
+    aimd = AdaptiveConcurrency(start_concurrency=16, cooldown=0)
+    aimd.response_received('a', 200, 1.0, now=0)
+    # latency increases permanently; the usual latency follows it
+    decreases = [aimd.response_received('a', 200, 5.0, now=i)
+                 for i in range(1, 20)]
+    assert decreases[0]
+    assert not any(decreases[-10:])
+    assert aimd.concurrency('a') > 1
+
+
+def test_from_settings():
+    from scrapy.settings import Settings
+    aimd = AdaptiveConcurrency.from_settings(Settings({
+        'PRERENDER_ADAPTIVE_START_CONCURRENCY': 10,
+        'PRERENDER_ADAPTIVE_DECREASE_FACTOR': 0.7,
+    }))
+    assert aimd.concurrency('a') == 10
+    aimd.congestion('a', now=0)
+    assert aimd.concurrency('a') == 7
+
+
+def test_capacity_gate():
+    gate = CapacityGate()
+    limits_a = [('domain-a', 2), ('backend', 3)]
+    limits_b = [('domain-b', 2), ('backend', 3)]
+
+    assert gate.acquire(limits_a) is None
+    assert gate.acquire(limits_a) is None
+    # domain-a is full
+    fired = []
+    dfd_a = gate.acquire(limits_a)
+    dfd_a.addCallback(lambda _: fired.append('a'))
+    # domain-b has room
+    assert gate.acquire(limits_b) is None
+    # backend is full
+    dfd_b = gate.acquire(limits_b)
+    dfd_b.addCallback(lambda _: fired.append('b'))
+    assert gate.active == {'domain-a': 2, 'domain-b': 1, 'backend': 3}
+
+    # domain-b request is finished; backend has room now, but
+    # the first waiting request still can't be sent
+    gate.release(['domain-b', 'backend'])
+    assert fired == ['b']
+    gate.release(['domain-a', 'backend'])
+    assert fired == ['b', 'a']
+    assert gate.active == {'domain-a': 2, 'domain-b': 1, 'backend': 3}
+    assert not gate.waiting
+
+
+def test_capacity_gate_order():
+    gate = CapacityGate()
+    limits = [('domain', 1)]
+    assert gate.acquire(limits) is None
+    fired = []
+    for i in range(3):
+        gate.acquire(limits).addCallback(lambda _, i=i: fired.append(i))
+    for i in range(3):
+        gate.release(['domain'])
+    assert fired == [0, 1, 2]
+    gate.release(['domain'])
+    assert gate.active == {}
+
+
+def test_capacity_gate_cancel():
+    gate = CapacityGate()
+    limits = [('domain', 1)]
+    assert gate.acquire(limits) is None
+    failures = []
+    dfd1 = gate.acquire(limits)
+    dfd2 = gate.acquire(limits)
+    dfd1.addErrback(failures.append)
+    dfd2.addErrback(failures.append)
+
+    dfd1.cancel()
+    assert len(gate.waiting) == 1
+    gate.cancel_all()
+    assert not gate.waiting
+    assert [f.type for f in failures] == [defer.CancelledError] * 2
+    gate.release(['domain'])
+    assert gate.active == {}
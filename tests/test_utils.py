@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 import json
+import os
+import subprocess
+import sys
+import threading
 
+import pytest
 from hypothesis import given, assume
 from hypothesis import strategies as st
 from scrapy.http import Headers
@@ -9,7 +14,8 @@ from scrapy_prerender.utils import (
     headers_to_scrapy,
     _fast_hash,
     json_based_hash,
-    dict_hash
+    dict_hash,
+    HashCache,
 )
 
 
@@ -61,6 +67,29 @@ def test_fast_hash(val1, val2):
     assert _fast_hash(val1) != _fast_hash(val2)
 
 
+def test_fast_hash_is_process_stable():
+    value = {"lua_source": "function main(prerender) end", "n": [1, b"x"]}
+    code = ("from scrapy_prerender.utils import _fast_hash; "
+            "print(_fast_hash(%r, stable=True))" % (value,))
+    env = dict(os.environ, PYTHONHASHSEED='1')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', code], env=env,
+                                     cwd=root)
+    assert output.decode('ascii').strip() == _fast_hash(value, stable=True)
+
+
+def test_fast_hash_uses_builtin_hash(monkeypatch):
+    from scrapy_prerender import utils
+
+    def _stable_hash(data):
+        raise AssertionError("stable hash is not needed")
+    monkeypatch.setattr(utils, '_stable_hash', _stable_hash)
+    value = {"lua_source": "function main(prerender) end"}
+    assert _fast_hash(value) == _fast_hash(dict(value))
+    with pytest.raises(AssertionError):
+        _fast_hash(value, stable=True)
+
+
 @given(_data, _data)
 def test_dict_hash(val1, val2):
     assume(val1 != val2)
@@ -73,3 +102,46 @@ def test_json_based_hash(val1, val2):
     assume(val1 != val2)
     assert json_based_hash(val1) == json_based_hash(val1)
     assert json_based_hash(val1) != json_based_hash(val2)
+
+
+def test_hash_cache_lru():
+    cache = HashCache(max_entries=3)
+    for key in 'abc':
+        cache.set(key, key.upper())
+    assert cache.get('a') == 'A'  # 'b' is the least recently used now
+    cache.set('d', 'D')
+    assert cache.get('b') is None
+    assert [cache.get(key) for key in 'acd'] == ['A', 'C', 'D']
+    assert (cache.hits, cache.misses, cache.evictions) == (4, 1, 1)
+
+
+def test_hash_cache_max_bytes():
+    cache = HashCache(max_entries=None, max_bytes=10000)
+    for i in range(1000):
+        cache.set('key%d' % i, 'x' * 40)
+    assert 0 < cache.bytes <= 10000
+    assert len(cache) == 1000 - cache.evictions
+    assert cache.get('key999') is not None
+
+    cache.set_limits(max_entries=5)
+    assert len(cache) == 5
+    cache.clear()
+    assert len(cache) == 0 and cache.bytes == 0
+
+
+def test_hash_cache_threads():
+    cache = HashCache(max_entries=50)
+
+    def worker(n):
+        for i in range(2000):
+            key = 'k%d' % ((i * n) % 100)
+            if cache.get(key) is None:
+                cache.set(key, key)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(1, 5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(cache) == 50
+    assert cache.hits + cache.misses == 8000